@@ -50,19 +50,45 @@ if XPRA_LOCAL_SERVERS_SUPPORTED:
                  % (cython_version_string,
                     ".".join([str(part) for part in NEEDED_CYTHON])))
 
+    # These only make things faster (xpra.kernels falls back on NumPy or
+    # plain Python without them), so failing to build one is not fatal:
+    OPTIONAL_EXTENSIONS = ("xpra._kernels",)
+
+    class build_ext_optional(build_ext):
+        def build_extensions(self):
+            extensions = self.extensions
+            self.extensions = [ext for ext in extensions
+                               if ext.name not in OPTIONAL_EXTENSIONS]
+            build_ext.build_extensions(self)
+            for ext in list(extensions):
+                if ext.name not in OPTIONAL_EXTENSIONS:
+                    continue
+                self.extensions = [ext]
+                try:
+                    build_ext.build_extensions(self)
+                except Exception, e:
+                    sys.stderr.write("WARNING: not building %s: %s\n"
+                                     % (ext.name, e))
+                    extensions.remove(ext)
+            self.extensions = extensions
+
     ext_modules = [
       Extension("wimpiggy.lowlevel.bindings",
                 ["wimpiggy/lowlevel/bindings.pyx"],
                 **pkgconfig("pygobject-2.0", "gdk-x11-2.0", "gtk+-x11-2.0",
-                            "xtst", "xfixes", "xcomposite", "xdamage")
+                            "xtst", "xfixes", "xcomposite", "xdamage",
+                            "xext", "xrandr")
                 ),
       Extension("xpra.wait_for_x_server",
                 ["xpra/wait_for_x_server.pyx"],
                 **pkgconfig("x11")
                 ),
+      Extension("xpra._kernels",
+                ["xpra/_kernels.pyx"],
+                ),
       ]
 
-    cmdclass = {'build_ext': build_ext}
+    cmdclass = {'build_ext': build_ext_optional}
 else:
     ext_modules = []
     cmdclass = {}
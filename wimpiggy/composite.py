@@ -10,7 +10,7 @@ from wimpiggy.lowlevel import (xcomposite_redirect_window,
                                xcomposite_unredirect_window,
                                xcomposite_name_window_pixmap,
                                xdamage_start, xdamage_stop,
-                               xdamage_acknowledge,
+                               xdamage_fetch,
                                add_event_receiver, remove_event_receiver,
                                get_parent, addXSelectInput, const,
                                geometry_with_border)
@@ -43,49 +43,68 @@ class CompositeHelper(AutoPropGObjectMixin, gobject.GObject):
         def setup():
             if not self._already_composited:
                 xcomposite_redirect_window(window)
-            (_, _, _, _, self._border_width) = geometry_with_border(window)
+            (_, _, w, h, self._border_width) = geometry_with_border(window)
+            self._size = (w, h)
         trap.call(setup)
+        # The ancestors we watch for unmaps and reparents; only a reparent
+        # changes who they are, so they are kept across pixmap refreshes:
         self._listening_to = None
-        self.invalidate_pixmap()
+        self._contents_handle = None
+        # For the logs, to see how much work the above saves:
+        self.pixmaps_named = 0
+        self.invalidations = 0
         self._damage_handle = xdamage_start(window)
 
         add_event_receiver(self._window, self)
 
     def destroy(self):
+        log("window %s: named %s pixmaps, invalidated %s times",
+            self._window, self.pixmaps_named, self.invalidations,
+            type="pixmap")
         if not self._already_composited:
             trap.swallow(xcomposite_unredirect_window, self._window)
         trap.swallow(xdamage_stop, self._window, self._damage_handle)
         self._damage_handle = None
         self._contents_handle = None
-        self.invalidate_pixmap()
+        self._stop_listening()
         remove_event_receiver(self._window, self)
         self._window = None
 
-    def acknowledge_changes(self, x, y, w, h):
-        if self._damage_handle is not None:
-            trap.swallow(xdamage_acknowledge,
-                         self._window, self._damage_handle,
-                         x - self._border_width,
-                         y - self._border_width,
-                         w, h)
+    def fetch_damage(self):
+        # Returns the (x, y, w, h) rectangles that changed since the last
+        # call, and clears them.  "contents-changed" is only emitted once
+        # until this is called again.
+        if self._damage_handle is None:
+            return []
+        try:
+            rects = trap.call(xdamage_fetch, self._window, self._damage_handle)
+        except XError:
+            log("window disappeared while fetching its damage")
+            return []
+        b = self._border_width
+        return [(x + b, y + b, w, h) for (x, y, w, h) in rects]
 
     def invalidate_pixmap(self):
-        log("invalidating named pixmap", type="pixmap")
+        if self._contents_handle is not None:
+            log("invalidating named pixmap", type="pixmap")
+            self.invalidations += 1
+            self._contents_handle = None
+
+    def _stop_listening(self):
+        self.invalidate_pixmap()
         if self._listening_to is not None:
             self._cleanup_listening(self._listening_to)
             self._listening_to = None
-        self._contents_handle = None
 
     def _cleanup_listening(self, listening):
         # Don't want to stop listening to self._window!:
-        assert self._window not in self._listening_to
-        for w in self._listening_to:
+        assert self._window not in listening
+        for w in listening:
             remove_event_receiver(w, self)
 
     def do_get_property_contents_handle(self, name):
         if self._contents_handle is None:
             log("refreshing named pixmap", type="pixmap")
-            assert self._listening_to is None
             def set_pixmap():
                 # The tricky part here is that the pixmap returned by
                 # NameWindowPixmap gets invalidated every time the window's
@@ -100,7 +119,17 @@ class CompositeHelper(AutoPropGObjectMixin, gobject.GObject):
                 #   2) QueryTree to get parent
                 #   3) repeat 1 & 2 up to the root
                 #   4) call NameWindowPixmap
-                # we are safe.  (I think.)
+                # we are safe.  (I think.)  Once we have done steps 1-3, we
+                # stay subscribed until a reparent changes the ancestry, so
+                # later refreshes can skip straight to step 4.
+                if self._listening_to is not None:
+                    handle = xcomposite_name_window_pixmap(self._window)
+                    self.pixmaps_named += 1
+                    if handle is None:
+                        log("failed to name a window pixmap (expect an X"
+                            " error soon)", type="pixmap")
+                    self._contents_handle = handle
+                    return
                 listening = []
                 try:
                     win = get_parent(self._window)
@@ -117,6 +146,7 @@ class CompositeHelper(AutoPropGObjectMixin, gobject.GObject):
                         listening.append(win)
                         win = get_parent(win)
                     handle = xcomposite_name_window_pixmap(self._window)
+                    self.pixmaps_named += 1
                 except:
                     try:
                         self._cleanup_listening(listening)
@@ -144,14 +174,23 @@ class CompositeHelper(AutoPropGObjectMixin, gobject.GObject):
             return handle.pixmap
 
     def do_wimpiggy_unmap_event(self, *args):
+        # Our window, or one of its ancestors, stopped being viewable:
         self.invalidate_pixmap()
 
     def do_wimpiggy_configure_event(self, event):
-        self._border_width = event.border_width
-        self.invalidate_pixmap()
+        # We also hear about our ancestors being configured, but those don't
+        # affect our pixmap; and nor does our window merely moving:
+        if event.window is not self._window:
+            return
+        size = (event.width, event.height)
+        if size != self._size or event.border_width != self._border_width:
+            self._size = size
+            self._border_width = event.border_width
+            self.invalidate_pixmap()
 
     def do_wimpiggy_reparent_event(self, *args):
-        self.invalidate_pixmap()
+        # Our ancestry changed, so we must find out what it is again:
+        self._stop_listening()
 
     def do_wimpiggy_damage_event(self, event):
         event.x += self._border_width
@@ -761,7 +761,8 @@ def xtest_fake_button(display_source, button, is_press):
 # probably also Xfixes, Xrandr, etc.).  (But note that we don't actually have
 # to query for Xfixes support because 1) any server that can handle us at all
 # already has a sufficiently advanced version of Xfixes, and 2) GTK+ already
-# enables Xfixes for us automatically.)
+# enables Xfixes for us automatically.  We only do so to find out its event
+# base, for cursor notifications.)
 
 cdef _ensure_extension_support(display_source, major, minor, extension,
                                Bool (*query_extension)(Display*, int*, int*),
@@ -877,11 +878,14 @@ cdef extern from "X11/extensions/Xfixes.h":
     ctypedef XID XserverRegion
     XserverRegion XFixesCreateRegion(Display *, XRectangle *, int nrectangles)
     void XFixesDestroyRegion(Display *, XserverRegion)
+    XRectangle * XFixesFetchRegion(Display *, XserverRegion,
+                                   int * nrectangles)
 
 cdef extern from "X11/extensions/Xdamage.h":
     ctypedef XID Damage
     unsigned int XDamageReportDeltaRectangles
     #unsigned int XDamageReportRawRectangles
+    unsigned int XDamageReportNonEmpty
     unsigned int XDamageNotify
     ctypedef struct XDamageNotifyEvent:
         Damage damage
@@ -901,36 +905,275 @@ def _ensure_XDamage_support(display_source):
                               XDamageQueryVersion)
 
 def xdamage_start(window):
+    # In NonEmpty mode, the X server sends a single DamageNotify when the
+    # window goes from undamaged to damaged, and then nothing more until we
+    # subtract the damage again -- no matter how many times it gets drawn to
+    # in the meantime.  The damage itself accumulates in the server, and we
+    # pick it up with xdamage_fetch when we are ready to do something about
+    # it.  (The event's area is the whole window, and can be ignored.)
     _ensure_XDamage_support(window)
     return XDamageCreate(get_xdisplay_for(window), get_xwindow(window),
-                         XDamageReportDeltaRectangles)
+                         XDamageReportNonEmpty)
 
 def xdamage_stop(display_source, handle):
     _ensure_XDamage_support(display_source)
     XDamageDestroy(get_xdisplay_for(display_source), handle)
 
-def xdamage_acknowledge(display_source, handle, x, y, width, height):
-    # cdef XRectangle rect
-    # rect.x = x
-    # rect.y = y
-    # rect.width = width
-    # rect.height = height
-    # repair = XFixesCreateRegion(get_xdisplay_for(display_source), &rect, 1)
-    # XDamageSubtract(get_xdisplay_for(display_source), handle, repair, XNone)
-    # XFixesDestroyRegion(get_xdisplay_for(display_source), repair)
-
-    # DeltaRectangles mode + XDamageSubtract is broken, because repair
-    # operations trigger a flood of re-reported events (see freedesktop.org bug
-    # #14648 for details).  So instead we always repair all damage.  This
-    # means we may get redundant damage notifications if areas outside of the
-    # rectangle we actually repaired get re-damaged, but it avoids the
-    # quadratic blow-up that fixing just the correct area causes, and still
-    # reduces the number of events we receive as compared to just using
-    # RawRectangles mode.  This is very important for things like, say,
-    # drawing a scatterplot in R, which may make hundreds of thousands of
-    # draws to the same location, and with RawRectangles mode xpra can lag by
-    # seconds just trying to keep track of the damage.
-    XDamageSubtract(get_xdisplay_for(display_source), handle, XNone, XNone)
+def xdamage_fetch(display_source, handle):
+    """Returns the damage accumulated in 'handle' as a list of (x, y, width,
+    height) rectangles, and clears it, so that the next change produces a new
+    DamageNotify."""
+    cdef Display * display
+    cdef XserverRegion parts
+    cdef XRectangle * rectangles
+    cdef int count, i
+    display = get_xdisplay_for(display_source)
+    parts = XFixesCreateRegion(display, NULL, 0)
+    try:
+        # Subtracting everything (repair == None) and collecting what was
+        # there into 'parts' is a single atomic operation in the server, so
+        # no damage can slip through between the two:
+        XDamageSubtract(display, handle, XNone, parts)
+        rectangles = XFixesFetchRegion(display, parts, &count)
+        result = []
+        if rectangles != NULL:
+            for i from 0 <= i < count:
+                result.append((rectangles[i].x, rectangles[i].y,
+                               rectangles[i].width, rectangles[i].height))
+            XFree(rectangles)
+        return result
+    finally:
+        XFixesDestroyRegion(display, parts)
+
+###################################
+# Cursors
+###################################
+
+cdef extern from "X11/extensions/Xfixes.h":
+    Bool XFixesQueryExtension(Display *, int * event_base, int *)
+    Status XFixesQueryVersion(Display *, int * major, int * minor)
+    unsigned int XFixesCursorNotify
+    unsigned long XFixesDisplayCursorNotifyMask
+    ctypedef struct XFixesCursorNotifyEvent:
+        Window window
+        int subtype
+        unsigned long cursor_serial
+        Time timestamp
+        Atom cursor_name
+    ctypedef struct XFixesCursorImage:
+        short x, y
+        unsigned short width, height
+        unsigned short xhot, yhot
+        unsigned long cursor_serial
+        unsigned long * pixels
+    void XFixesSelectCursorInput(Display *, Window, unsigned long mask)
+    XFixesCursorImage * XFixesGetCursorImage(Display *)
+
+def _ensure_XFixes_support(display_source):
+    _ensure_extension_support(display_source, 2, 0, "XFIXES",
+                              XFixesQueryExtension,
+                              XFixesQueryVersion)
+
+def xfixes_select_cursor_input(window):
+    """Asks for a wimpiggy-cursor-event on 'window' (which should be the
+    root window) whenever the displayed cursor changes."""
+    _ensure_XFixes_support(window)
+    XFixesSelectCursorInput(get_xdisplay_for(window), get_xwindow(window),
+                            XFixesDisplayCursorNotifyMask)
+
+def get_cursor_image(display_source):
+    """Returns the cursor currently being displayed, as a tuple (serial,
+    xhot, yhot, width, height, pixels), where pixels is a string of
+    non-premultiplied RGBA bytes (which is what gdk-pixbuf wants).  Returns
+    None if there is no cursor."""
+    cdef XFixesCursorImage * image
+    cdef unsigned char * cbuf
+    cdef Py_ssize_t cbuf_len
+    cdef unsigned int argb, a, r, g, b
+    cdef int i
+    _ensure_XFixes_support(display_source)
+    image = XFixesGetCursorImage(get_xdisplay_for(display_source))
+    if image == NULL:
+        return None
+    try:
+        buf = bytearray(image.width * image.height * 4)
+        PyObject_AsWriteBuffer(buf, <void **>&cbuf, &cbuf_len)
+        # The pixels are premultiplied ARGB32, one per unsigned long (so on
+        # 64-bit machines the top half of each is padding):
+        for 0 <= i < cbuf_len / 4:
+            argb = image.pixels[i] & 0xffffffff
+            a = (argb >> 24) & 0xff
+            r = (argb >> 16) & 0xff
+            g = (argb >> 8) & 0xff
+            b = (argb >> 0) & 0xff
+            if a != 0 and a != 0xff:
+                # (capped in case of bogus, not really premultiplied, pixels)
+                r = r * 255 / a
+                g = g * 255 / a
+                b = b * 255 / a
+                if r > 255:
+                    r = 255
+                if g > 255:
+                    g = 255
+                if b > 255:
+                    b = 255
+            cbuf[i * 4 + 0] = r
+            cbuf[i * 4 + 1] = g
+            cbuf[i * 4 + 2] = b
+            cbuf[i * 4 + 3] = a
+        return (image.cursor_serial, image.xhot, image.yhot,
+                image.width, image.height, str(buf))
+    finally:
+        XFree(image)
+
+###################################
+# XSync
+###################################
+
+cdef extern from "X11/extensions/sync.h":
+    ctypedef XID XSyncCounter
+    ctypedef XID XSyncAlarm
+    ctypedef struct XSyncValue:
+        int hi
+        unsigned int lo
+    ctypedef struct XSyncTrigger:
+        XSyncCounter counter
+        int value_type
+        XSyncValue wait_value
+        int test_type
+    ctypedef struct XSyncAlarmAttributes:
+        XSyncTrigger trigger
+        XSyncValue delta
+        Bool events
+        int state
+    ctypedef struct XSyncAlarmNotifyEvent:
+        XSyncAlarm alarm
+        XSyncValue counter_value
+        XSyncValue alarm_value
+    int XSyncAlarmNotify
+    int XSyncAbsolute
+    int XSyncPositiveComparison
+    unsigned long XSyncCACounter
+    unsigned long XSyncCAValueType
+    unsigned long XSyncCAValue
+    unsigned long XSyncCATestType
+    unsigned long XSyncCADelta
+    unsigned long XSyncCAEvents
+    Bool XSyncQueryExtension(Display *, int * event_base, int *)
+    Status XSyncInitialize(Display *, int * major, int * minor)
+    void XSyncIntsToValue(XSyncValue *, unsigned int lo, int hi)
+    XSyncAlarm XSyncCreateAlarm(Display *, unsigned long values_mask,
+                                XSyncAlarmAttributes *)
+    Status XSyncDestroyAlarm(Display *, XSyncAlarm)
+
+def _ensure_XSync_support(display_source):
+    _ensure_extension_support(display_source, 3, 0, "SYNC",
+                              XSyncQueryExtension,
+                              XSyncInitialize)
+
+# Alarms aren't windows, so their events can't be routed like everything
+# else's; instead we remember who asked for each one:
+_sync_alarm_receivers = {}
+
+def xsync_await(window, receiver, counter, value):
+    """Arranges for a wimpiggy-sync-alarm-event to be emitted on 'receiver'
+    once the XSync 'counter' reaches (at least) 'value', which is a 64-bit
+    unsigned integer.  Returns the alarm, which must be passed to
+    xsync_destroy_alarm once it has gone off (or is no longer wanted)."""
+    cdef XSyncAlarmAttributes attrs
+    cdef XSyncAlarm alarm
+    _ensure_XSync_support(window)
+    attrs.trigger.counter = counter
+    attrs.trigger.value_type = XSyncAbsolute
+    XSyncIntsToValue(&attrs.trigger.wait_value,
+                     value & 0xffffffff, (value >> 32) & 0x7fffffff)
+    attrs.trigger.test_type = XSyncPositiveComparison
+    # A zero delta makes the alarm go inactive after going off once:
+    XSyncIntsToValue(&attrs.delta, 0, 0)
+    attrs.events = 1
+    alarm = XSyncCreateAlarm(get_xdisplay_for(window),
+                             XSyncCACounter | XSyncCAValueType
+                             | XSyncCAValue | XSyncCATestType
+                             | XSyncCADelta | XSyncCAEvents,
+                             &attrs)
+    _sync_alarm_receivers[alarm] = receiver
+    return alarm
+
+def xsync_destroy_alarm(display_source, alarm):
+    if alarm in _sync_alarm_receivers:
+        del _sync_alarm_receivers[alarm]
+    XSyncDestroyAlarm(get_xdisplay_for(display_source), alarm)
+
+###################################
+# RandR
+###################################
+
+cdef extern from "X11/extensions/Xrandr.h":
+    ctypedef unsigned short SizeID
+    ctypedef unsigned short Rotation
+    ctypedef struct XRRScreenSize:
+        int width, height
+        int mwidth, mheight
+    ctypedef struct XRRScreenConfiguration:
+        pass
+    Bool XRRQueryExtension(Display *, int * event_base, int *)
+    Status XRRQueryVersion(Display *, int * major, int * minor)
+    XRRScreenConfiguration * XRRGetScreenInfo(Display *, Window)
+    void XRRFreeScreenConfigInfo(XRRScreenConfiguration *)
+    XRRScreenSize * XRRConfigSizes(XRRScreenConfiguration *, int * nsizes)
+    SizeID XRRConfigCurrentConfiguration(XRRScreenConfiguration *,
+                                         Rotation * rotation)
+    Status XRRSetScreenConfig(Display *, XRRScreenConfiguration *,
+                              Drawable, int size_index, Rotation, Time)
+
+def _ensure_XRandR_support(display_source):
+    _ensure_extension_support(display_source, 1, 1, "RANDR",
+                              XRRQueryExtension,
+                              XRRQueryVersion)
+
+def xrandr_get_screen_sizes(root):
+    """Returns the sizes the X server can switch the screen of 'root' (a
+    root window) to, as a list of (width, height)."""
+    cdef XRRScreenConfiguration * config
+    cdef XRRScreenSize * sizes
+    cdef int nsizes, i
+    _ensure_XRandR_support(root)
+    config = XRRGetScreenInfo(get_xdisplay_for(root), get_xwindow(root))
+    if config == NULL:
+        return []
+    try:
+        sizes = XRRConfigSizes(config, &nsizes)
+        result = []
+        for i from 0 <= i < nsizes:
+            result.append((sizes[i].width, sizes[i].height))
+        return result
+    finally:
+        XRRFreeScreenConfigInfo(config)
+
+def xrandr_set_screen_size(root, width, height):
+    """Switches the screen of 'root' to (width, height), which must be one
+    of the sizes returned by xrandr_get_screen_sizes.  Returns whether it
+    worked."""
+    cdef XRRScreenConfiguration * config
+    cdef XRRScreenSize * sizes
+    cdef int nsizes, i
+    cdef Rotation rotation
+    _ensure_XRandR_support(root)
+    config = XRRGetScreenInfo(get_xdisplay_for(root), get_xwindow(root))
+    if config == NULL:
+        return False
+    try:
+        sizes = XRRConfigSizes(config, &nsizes)
+        XRRConfigCurrentConfiguration(config, &rotation)
+        for i from 0 <= i < nsizes:
+            if sizes[i].width == width and sizes[i].height == height:
+                # (0 is RRSetConfigSuccess)
+                return XRRSetScreenConfig(get_xdisplay_for(root), config,
+                                          get_xwindow(root), i, rotation,
+                                          CurrentTime) == 0
+        return False
+    finally:
+        XRRFreeScreenConfigInfo(config)
 
 ###################################
 # Smarter convenience wrappers
@@ -1205,6 +1448,7 @@ _x_event_signals = {
     PropertyNotify: ("wimpiggy-property-notify-event", None),
     KeyPress: ("wimpiggy-key-press-event", None),
     "XDamageNotify": ("wimpiggy-damage-event", None),
+    "XFixesCursorNotify": ("wimpiggy-cursor-event", None),
     }
 
 def _gw(display, xwin):
@@ -1215,6 +1459,8 @@ cdef GdkFilterReturn x_event_filter(GdkXEvent * e_gdk,
                                     void * userdata) with gil:
     cdef XEvent * e
     cdef XDamageNotifyEvent * damage_e
+    cdef XFixesCursorNotifyEvent * cursor_e
+    cdef XSyncAlarmNotifyEvent * alarm_e
     e = <XEvent*>e_gdk
     if e.xany.send_event and e.type not in (ClientMessage, UnmapNotify):
         return GDK_FILTER_CONTINUE
@@ -1226,6 +1472,26 @@ cdef GdkFilterReturn x_event_filter(GdkXEvent * e_gdk,
             my_events[damage_type] = my_events["XDamageNotify"]
         else:
             damage_type = -1
+        if d.get_data("XFIXES-event-base") is not None:
+            cursor_type = d.get_data("XFIXES-event-base") + XFixesCursorNotify
+            my_events[cursor_type] = my_events["XFixesCursorNotify"]
+        else:
+            cursor_type = -1
+        if (d.get_data("SYNC-event-base") is not None
+            and e.type == d.get_data("SYNC-event-base") + XSyncAlarmNotify):
+            alarm_e = <XSyncAlarmNotifyEvent*>e
+            log("AlarmNotify received")
+            receiver = _sync_alarm_receivers.get(alarm_e.alarm)
+            if receiver is not None:
+                pyev = AdHocStruct()
+                pyev.type = e.type
+                pyev.display = d
+                pyev.alarm = alarm_e.alarm
+                pyev.counter_value = ((<long long>alarm_e.counter_value.hi
+                                       << 32)
+                                      | alarm_e.counter_value.lo)
+                receiver.emit("wimpiggy-sync-alarm-event", pyev)
+            return GDK_FILTER_CONTINUE
         if e.type in my_events:
             pyev = AdHocStruct()
             pyev.type = e.type
@@ -1326,6 +1592,11 @@ cdef GdkFilterReturn x_event_filter(GdkXEvent * e_gdk,
                     pyev.y = damage_e.area.y
                     pyev.width = damage_e.area.width
                     pyev.height = damage_e.area.height
+                elif e.type == cursor_type:
+                    log("CursorNotify received")
+                    cursor_e = <XFixesCursorNotifyEvent*>e
+                    pyev.window = _gw(d, e.xany.window)
+                    pyev.cursor_serial = cursor_e.cursor_serial
             except XError, e:
                 log("Some window in our event disappeared before we could "
                     + "handle the event; so I'm just ignoring it instead.")
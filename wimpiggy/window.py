@@ -35,7 +35,6 @@ log = Logger()
 
 # Todo:
 #   client focus hints
-#   _NET_WM_SYNC_REQUEST
 #   root window requests (pagers, etc. requesting to change client states)
 #   _NET_WM_PING/detect window not responding (also a root window message)
 
@@ -114,11 +113,15 @@ log = Logger()
 # view/"controller" for a WindowModel.
 #
 # Viewing a (Base)WindowModel is easy.  Connect to the client-contents-changed
-# signal.  Every time the window contents is updated, you'll get a message.
+# signal.  When the window contents get updated, you'll get a message.
 # This message is passed a single object e, which has useful members:
 #   e.x, e.y, e.width, e.height:
-#      The part of the client window that was modified, and needs to be
-#      redrawn.
+#      The part of the client window that may have been modified, and needs
+#      to be redrawn (currently, the whole window).
+# You won't get another message until you call fetch_damage() on the model,
+# which returns a list of (x, y, w, h) rectangles saying exactly what has
+# changed since the last call.  Call it *before* reading the window contents,
+# so that nothing that changes while you do so gets lost.
 # To get the actual contents of the window to draw, there is a "handle"
 # available as the "client-contents-handle" property on the
 # (Base)WindowModel.  So long as you hold a reference to this object, the
@@ -246,8 +249,8 @@ class BaseWindowModel(AutoPropGObjectMixin, gobject.GObject):
     def do_get_property_client_contents_handle(self, name):
         return self._composite.get_property("contents-handle")
 
-    def acknowledge_changes(self, x, y, w, h):
-        self._composite.acknowledge_changes(x, y, w, h)
+    def fetch_damage(self):
+        return self._composite.fetch_damage()
 
     def do_wimpiggy_configure_event(self, event):
         self._geometry = (event.x, event.y, event.width, event.height,
@@ -391,6 +394,14 @@ class WindowModel(BaseWindowModel):
         "owner": (gobject.TYPE_PYOBJECT,
                   "Owner", "",
                   gobject.PARAM_READABLE),
+        # True from when we resize a window that supports
+        # _NET_WM_SYNC_REQUEST, until it says it has finished repainting at
+        # the new size (or we give up waiting); its contents are best left
+        # alone in the meantime:
+        "sync-pending": (gobject.TYPE_BOOLEAN,
+                         "Waiting for the client to repaint after a resize",
+                         "", False,
+                         gobject.PARAM_READABLE),
         }
     __gsignals__ = {
         "ownership-election": (gobject.SIGNAL_RUN_LAST,
@@ -402,7 +413,12 @@ class WindowModel(BaseWindowModel):
         "wimpiggy-property-notify-event": one_arg_signal,
         "wimpiggy-unmap-event": one_arg_signal,
         "wimpiggy-destroy-event": one_arg_signal,
+        "wimpiggy-sync-alarm-event": one_arg_signal,
         }
+
+    # How long to wait for a client to acknowledge a _NET_WM_SYNC_REQUEST, in
+    # milliseconds, before deciding that it isn't going to:
+    SYNC_TIMEOUT = 1000
         
     def __init__(self, parking_window, client_window):
         """Register a new client window with the WM.
@@ -431,6 +447,12 @@ class WindowModel(BaseWindowModel):
         # The WM_HINTS input field
         self._input_field = True
 
+        # _NET_WM_SYNC_REQUEST state; see _update_client_geometry:
+        self._sync_counter = None
+        self._sync_value = 0
+        self._sync_alarm = None
+        self._sync_timer = None
+
         def setup_client():
             # Start listening for important events.
             self.client_window.set_events(self.client_window.get_events()
@@ -528,6 +550,7 @@ class WindowModel(BaseWindowModel):
                 # #526635:
                 wimpiggy.lowlevel.show_unraised_without_extra_stupid_stuff(self.client_window)
         trap.swallow(unmanageit)
+        self._end_sync()
         self.corral_window.destroy()
         BaseWindowModel.do_unmanaged(self, exiting)
 
@@ -566,12 +589,64 @@ class WindowModel(BaseWindowModel):
                                                            hints)
             (w, h, wvis, hvis) = size
             (x, y) = owner.window_position(self, w, h)
+            if (w, h) != self.get_property("actual-size"):
+                self._request_sync()
             self.corral_window.move_resize(x, y, w, h)
             trap.swallow(wimpiggy.lowlevel.configureAndNotify,
                          self.client_window, 0, 0, w, h)
             self._internal_set_property("actual-size", (w, h))
             self._internal_set_property("user-friendly-size", (wvis, hvis))
 
+    def _request_sync(self):
+        # If the client supports it, ask it to bump its sync counter once it
+        # has dealt with the coming ConfigureNotify and repainted, so that
+        # nobody looks at its half-drawn contents in the meantime.
+        if (self._sync_counter is None
+            or "_NET_WM_SYNC_REQUEST" not in self.get_property("protocols")):
+            return
+        self._end_sync()
+        self._sync_value += 1
+        value = self._sync_value
+        def request():
+            now = gtk.gdk.x11_get_server_time(self.corral_window)
+            wimpiggy.lowlevel.sendClientMessage(self.client_window, False, 0,
+                                                "WM_PROTOCOLS",
+                                                "_NET_WM_SYNC_REQUEST", now,
+                                                value & 0xffffffff,
+                                                value >> 32, 0)
+            return wimpiggy.lowlevel.xsync_await(self.client_window, self,
+                                                 self._sync_counter, value)
+        try:
+            self._sync_alarm = trap.call(request)
+        except (XError, ValueError), e:
+            log("not waiting for sync counter: %s", e)
+            return
+        self._sync_timer = gobject.timeout_add(self.SYNC_TIMEOUT,
+                                               self._sync_timed_out)
+        self._internal_set_property("sync-pending", True)
+
+    def do_wimpiggy_sync_alarm_event(self, event):
+        if event.alarm == self._sync_alarm:
+            log("client repainted after resize")
+            self._end_sync()
+
+    def _sync_timed_out(self):
+        log.warn("client did not respond to _NET_WM_SYNC_REQUEST")
+        self._sync_timer = None
+        self._end_sync()
+        return False
+
+    def _end_sync(self):
+        if self._sync_alarm is not None:
+            trap.swallow(wimpiggy.lowlevel.xsync_destroy_alarm,
+                         self.client_window, self._sync_alarm)
+            self._sync_alarm = None
+        if self._sync_timer is not None:
+            gobject.source_remove(self._sync_timer)
+            self._sync_timer = None
+        if self.get_property("sync-pending"):
+            self._internal_set_property("sync-pending", False)
+
     def do_child_configure_request_event(self, event):
         # Ignore the request, but as per ICCCM 4.1.5, send back a synthetic
         # ConfigureNotify telling the client that nothing has happened.
@@ -708,6 +783,11 @@ class WindowModel(BaseWindowModel):
         log("icon is now %r", self.get_property("icon"))
     _property_handlers["_NET_WM_ICON"] = _handle_net_wm_icon
 
+    def _handle_sync_request_counter(self):
+        self._sync_counter = prop_get(self.client_window,
+                                      "_NET_WM_SYNC_REQUEST_COUNTER", "u32")
+    _property_handlers["_NET_WM_SYNC_REQUEST_COUNTER"] = _handle_sync_request_counter
+
     def _read_initial_properties(self):
         # Things that don't change:
         geometry = self.client_window.get_geometry()
@@ -789,7 +869,7 @@ class WindowModel(BaseWindowModel):
                         "WM_NAME", "_NET_WM_NAME",
                         "WM_ICON_NAME", "_NET_WM_ICON_NAME",
                         "_NET_WM_STRUT", "_NET_WM_STRUT_PARTIAL",
-                        "_NET_WM_ICON"]:
+                        "_NET_WM_ICON", "_NET_WM_SYNC_REQUEST_COUNTER"]:
             self._handle_property_change(mutable)
 
     ################################
@@ -1104,9 +1184,9 @@ class WindowView(gtk.Widget):
         cr.set_matrix(self._get_transform_matrix())
 
         # It's important to acknowledge changes *before* we redraw them, to
-        # avoid a race condition.
-        self.model.acknowledge_changes(event.area.x, event.area.y,
-                                       event.area.width, event.area.height)
+        # avoid a race condition.  (We repaint the whole area we were told
+        # about anyway, so we don't need the exact rectangles.)
+        self.model.fetch_damage()
 
         cr.set_source_pixmap(self.model.get_property("client-contents"),
                              0, 0)
@@ -52,6 +52,9 @@ class Wm(gobject.GObject):
         "_NET_WM_ALLOWED_ACTIONS",
         "_NET_WM_ACTION_CLOSE",
 
+        "_NET_WM_SYNC_REQUEST",
+        "_NET_WM_SYNC_REQUEST_COUNTER",
+
         # We don't actually use _NET_WM_USER_TIME at all (yet), but it is
         # important to say we support the _NET_WM_USER_TIME_WINDOW property,
         # because this tells applications that they do not need to constantly
@@ -0,0 +1,103 @@
+# This file is part of Parti.
+# Copyright (C) 2010 Nathaniel Smith <njs@pobox.com>
+# Parti is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+# Compiled versions of the pixel loops in xpra.kernels, which is what you
+# want to be calling (it falls back on NumPy or plain Python when this module
+# has not been built).
+
+cdef extern from "string.h":
+    int memcmp(void * a, void * b, size_t n)
+    void * memcpy(void * dst, void * src, size_t n)
+
+cdef extern from "Python.h":
+    ctypedef int Py_ssize_t
+    object PyString_FromStringAndSize(char * s, Py_ssize_t len)
+    char * PyString_AsString(object string) except NULL
+    int PyObject_AsReadBuffer(object obj,
+                              void ** buffer,
+                              Py_ssize_t * buffer_len) except -1
+
+cdef unsigned char * _read_buffer(data, Py_ssize_t needed) except NULL:
+    cdef unsigned char * cbuf
+    cdef Py_ssize_t cbuf_len
+    PyObject_AsReadBuffer(data, <void **>&cbuf, &cbuf_len)
+    if cbuf_len < needed:
+        raise ValueError("buffer too small")
+    return cbuf
+
+def region_data(data, int rowstride, int offset, int rowwidth, int height):
+    cdef unsigned char * src = _read_buffer(data, offset
+                                            + rowstride * (height - 1)
+                                            + rowwidth)
+    out = PyString_FromStringAndSize(NULL, rowwidth * height)
+    cdef unsigned char * dst = <unsigned char *>PyString_AsString(out)
+    cdef int y
+    for 0 <= y < height:
+        memcpy(dst + y * rowwidth, src + offset + y * rowstride, rowwidth)
+    return out
+
+def rgb24_to_rgb565(data):
+    cdef unsigned char * src
+    cdef Py_ssize_t src_len
+    PyObject_AsReadBuffer(data, <void **>&src, &src_len)
+    cdef Py_ssize_t pixels = src_len / 3
+    out = PyString_FromStringAndSize(NULL, pixels * 2)
+    cdef unsigned char * dst = <unsigned char *>PyString_AsString(out)
+    cdef unsigned int value
+    cdef Py_ssize_t i
+    for 0 <= i < pixels:
+        value = (((src[i * 3] >> 3) << 11) | ((src[i * 3 + 1] >> 2) << 5)
+                 | (src[i * 3 + 2] >> 3))
+        dst[i * 2] = value & 0xff
+        dst[i * 2 + 1] = value >> 8
+    return out
+
+def unpremultiply_argb(data):
+    cdef unsigned int * src
+    cdef Py_ssize_t src_len
+    cdef unsigned int argb, a, r, g, b
+    assert sizeof(int) == 4
+    PyObject_AsReadBuffer(data, <void **>&src, &src_len)
+    cdef Py_ssize_t pixels = src_len / 4
+    out = PyString_FromStringAndSize(NULL, pixels * 4)
+    cdef unsigned char * dst = <unsigned char *>PyString_AsString(out)
+    cdef Py_ssize_t i
+    for 0 <= i < pixels:
+        argb = src[i]
+        a = (argb >> 24) & 0xff
+        r = (argb >> 16) & 0xff
+        g = (argb >> 8) & 0xff
+        b = argb & 0xff
+        if a != 0 and a != 0xff:
+            # (capped in case of bogus, not really premultiplied, pixels)
+            r = r * 255 / a
+            g = g * 255 / a
+            b = b * 255 / a
+            if r > 255:
+                r = 255
+            if g > 255:
+                g = 255
+            if b > 255:
+                b = 255
+        dst[i * 4 + 0] = r
+        dst[i * 4 + 1] = g
+        dst[i * 4 + 2] = b
+        dst[i * 4 + 3] = a
+    return out
+
+def solid_pixel(data, int rowstride, int offset, int rowwidth, int height,
+                int bpp):
+    cdef unsigned char * src = _read_buffer(data, offset
+                                            + rowstride * (height - 1)
+                                            + rowwidth)
+    cdef unsigned char * first = src + offset
+    cdef unsigned char * row
+    cdef int x, y
+    for 0 <= y < height:
+        row = first + y * rowstride
+        for 0 <= x < rowwidth / bpp:
+            if memcmp(row + x * bpp, first, bpp) != 0:
+                return None
+    return PyString_FromStringAndSize(<char *>first, bpp)
@@ -0,0 +1,154 @@
+# This file is part of Parti.
+# Copyright (C) 2010 Nathaniel Smith <njs@pobox.com>
+# Parti is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+# Times the pixel kernels (see xpra.kernels) with each implementation that is
+# available here, against the way the same work was done before there were
+# kernels.  Run it with:
+#
+#   python -m xpra.bench_kernels
+
+import sys
+import time
+import random
+import struct
+
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
+
+import xpra.kernels
+from xpra.tiles import CapturedPixels, TILE_SIZE
+
+WIDTH = 1024
+HEIGHT = 768
+# As gdk-pixbuf would pad the rows of a capture of that size:
+ROWSTRIDE = WIDTH * 3 + 4
+
+def _timed(fn, minimum=0.5):
+    """Returns how long fn() takes, in milliseconds per call."""
+    calls = 0
+    start = time.time()
+    while True:
+        fn()
+        calls += 1
+        elapsed = time.time() - start
+        if elapsed >= minimum:
+            return elapsed * 1000.0 / calls
+
+def _implementations():
+    saved = (xpra.kernels._kernels, xpra.kernels.numpy)
+    choices = [("python", None, None)]
+    if saved[1] is not None:
+        choices.append(("numpy", None, saved[1]))
+    if saved[0] is not None:
+        choices.append(("compiled", saved[0], None))
+    return (saved, choices)
+
+def _bench(name, fn, baseline=None):
+    results = []
+    if baseline is not None:
+        results.append(("before", _timed(baseline)))
+    (saved, choices) = _implementations()
+    try:
+        for (label, xpra.kernels._kernels, xpra.kernels.numpy) in choices:
+            results.append((label, _timed(fn)))
+    finally:
+        (xpra.kernels._kernels, xpra.kernels.numpy) = saved
+    print "%-26s %s" % (name, "  ".join(["%s %.3fms" % r for r in results]))
+
+# What xpra.depth and xpra.icons did before they used the kernels:
+def _old_rgb24_to_rgb565(data):
+    if xpra.kernels.numpy is not None:
+        numpy = xpra.kernels.numpy
+        p = numpy.frombuffer(data, dtype=numpy.uint8).reshape((-1, 3))
+        p = p.astype(numpy.uint32)
+        values = (((p[:, 0] >> 3) << 11) | ((p[:, 1] >> 2) << 5)
+                  | (p[:, 2] >> 3))
+        return values.astype("<u2").tostring()
+    packed = {}
+    out = []
+    for i in xrange(0, len(data), 3):
+        pixel = data[i:i + 3]
+        value = packed.get(pixel)
+        if value is None:
+            (r, g, b) = struct.unpack("BBB", pixel)
+            value = struct.pack("<H", ((r >> 3) << 11) | ((g >> 2) << 5)
+                                | (b >> 3))
+            packed[pixel] = value
+        out.append(value)
+    return "".join(out)
+
+def _old_unpremultiply_argb(data):
+    # (the kernels' NumPy and Python versions are the old ones, moved)
+    if xpra.kernels.numpy is not None:
+        return xpra.kernels._unpremultiply_argb_np(data)
+    return xpra.kernels._unpremultiply_argb_py(data)
+
+def _old_row_digests(pixels):
+    rowwidth = pixels.width * pixels.bpp
+    return [md5(pixels.data[i * pixels.rowstride:
+                            i * pixels.rowstride + rowwidth]).digest()
+            for i in xrange(pixels.height)]
+
+def _old_tile_data(pixels, tx, ty, tw, th):
+    # (how CapturedPixels.tile_data cut tiles out before region_data)
+    bpp = pixels.bpp
+    numpy = xpra.kernels.numpy
+    if numpy is not None:
+        rows = numpy.frombuffer(pixels.data, dtype=numpy.uint8)
+        rows = rows.reshape((pixels.height, pixels.rowstride))
+        return rows[ty:ty + th, tx * bpp:(tx + tw) * bpp].tostring()
+    return "".join([pixels.data[start:start + tw * bpp]
+                    for start in xrange(ty * pixels.rowstride + tx * bpp,
+                                        (ty + th) * pixels.rowstride,
+                                        pixels.rowstride)])
+
+def main():
+    random.seed(0)
+    # Mostly flat, with some noise, like an ordinary desktop:
+    rows = []
+    for y in xrange(HEIGHT):
+        if y % 16 == 0:
+            row = "".join([chr(random.randrange(256))
+                           for _ in xrange(WIDTH * 3)])
+        else:
+            row = "\xee" * (WIDTH * 3)
+        rows.append(row + "\0" * (ROWSTRIDE - WIDTH * 3))
+    data = "".join(rows)
+    pixels = CapturedPixels(0, 0, WIDTH, HEIGHT, data, ROWSTRIDE)
+    argb = data[:TILE_SIZE * TILE_SIZE * 4]
+    rgb = pixels.tile_data(0, 0, WIDTH, 64)
+    size = TILE_SIZE
+
+    print "%sx%s capture, %s" % (WIDTH, HEIGHT, sys.version.split()[0])
+    print "(\"before\" is how this was done without the kernels)"
+    def all_tiles(fn):
+        for ty in xrange(0, HEIGHT, size):
+            for tx in xrange(0, WIDTH, size):
+                fn(tx, ty, size, size)
+    _bench("row digests",
+           pixels.row_digests,
+           lambda: _old_row_digests(pixels))
+    def old_solid(*tile):
+        tile_data = _old_tile_data(pixels, *tile)
+        return tile_data == tile_data[:3] * (len(tile_data) // 3)
+    _bench("solid tiles",
+           lambda: all_tiles(pixels.solid_pixel),
+           lambda: all_tiles(old_solid))
+    def old_digest(*tile):
+        return md5(_old_tile_data(pixels, *tile)).digest()
+    _bench("tile digests",
+           lambda: all_tiles(pixels.tile_digest),
+           lambda: all_tiles(old_digest))
+    _bench("rgb24 to rgb565 (64 rows)",
+           lambda: xpra.kernels.rgb24_to_rgb565(rgb),
+           lambda: _old_rgb24_to_rgb565(rgb))
+    _bench("unpremultiply (64x64)",
+           lambda: xpra.kernels.unpremultiply_argb(argb),
+           lambda: _old_unpremultiply_argb(argb))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+# This file is part of Parti.
+# Copyright (C) 2010 Nathaniel Smith <njs@pobox.com>
+# Parti is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+# Sorting tiles by what is in them, so that each kind goes out the cheapest
+# way.  A tile of a single colour (a bit of background, say) needs nothing
+# but the colour; a tile with only a few colours in it (text, toolbars,
+# borders) compresses very well losslessly, and is blurred by lossy
+# encodings; anything else (photos, gradients, video) is what the window's
+# usual encoding is for.
+
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+SOLID = "solid"
+LOW_COLOUR = "low-colour"
+CONTINUOUS = "continuous"
+CLASSES = (SOLID, LOW_COLOUR, CONTINUOUS)
+
+# A tile with more colours than this is continuous-tone:
+LOW_COLOUR_LIMIT = 256
+# Only every SAMPLE_ROWS-th row of a tile is counted.  Sampling can only
+# make a tile look like it has fewer colours than it does, so text is never
+# mistaken for a photo; the worst it can do is have a continuous-tone tile
+# sent losslessly:
+SAMPLE_ROWS = 4
+
+def _count_colours_np(data, limit):
+    pixels = numpy.frombuffer(data, dtype=numpy.uint8).reshape((-1, 3))
+    values = ((pixels[:, 0].astype(numpy.uint32) << 16)
+              | (pixels[:, 1].astype(numpy.uint32) << 8)
+              | pixels[:, 2])
+    return len(numpy.unique(values))
+
+def _count_colours_py(data, limit):
+    # Spread each pixel out to 4 bytes, so that they can be read back as
+    # integers; this keeps the per-pixel work in C:
+    values = bytearray(len(data) // 3 * 4)
+    for i in xrange(3):
+        values[i::4] = data[i::3]
+    values = array("I", str(values))
+    # ...and stop as soon as there are too many to matter, which for a
+    # photo is well before the end:
+    step = max(limit + 1, 64)
+    seen = set()
+    for i in xrange(0, len(values), step):
+        seen.update(values[i:i + step])
+        if len(seen) > limit:
+            break
+    return len(seen)
+
+def count_colours(data, limit=LOW_COLOUR_LIMIT):
+    """Returns the number of distinct colours in the rgb24 'data', or some
+    number above 'limit' if there are more than that."""
+    if numpy is not None:
+        return _count_colours_np(data, limit)
+    return _count_colours_py(data, limit)
+
+def classify_tile(pixels, tx, ty, tw, th):
+    """Returns (class, colour) for the tile (tx, ty, tw, th) of the rgb24
+    CapturedPixels 'pixels', where class is one of CLASSES, and colour is the
+    tile's colour (as 0xRRGGBB) if it is SOLID, and None otherwise."""
+    if not tw or not th:
+        return (CONTINUOUS, None)
+    pixel = pixels.solid_pixel(tx, ty, tw, th)
+    if pixel is not None:
+        (r, g, b) = [ord(c) for c in pixel]
+        return (SOLID, (r << 16) | (g << 8) | b)
+    sample = "".join([pixels.tile_data(tx, y, tw, 1)
+                      for y in xrange(ty, ty + th, SAMPLE_ROWS)])
+    if count_colours(sample) <= LOW_COLOUR_LIMIT:
+        return (LOW_COLOUR, None)
+    return (CONTINUOUS, None)
+
+def merge_fills(fills):
+    """Takes a list of [x, y, w, h, colour] fills, in row-major order, and
+    joins horizontally adjacent ones of the same colour and height."""
+    merged = []
+    for fill in fills:
+        if merged:
+            (x, y, w, h, colour) = merged[-1]
+            if (fill[1] == y and fill[3] == h and fill[4] == colour
+                and fill[0] == x + w):
+                merged[-1] = [x, y, w + fill[2], h, colour]
+                continue
+        merged.append(list(fill))
+    return merged
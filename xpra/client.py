@@ -15,6 +15,12 @@ from wimpiggy.log import Logger
 log = Logger()
 
 from xpra.protocol import Protocol
+from xpra.tiles import (CapturedPixels, TileCache, TILE_SIZE,
+                        iter_tiles, hit_rate)
+from xpra.encodings import DECODERS, LOSSLESS
+from xpra.scaling import scale_value, unscale_value
+from xpra.cursors import CURSOR_CACHE_SIZE
+from xpra.icons import ICON_CACHE_SIZE, DEFAULT_ICON_SIZE, unpremultiply_argb
 from xpra.keys import mask_to_names, grok_modifier_map
 from xpra.platform.gui import ClipboardProtocolHelper, ClientExtras
 
@@ -53,6 +59,10 @@ class ClientSource(object):
             return None, False
 
 class ClientWindow(gtk.Window):
+    # While the user drags a window's edge, tell the server about its new
+    # size at most this often (in milliseconds):
+    RESIZE_DELAY = 50
+
     def __init__(self, client, id, x, y, w, h, metadata, override_redirect):
         if override_redirect:
             type = gtk.WINDOW_POPUP
@@ -66,6 +76,13 @@ class ClientWindow(gtk.Window):
         self._backing = None
         self._metadata = {}
         self._override_redirect = override_redirect
+        self._resize_timer = None
+        self._metadata_requested = False
+        # Reported to the server, which doesn't bother sending updates for
+        # windows that can't be seen:
+        self._window_state = {"iconified": False,
+                              "withdrawn": False,
+                              "obscured": False}
         self._new_backing(w, h)
         self.update_metadata(metadata)
         
@@ -74,12 +91,15 @@ class ClientWindow(gtk.Window):
                         | gtk.gdk.KEY_PRESS_MASK | gtk.gdk.KEY_RELEASE_MASK
                         | gtk.gdk.POINTER_MOTION_MASK
                         | gtk.gdk.BUTTON_PRESS_MASK
-                        | gtk.gdk.BUTTON_RELEASE_MASK)
+                        | gtk.gdk.BUTTON_RELEASE_MASK
+                        | gtk.gdk.VISIBILITY_NOTIFY_MASK)
 
         self.move(x, y)
         self.set_default_size(w, h)
 
         self.connect("notify::has-toplevel-focus", self._focus_change)
+        self.connect("window-state-event", self._window_state_changed)
+        self.connect("visibility-notify-event", self._visibility_changed)
 
     def update_metadata(self, metadata):
         self._metadata.update(metadata)
@@ -115,20 +135,11 @@ class ClientWindow(gtk.Window):
             self.set_wmclass(*self._metadata.get("class-instance",
                                                  ("xpra", "Xpra")))
 
-        if "icon" in self._metadata:
-            (width, height, coding, data) = self._metadata["icon"]
-            assert coding == "premult_argb32"
-            cairo_surf = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
-            cairo_surf.get_data()[:] = data
-            # FIXME: We round-trip through PNG. This is ridiculous, but faster
-            # than doing a bunch of alpha un-premultiplying and byte-swapping
-            # by hand in Python (better still would be to write some Pyrex,
-            # but I don't have time right now):
-            loader = gtk.gdk.PixbufLoader()
-            cairo_surf.write_to_png(loader)
-            loader.close()
-            pixbuf = loader.get_pixbuf()
-            self.set_icon(pixbuf)            
+        # Only look at the icon when it actually changes, since every
+        # lookup counts towards keeping our icon cache in step with the
+        # server's:
+        if "icon" in metadata:
+            self.set_icon(self._client.get_icon(metadata["icon"]))
 
     def _new_backing(self, w, h):
         old_backing = self._backing
@@ -161,6 +172,24 @@ class ClientWindow(gtk.Window):
         self.window.invalidate_rect(gtk.gdk.Rectangle(x, y, width, height),
                                     False)
 
+    def fill(self, x, y, width, height, colour):
+        cr = self._backing.cairo_create()
+        cr.set_source_rgb(((colour >> 16) & 0xff) / 255.0,
+                          ((colour >> 8) & 0xff) / 255.0,
+                          (colour & 0xff) / 255.0)
+        cr.rectangle(x, y, width, height)
+        cr.fill()
+        self.window.invalidate_rect(gtk.gdk.Rectangle(x, y, width, height),
+                                    False)
+
+    def copy_area(self, src_x, src_y, width, height, dst_x, dst_y):
+        gc = self._backing.new_gc()
+        self._backing.draw_drawable(gc, self._backing, src_x, src_y,
+                                    dst_x, dst_y, width, height)
+        self.window.invalidate_rect(gtk.gdk.Rectangle(dst_x, dst_y,
+                                                      width, height),
+                                    False)
+
     def do_expose_event(self, event):
         if not self.flags() & gtk.MAPPED:
             return
@@ -196,18 +225,65 @@ class ClientWindow(gtk.Window):
                 self._client.send(["move-window", self._id, x, y])
             if (w, h) != self._size:
                 self._size = (w, h)
-                self._client.send(["resize-window", self._id, w, h])
+                if self._resize_timer is None:
+                    self._resize_timer = gobject.timeout_add(
+                        self.RESIZE_DELAY, self._send_resize)
                 self._new_backing(w, h)
 
+    def _send_resize(self):
+        self._resize_timer = None
+        (w, h) = self._size
+        self._client.send(["resize-window", self._id, w, h])
+        return False
+
+    def rescale(self, old_scale, new_scale):
+        # Override-redirect windows get resized by the server:
+        if self._override_redirect:
+            return
+        (w, h) = [scale_value(unscale_value(v, old_scale), new_scale)
+                  for v in self._size]
+        self.resize(w, h)
+
     def move_resize(self, x, y, w, h):
         assert self._override_redirect
         self.window.move_resize(x, y, w, h)
         self._new_backing(w, h)
 
+    def configure(self, x, y, w, h):
+        # For read-only viewers, which follow the client in control; the
+        # configure event takes care of the backing:
+        assert not self._override_redirect
+        self.move(x, y)
+        self.resize(w, h)
+        self.show()
+
     def do_unmap_event(self, event):
+        if self._resize_timer is not None:
+            # (map-window will tell the server the size)
+            gobject.source_remove(self._resize_timer)
+            self._resize_timer = None
         if not self._override_redirect:
             self._client.send(["unmap-window", self._id])
 
+    def _window_state_changed(self, widget, event):
+        state = event.new_window_state
+        self._update_window_state(
+            iconified=bool(state & gtk.gdk.WINDOW_STATE_ICONIFIED),
+            withdrawn=bool(state & gtk.gdk.WINDOW_STATE_WITHDRAWN))
+        return False
+
+    def _visibility_changed(self, widget, event):
+        obscured = (event.state == gtk.gdk.VISIBILITY_FULLY_OBSCURED)
+        self._update_window_state(obscured=obscured)
+        return False
+
+    def _update_window_state(self, **changes):
+        state = dict(self._window_state)
+        state.update(changes)
+        if state != self._window_state:
+            self._window_state = state
+            self._client.send(["window-state", self._id, state])
+
     def do_delete_event(self, event):
         self._client.send(["close-window", self._id])
         return True
@@ -261,8 +337,15 @@ class ClientWindow(gtk.Window):
         self._button_action(scroll_map[event.direction], event, False)
 
     def _focus_change(self, *args):
-        self._client.update_focus(self._id,
-                                  self.get_property("has-toplevel-focus"))
+        focused = self.get_property("has-toplevel-focus")
+        self._client.update_focus(self._id, focused)
+        if (focused and "icon" not in self._metadata
+            and not self._metadata_requested):
+            # On attach, the server sends icons and the like after the
+            # window contents; this one is wanted now (for the task bar,
+            # window switchers, ...):
+            self._metadata_requested = True
+            self._client.send(["request-metadata", self._id])
 
 gobject.type_register(ClientWindow)
 
@@ -272,16 +355,50 @@ class XpraClient(gobject.GObject):
         "received-gibberish": n_arg_signal(1),
         }
 
-    def __init__(self, conn, compression_level):
+    def __init__(self, conn, compression_level, tile_cache_size=0,
+                 encoding=None, quality=None, progressive=False, scale=100,
+                 read_only=False, auto_depth=False):
         gobject.GObject.__init__(self)
         self._window_to_id = {}
         self._id_to_window = {}
 
+        # Filled in for real once the server tells us what it agreed to:
+        self._tile_cache = TileCache(0)
+        self._tile_size = TILE_SIZE
+        self._tile_hits = 0
+        self._tile_misses = 0
+        self._tiles_received = 0
+        # Cursors the server has sent us, in step with its mirror of this:
+        self._cursors = TileCache(CURSOR_CACHE_SIZE)
+        self._cursor = None
+        # Likewise for window icons (as pixbufs):
+        self._icons = TileCache(ICON_CACHE_SIZE)
+
         self._protocol = Protocol(conn, self.process_packet)
         ClientSource(self._protocol)
         capabilities_request = dict(default_capabilities)
         if compression_level:
             capabilities_request["deflate"] = compression_level
+        if tile_cache_size:
+            capabilities_request["tile_cache_size"] = tile_cache_size
+        capabilities_request["encodings"] = DECODERS.keys()
+        capabilities_request["fills"] = True
+        capabilities_request["cursors"] = True
+        capabilities_request["icon_size"] = DEFAULT_ICON_SIZE
+        if encoding is not None:
+            capabilities_request["encoding"] = encoding
+        if quality is not None:
+            capabilities_request["quality"] = quality
+        if progressive:
+            capabilities_request["progressive"] = True
+        if scale != 100:
+            capabilities_request["scale"] = scale
+        if read_only:
+            capabilities_request["read_only"] = True
+        if auto_depth:
+            capabilities_request["auto_depth"] = True
+        self._encodings = ["rgb24"]
+        self._window_scales = {0: scale}
         root_w, root_h = gtk.gdk.get_default_root_window().get_size()
         capabilities_request["desktop_size"] = [root_w, root_h]
         self.send(["hello", capabilities_request])
@@ -301,7 +418,20 @@ class XpraClient(gobject.GObject):
 
     def run(self):
         gtk_main_quit_on_fatal_exceptions_enable()
-        gtk.main()
+        try:
+            gtk.main()
+        finally:
+            self._log_stats()
+
+    def _log_stats(self):
+        if self._tile_cache.capacity:
+            lookups = self._tile_hits + self._tile_misses
+            log.info("tile cache: %s tiles received, %s drawn from cache"
+                     " (hit rate %s), %s missing",
+                     self._tiles_received, self._tile_hits,
+                     hit_rate(self._tile_hits,
+                              self._tiles_received + lookups),
+                     self._tile_misses)
 
     def _keys_changed(self, *args):
         self._modifier_map = grok_modifier_map(gtk.gdk.display_get_default())
@@ -326,10 +456,53 @@ class XpraClient(gobject.GObject):
     def send_mouse_position(self, packet):
         self._protocol.source.queue_mouse_position_packet(packet)
 
+    def set_encoding(self, encoding, quality, id=0):
+        """Asks the server to use 'encoding' for window 'id' from now on (or
+        for all windows without an encoding of their own, if 'id' is 0)."""
+        assert encoding in self._encodings
+        self.send(["encoding", id, encoding, quality])
+
+    def set_scale(self, scale, id=0):
+        """Asks the server to show window 'id' at 'scale' percent of its real
+        size (or all windows, if 'id' is 0), and resizes our windows to
+        match."""
+        self.send(["scale", id, scale])
+        if id == 0:
+            windows = self._id_to_window.items()
+        else:
+            windows = [(id, self._id_to_window[id])]
+        for (window_id, window) in windows:
+            window.rescale(self._scale_for(window_id), scale)
+        if id == 0:
+            self._window_scales = {0: scale}
+        else:
+            self._window_scales[id] = scale
+
+    def _scale_for(self, id):
+        return self._window_scales.get(id, self._window_scales[0])
+
+    def get_icon(self, icon):
+        if len(icon) == 1:
+            return self._icons.touch(icon[0])
+        (key, width, height, coding, data) = icon
+        assert coding == "premult_argb32"
+        pixbuf = gtk.gdk.pixbuf_new_from_data(unpremultiply_argb(data),
+                                              gtk.gdk.COLORSPACE_RGB, True, 8,
+                                              width, height, width * 4)
+        self._icons.add(key, pixbuf)
+        return pixbuf
+
     def _process_hello(self, packet):
         (_, capabilities) = packet
         if "deflate" in capabilities:
             self._protocol.enable_deflate(capabilities["deflate"])
+        if "tile_cache_size" in capabilities:
+            self._tile_cache = TileCache(capabilities["tile_cache_size"])
+            self._tile_size = capabilities["tile_size"]
+        self._encodings = capabilities.get("encodings", ["rgb24"])
+        # The server may not have been able to give us exactly what we asked
+        # for:
+        self._window_scales = {0: capabilities.get("scale", 100)}
         if capabilities.get("__prerelease_version") != xpra.__version__:
             log.error("sorry, I only know how to talk to v%s servers",
                       xpra.__version__)
@@ -350,12 +523,19 @@ class XpraClient(gobject.GObject):
         self.emit("handshake-complete")
 
     def _process_new_common(self, packet, override_redirect):
-        (_, id, x, y, w, h, metadata) = packet
+        (_, id, x, y, w, h, metadata) = packet[:7]
         window = ClientWindow(self, id, x, y, w, h, metadata,
                               override_redirect)
         self._id_to_window[id] = window
         self._window_to_id[window] = id
         window.show_all()
+        if self._cursor is not None:
+            window.window.set_cursor(self._cursor)
+        if len(packet) > 7:
+            # The initial contents, so that popups show up fully drawn:
+            (width, height, coding, data) = packet[7:]
+            window.draw(0, 0, width, height,
+                        DECODERS[coding](width, height, data))
 
     def _process_new_window(self, packet):
         self._process_new_common(packet, False)
@@ -364,10 +544,79 @@ class XpraClient(gobject.GObject):
         self._process_new_common(packet, True)
 
     def _process_draw(self, packet):
-        (_, id, x, y, width, height, coding, data) = packet
-        window = self._id_to_window[id]
-        assert coding == "rgb24"
-        window.draw(x, y, width, height, data)
+        (_, id, x, y, width, height, coding, data) = packet[:8]
+        if len(packet) > 8:
+            options = packet[8]
+        else:
+            options = {}
+        assert coding in self._encodings
+        data = DECODERS[coding](width, height, data)
+        if "tiles" in options:
+            assert coding in LOSSLESS
+            self._cache_tiles(x, y, width, height, data, options["tiles"])
+        # The server may still send updates for a window that it has just
+        # told us is gone (they need to reach the tile cache regardless):
+        window = self._id_to_window.get(id)
+        if window is not None:
+            window.draw(x, y, width, height, data)
+
+    def _cache_tiles(self, x, y, width, height, data, keys):
+        pixels = CapturedPixels(x, y, width, height, data)
+        tiles = list(iter_tiles(x, y, width, height, self._tile_size))
+        assert len(tiles) == len(keys)
+        for ((tx, ty, tw, th), key) in zip(tiles, keys):
+            self._tile_cache.add(key, pixels.tile_data(tx, ty, tw, th))
+        self._tiles_received += len(tiles)
+
+    def _process_tile_ref(self, packet):
+        (_, id, refs) = packet
+        window = self._id_to_window.get(id)
+        for (x, y, width, height, key) in refs:
+            try:
+                data = self._tile_cache.touch(key)
+            except KeyError:
+                # Should never happen, but if it does, the best we can do is
+                # leave the stale contents there:
+                log.warn("tile missing from cache, window %s may be out of"
+                         " date at (%s, %s)", id, x, y)
+                self._tile_misses += 1
+                continue
+            self._tile_hits += 1
+            if window is not None:
+                window.draw(x, y, width, height, data)
+
+    def _process_fill(self, packet):
+        (_, id, fills) = packet
+        window = self._id_to_window.get(id)
+        if window is not None:
+            for (x, y, width, height, colour) in fills:
+                window.fill(x, y, width, height, colour)
+
+    def _process_copy_area(self, packet):
+        (_, id, src_x, src_y, width, height, dst_x, dst_y) = packet
+        window = self._id_to_window.get(id)
+        if window is not None:
+            window.copy_area(src_x, src_y, width, height, dst_x, dst_y)
+
+    def _process_cursor(self, packet):
+        (_, key, xhot, yhot, width, height, pixels) = packet
+        pixbuf = gtk.gdk.pixbuf_new_from_data(pixels, gtk.gdk.COLORSPACE_RGB,
+                                              True, 8, width, height,
+                                              width * 4)
+        cursor = gtk.gdk.Cursor(gtk.gdk.display_get_default(), pixbuf,
+                                xhot, yhot)
+        self._cursors.add(key, cursor)
+        self._set_cursor(cursor)
+
+    def _process_cursor_ref(self, packet):
+        (_, key) = packet
+        self._set_cursor(self._cursors.touch(key))
+
+    def _set_cursor(self, cursor):
+        self._cursor = cursor
+        for window in self._id_to_window.itervalues():
+            if window.window is not None:
+                window.window.set_cursor(cursor)
 
     def _process_window_metadata(self, packet):
         (_, id, metadata) = packet
@@ -379,6 +628,14 @@ class XpraClient(gobject.GObject):
         window = self._id_to_window[id]
         window.move_resize(x, y, w, h)
 
+    def _process_configure_window(self, packet):
+        (_, id, x, y, w, h) = packet
+        self._id_to_window[id].configure(x, y, w, h)
+
+    def _process_unmap_window(self, packet):
+        (_, id) = packet
+        self._id_to_window[id].hide()
+
     def _process_lost_window(self, packet):
         (_, id) = packet
         window = self._id_to_window[id]
@@ -399,9 +656,16 @@ class XpraClient(gobject.GObject):
         "new-window": _process_new_window,
         "new-override-redirect": _process_new_override_redirect,
         "draw": _process_draw,
+        "tile-ref": _process_tile_ref,
+        "fill": _process_fill,
+        "copy-area": _process_copy_area,
         "window-metadata": _process_window_metadata,
         "configure-override-redirect": _process_configure_override_redirect,
+        "configure-window": _process_configure_window,
+        "unmap-window": _process_unmap_window,
         "lost-window": _process_lost_window,
+        "cursor": _process_cursor,
+        "cursor-ref": _process_cursor_ref,
         # "clipboard-*" packets are handled by a special case below.
         Protocol.CONNECTION_LOST: _process_connection_lost,
         Protocol.GIBBERISH: _process_gibberish,
@@ -0,0 +1,24 @@
+# This file is part of Parti.
+# Copyright (C) 2010 Nathaniel Smith <njs@pobox.com>
+# Parti is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+# Cursor images are sent to the client once, and after that referred to by
+# key, with both ends keeping a TileCache of the same capacity in step (see
+# xpra.tiles).  Keys are content digests rather than X cursor serials, since
+# applications tend to create new cursors that look just like old ones (and
+# serials mean nothing to a client that has attached to a different server
+# before).
+
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
+
+CURSOR_CACHE_SIZE = 64
+
+def cursor_key(xhot, yhot, width, height, pixels):
+    digest = md5()
+    digest.update("%s,%s,%sx%s:" % (xhot, yhot, width, height))
+    digest.update(pixels)
+    return digest.hexdigest()
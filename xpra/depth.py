@@ -0,0 +1,191 @@
+# This file is part of Parti.
+# Copyright (C) 2010 Nathaniel Smith <njs@pobox.com>
+# Parti is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+# Reduced colour depth, for slow links.  "rgb565" sends 16 bits per pixel
+# (5 for red, 6 for green, 5 for blue); "palette" sends 8, as an index into a
+# palette that goes along with the pixels: the image's own colours if there
+# are no more than 256 of them (in which case nothing is lost), or a fixed
+# 3-3-2 palette otherwise.  Either way there is less to send, at the price of
+# some banding.
+#
+# The server can switch to these by itself while the link to the client is
+# congested, which we judge by how much of the time writes to the client
+# spend waiting for the link; once it has been keeping up comfortably for a
+# while, everything goes back to full depth.
+
+import sys
+import struct
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from xpra.kernels import rgb24_to_rgb565
+
+# Lookup tables for when we don't have NumPy, built on first use:
+_tables = {}
+
+def _rgb565_to_rgb24_table():
+    if "rgb565" not in _tables:
+        def expand(v, bits):
+            # Repeat the top bits at the bottom, so that full brightness
+            # stays full brightness:
+            return (v << (8 - bits)) | (v >> (2 * bits - 8))
+        _tables["rgb565"] = [chr(expand(v >> 11, 5))
+                             + chr(expand((v >> 5) & 0x3f, 6))
+                             + chr(expand(v & 0x1f, 5))
+                             for v in xrange(0x10000)]
+    return _tables["rgb565"]
+
+def _pixel_values_np(data):
+    pixels = numpy.frombuffer(data, dtype=numpy.uint8).reshape((-1, 3))
+    return pixels.astype(numpy.uint32)
+
+def encode_rgb565(width, height, data, quality):
+    """Packs rgb24 'data' into 16 bits per pixel, little-endian."""
+    return rgb24_to_rgb565(data)
+
+def decode_rgb565(width, height, data):
+    assert len(data) == width * height * 2
+    if numpy is not None:
+        values = numpy.frombuffer(data, dtype="<u2").astype(numpy.uint32)
+        r = values >> 11
+        g = (values >> 5) & 0x3f
+        b = values & 0x1f
+        pixels = numpy.empty((len(values), 3), dtype=numpy.uint8)
+        pixels[:, 0] = (r << 3) | (r >> 2)
+        pixels[:, 1] = (g << 2) | (g >> 4)
+        pixels[:, 2] = (b << 3) | (b >> 2)
+        return pixels.tostring()
+    values = array("H", data)
+    if sys.byteorder == "big":
+        values.byteswap()
+    table = _rgb565_to_rgb24_table()
+    return "".join([table[v] for v in values])
+
+def _fixed_palette():
+    # 3 bits of red, 3 of green, 2 of blue, each stretched back to 0-255:
+    if "palette" not in _tables:
+        colours = []
+        for i in xrange(256):
+            r = (i >> 5) * 255 // 7
+            g = ((i >> 2) & 7) * 255 // 7
+            b = (i & 3) * 255 // 3
+            colours.append(chr(r) + chr(g) + chr(b))
+        _tables["palette"] = colours
+    return _tables["palette"]
+
+def _encode_palette_np(data):
+    p = _pixel_values_np(data)
+    values = (p[:, 0] << 16) | (p[:, 1] << 8) | p[:, 2]
+    (colours, indices) = numpy.unique(values, return_inverse=True)
+    if len(colours) <= 256:
+        palette = numpy.empty((len(colours), 3), dtype=numpy.uint8)
+        palette[:, 0] = colours >> 16
+        palette[:, 1] = (colours >> 8) & 0xff
+        palette[:, 2] = colours & 0xff
+        return (palette.tostring(), indices.astype(numpy.uint8).tostring())
+    indices = ((p[:, 0] & 0xe0) | ((p[:, 1] & 0xe0) >> 3) | (p[:, 2] >> 6))
+    return ("".join(_fixed_palette()),
+            indices.astype(numpy.uint8).tostring())
+
+def _encode_palette_py(data):
+    palette = {}
+    indices = []
+    for i in xrange(0, len(data), 3):
+        pixel = data[i:i + 3]
+        index = palette.get(pixel)
+        if index is None:
+            if len(palette) == 256:
+                break
+            index = palette[pixel] = chr(len(palette))
+        indices.append(index)
+    else:
+        colours = sorted(palette, key=palette.get)
+        return ("".join(colours), "".join(indices))
+    # Too many colours for a palette of their own:
+    fixed = {}
+    indices = []
+    for i in xrange(0, len(data), 3):
+        pixel = data[i:i + 3]
+        index = fixed.get(pixel)
+        if index is None:
+            (r, g, b) = struct.unpack("BBB", pixel)
+            index = fixed[pixel] = chr((r & 0xe0) | ((g & 0xe0) >> 3)
+                                       | (b >> 6))
+        indices.append(index)
+    return ("".join(_fixed_palette()), "".join(indices))
+
+def encode_palette(width, height, data, quality):
+    """Returns the rgb24 'data' as one byte holding the number of palette
+    entries less one, the palette itself (3 bytes per entry), and then one
+    byte per pixel."""
+    if numpy is not None:
+        (palette, indices) = _encode_palette_np(data)
+    else:
+        (palette, indices) = _encode_palette_py(data)
+    return chr(len(palette) // 3 - 1) + palette + indices
+
+def decode_palette(width, height, data):
+    entries = ord(data[0]) + 1
+    palette = data[1:1 + entries * 3]
+    indices = data[1 + entries * 3:]
+    assert len(palette) == entries * 3
+    assert len(indices) == width * height
+    if numpy is not None:
+        colours = numpy.frombuffer(palette, dtype=numpy.uint8)
+        colours = colours.reshape((entries, 3))
+        return colours[numpy.frombuffer(indices, dtype=numpy.uint8)].tostring()
+    colours = [palette[i:i + 3] for i in xrange(0, len(palette), 3)]
+    return "".join([colours[i] for i in array("B", indices)])
+
+# How far back we look when deciding whether the link is congested:
+LINK_PERIOD = 2.0
+# The link counts as congested once writes spend at least this fraction of
+# the time waiting for it...
+CONGESTED_BUSY = 0.8
+# ...and as having recovered once they spend no more than this fraction
+# waiting, for at least RECOVERY_TIME seconds.  Reduced depth sends at most
+# two thirds as much, so a link that keeps up this easily should cope with
+# full depth again:
+RECOVERED_BUSY = 0.25
+RECOVERY_TIME = 10.0
+
+class LinkMonitor(object):
+    def __init__(self, period=LINK_PERIOD):
+        self.period = period
+        self.is_constrained = False
+        self._start = None
+        self._calm_since = None
+
+    def record(self, now, waited):
+        """Takes 'waited', the total time so far that writes to the client
+        have spent waiting for the link.  Returns True if this switched the
+        link between constrained and not."""
+        if self._start is None:
+            self._start = (now, waited)
+            return False
+        (start, start_waited) = self._start
+        elapsed = now - start
+        if elapsed < self.period:
+            return False
+        self._start = (now, waited)
+        busy = (waited - start_waited) / elapsed
+        if not self.is_constrained:
+            if busy >= CONGESTED_BUSY:
+                self.is_constrained = True
+                self._calm_since = None
+                return True
+        elif busy <= RECOVERED_BUSY:
+            if self._calm_since is None:
+                self._calm_since = start
+            if now - self._calm_since >= RECOVERY_TIME:
+                self.is_constrained = False
+                return True
+        else:
+            self._calm_since = None
+        return False
@@ -0,0 +1,84 @@
+# This file is part of Parti.
+# Copyright (C) 2010 Nathaniel Smith <njs@pobox.com>
+# Parti is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+# The ways window contents can be encoded in a "draw" packet.  The server
+# picks one of ENCODERS for each update, the client turns it back into plain
+# rgb24 data with the matching entry in DECODERS.  Which encodings are
+# actually used is negotiated in "hello".
+#
+# This module is also used for checking command line options, before it is
+# safe to load gtk, and thus must not import gtk at load time.
+
+from xpra.tiles import CapturedPixels
+from xpra.depth import (encode_rgb565, decode_rgb565,
+                        encode_palette, decode_palette)
+
+DEFAULT_QUALITY = 80
+
+# Encodings which reproduce the captured pixels exactly.  Only these can be
+# used for things like the tile cache, which assume that the client has the
+# same pixels we do:
+LOSSLESS = ("rgb24", "png")
+
+# Encodings with fewer bits per pixel, for slow links:
+REDUCED_DEPTH = ("rgb565", "palette")
+
+def clamp_quality(quality):
+    return max(1, min(100, int(quality)))
+
+def _pixbuf_from_rgb24(width, height, data):
+    import gtk
+    return gtk.gdk.pixbuf_new_from_data(data, gtk.gdk.COLORSPACE_RGB,
+                                        False, 8, width, height, width * 3)
+
+def _save_pixbuf(pixbuf, type, options):
+    chunks = []
+    def append(buf):
+        chunks.append(buf)
+        return True
+    pixbuf.save_to_callback(append, type, options)
+    return "".join(chunks)
+
+def encode_rgb24(width, height, data, quality):
+    return data
+
+def encode_png(width, height, data, quality):
+    return _save_pixbuf(_pixbuf_from_rgb24(width, height, data), "png", {})
+
+def encode_jpeg(width, height, data, quality):
+    return _save_pixbuf(_pixbuf_from_rgb24(width, height, data), "jpeg",
+                        {"quality": str(clamp_quality(quality))})
+
+ENCODERS = {
+    "rgb24": encode_rgb24,
+    "png": encode_png,
+    "jpeg": encode_jpeg,
+    "rgb565": encode_rgb565,
+    "palette": encode_palette,
+    }
+
+def decode_rgb24(width, height, data):
+    assert len(data) == width * height * 3
+    return data
+
+def decode_with_pixbuf_loader(width, height, data):
+    import gtk
+    loader = gtk.gdk.PixbufLoader()
+    loader.write(data)
+    loader.close()
+    pixbuf = loader.get_pixbuf()
+    assert (pixbuf.get_width(), pixbuf.get_height()) == (width, height)
+    assert pixbuf.get_n_channels() == 3 and not pixbuf.get_has_alpha()
+    pixels = CapturedPixels(0, 0, width, height, pixbuf.get_pixels(),
+                            pixbuf.get_rowstride())
+    return pixels.tile_data(0, 0, width, height)
+
+DECODERS = {
+    "rgb24": decode_rgb24,
+    "png": decode_with_pixbuf_loader,
+    "jpeg": decode_with_pixbuf_loader,
+    "rgb565": decode_rgb565,
+    "palette": decode_palette,
+    }
@@ -0,0 +1,140 @@
+# This file is part of Parti.
+# Copyright (C) 2010 Nathaniel Smith <njs@pobox.com>
+# Parti is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+# Somewhere to run the expensive, X-free parts of the pixel pipeline (mostly
+# png/jpeg encoding) without holding up the main loop.  The encoders spend
+# most of their time in C code that releases the GIL, so a few threads go a
+# long way.
+#
+# Jobs may finish in any order; it is up to the caller to put the results
+# back in sequence.
+
+import sys
+from Queue import Queue
+from threading import Thread
+
+from wimpiggy.log import Logger
+log = Logger()
+
+class Job(object):
+    def __init__(self, callback, fn, args):
+        self._callback = callback
+        self._fn = fn
+        self._args = args
+        self.done = False
+        self._result = None
+        self._exc_info = None
+
+    def run(self):
+        try:
+            self._result = self._fn(*self._args)
+        except:
+            self._exc_info = sys.exc_info()
+        self.done = True
+        if self._callback is not None:
+            self._callback(self)
+
+    def result(self):
+        """Returns what the job's function returned, or re-raises whatever it
+        raised.  Only valid once the job is done."""
+        assert self.done
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+class InlineExecutor(object):
+    """Runs each job straight away, in the calling thread.  The job is done
+    by the time submit() returns, so the callback is never called."""
+    def submit(self, callback, fn, *args):
+        job = Job(None, fn, args)
+        job.run()
+        return job
+
+class ThreadPoolExecutor(object):
+    """Runs jobs on a fixed number of worker threads.  The callback is called
+    from the worker thread, as soon as the job is done."""
+    def __init__(self, threads):
+        self._queue = Queue()
+        for i in xrange(threads):
+            thread = Thread(target=self._worker_loop)
+            thread.daemon = True
+            thread.start()
+
+    def _worker_loop(self):
+        while True:
+            job = self._queue.get()
+            job.run()
+
+    def submit(self, callback, fn, *args):
+        job = Job(callback, fn, args)
+        self._queue.put(job)
+        return job
+
+def make_executor(threads):
+    if threads <= 0:
+        return InlineExecutor()
+    log("encoding on %s threads", threads)
+    return ThreadPoolExecutor(threads)
+
+class UpdateQueue(object):
+    """The window updates waiting to go to one client, in order: each is
+    either a packet, or a Job that will produce one.  Keeps count of the jobs
+    still pending for each window."""
+    def __init__(self):
+        self._queue = []
+        # Job -> (id, info):
+        self._jobs = {}
+        # id -> number of that window's jobs still pending:
+        self._in_flight = {}
+
+    def __len__(self):
+        return len(self._queue)
+
+    def append(self, packet):
+        self._queue.append(packet)
+
+    def append_job(self, id, job, info=None):
+        """Queues the packet that 'job' will produce, for window 'id'.  If
+        the job fails, pop() hands back 'info' instead."""
+        self._jobs[job] = (id, info)
+        self._in_flight[id] = self._in_flight.get(id, 0) + 1
+        self._queue.append(job)
+
+    def jump_queue(self, id, packet):
+        """Queues 'packet' (for window 'id') ahead of everything except any
+        packets for that window that already did the same."""
+        position = 0
+        for (i, queued) in enumerate(self._queue):
+            if not isinstance(queued, Job) and queued[1] == id:
+                position = i + 1
+        self._queue.insert(position, packet)
+
+    def in_flight(self, id):
+        return id in self._in_flight
+
+    def ready(self):
+        """Whether the next update can be popped without waiting."""
+        if not self._queue:
+            return False
+        first = self._queue[0]
+        return not isinstance(first, Job) or first.done
+
+    def pop(self):
+        """Returns (packet, None) for the next update, or (None, info) if it
+        was to come from a job that failed (which is logged).  Only valid if
+        ready()."""
+        first = self._queue.pop(0)
+        if not isinstance(first, Job):
+            return (first, None)
+        (id, info) = self._jobs.pop(first)
+        self._in_flight[id] -= 1
+        if not self._in_flight[id]:
+            del self._in_flight[id]
+        try:
+            return (first.result(), None)
+        except Exception:
+            log.error("Failed to encode an update for window %s", id,
+                      exc_info=True)
+            return (None, info)
@@ -0,0 +1,38 @@
+# This file is part of Parti.
+# Copyright (C) 2010 Nathaniel Smith <njs@pobox.com>
+# Parti is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+# Window icons are shrunk by the server to the size the client asks for, and
+# sent to the client only once; after that, the "icon" metadata is just the
+# icon's key, and both ends keep a TileCache of the same capacity in step
+# (see xpra.tiles), exactly as for cursors.  All the windows of an
+# application usually share the same icon, so this saves a lot.
+
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
+
+# (for the client, which gets icons as ARGB32)
+from xpra.kernels import unpremultiply_argb
+
+ICON_CACHE_SIZE = 32
+# Big enough for task bars and window switchers:
+DEFAULT_ICON_SIZE = 64
+
+def icon_key(width, height, data):
+    digest = md5()
+    digest.update("%sx%s:" % (width, height))
+    digest.update(data)
+    return digest.hexdigest()
+
+def fit_icon_size(width, height, size):
+    """Returns the dimensions to scale a (width, height) icon to so that it
+    fits in a size x size square, keeping its aspect ratio.  Icons are never
+    scaled up."""
+    if width <= size and height <= size:
+        return (width, height)
+    if width >= height:
+        return (size, max(1, (height * size + width // 2) // width))
+    return (max(1, (width * size + height // 2) // height), size)
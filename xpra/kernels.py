@@ -0,0 +1,164 @@
+# This file is part of Parti.
+# Copyright (C) 2010 Nathaniel Smith <njs@pobox.com>
+# Parti is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+# The loops that run over every pixel we send: format conversion, alpha
+# un-premultiplying, cutting tiles out of captures (to send them, or to hash
+# them when looking for what changed), hashing rows, and spotting solid
+# colour.
+#
+# Each of these uses the compiled versions in xpra._kernels if that was
+# built, NumPy if it is around, and plain Python otherwise, so callers
+# needn't care which they get.  Row hashing uses md5 (in C already) on
+# buffers into the captured data, so it needs no copies whichever way it
+# runs.  Tiles are hashed after region_data() has copied them out, since
+# feeding md5 one short row at a time measured slower than the copy.  See
+# bench_kernels for how the implementations compare.
+#
+# There is no conversion from the X server's own BGRX: captures come from
+# gdk-pixbuf, which hands them over as rgb24 already.
+#
+# Pixel regions are given as the data, its rowstride, the offset of the
+# region's first byte, and the region's width (in bytes) and height.
+
+from array import array
+from binascii import hexlify, unhexlify
+
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
+
+try:
+    from xpra import _kernels
+except ImportError:
+    _kernels = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def implementation():
+    """Returns which implementation the conversions are using."""
+    if _kernels is not None:
+        return "compiled"
+    if numpy is not None:
+        return "numpy"
+    return "python"
+
+def _rgb565_np(r, g, b):
+    values = (((r.astype(numpy.uint16) >> 3) << 11)
+              | ((g.astype(numpy.uint16) >> 2) << 5)
+              | (b.astype(numpy.uint16) >> 3))
+    return values.astype("<u2").tostring()
+
+# For plain Python, each byte of rgb565 is worked out as the OR of two table
+# lookups, one on each of the two channels that go into it:
+_R_HI = "".join([chr((v >> 3) << 3) for v in xrange(256)])
+_G_HI = "".join([chr(v >> 5) for v in xrange(256)])
+_G_LO = "".join([chr(((v >> 2) & 7) << 5) for v in xrange(256)])
+_B_LO = "".join([chr(v >> 3) for v in xrange(256)])
+
+def _or_strings(a, b):
+    # (long integers are the only thing that will OR whole strings at once)
+    value = int(hexlify(a) or "0", 16) | int(hexlify(b) or "0", 16)
+    return unhexlify("%0*x" % (len(a) * 2, value))
+
+def _rgb24_to_rgb565_py(data):
+    (r, g, b) = (data[0::3], data[1::3], data[2::3])
+    rgb565 = bytearray(len(r) * 2)
+    rgb565[0::2] = _or_strings(g.translate(_G_LO), b.translate(_B_LO))
+    rgb565[1::2] = _or_strings(r.translate(_R_HI), g.translate(_G_HI))
+    return str(rgb565)
+
+def rgb24_to_rgb565(data):
+    """Packs rgb24 pixels into 16 bits each (5 bits red, 6 green, 5 blue),
+    little-endian."""
+    if _kernels is not None:
+        return _kernels.rgb24_to_rgb565(data)
+    if numpy is not None:
+        pixels = numpy.frombuffer(data, dtype=numpy.uint8).reshape((-1, 3))
+        return _rgb565_np(pixels[:, 0], pixels[:, 1], pixels[:, 2])
+    return _rgb24_to_rgb565_py(data)
+
+def _unpremultiply_argb_np(data):
+    pixels = numpy.frombuffer(data, dtype=numpy.uint32)
+    a = (pixels >> 24) & 0xff
+    # Fully transparent pixels are black, and stay that way:
+    divisor = numpy.where(a == 0, 255, a)
+    rgba = numpy.empty((len(pixels), 4), dtype=numpy.uint8)
+    for (i, shift) in enumerate((16, 8, 0)):
+        rgba[:, i] = numpy.minimum(255,
+                                   ((pixels >> shift) & 0xff) * 255 // divisor)
+    rgba[:, 3] = a
+    return rgba.tostring()
+
+def _unpremultiply_argb_py(data):
+    pixels = array("I", data)
+    assert pixels.itemsize == 4
+    rgba = array("B", "\0" * (len(pixels) * 4))
+    for i in xrange(len(pixels)):
+        argb = pixels[i]
+        a = (argb >> 24) & 0xff
+        r = (argb >> 16) & 0xff
+        g = (argb >> 8) & 0xff
+        b = argb & 0xff
+        if a != 0 and a != 0xff:
+            # (min() in case of bogus, not really premultiplied, icons)
+            r = min(255, r * 255 // a)
+            g = min(255, g * 255 // a)
+            b = min(255, b * 255 // a)
+        rgba[i * 4:i * 4 + 4] = array("B", (r, g, b, a))
+    return rgba.tostring()
+
+def unpremultiply_argb(data):
+    """Converts native-endian premultiplied ARGB32 pixels (as used by cairo,
+    and _NET_WM_ICON) to non-premultiplied RGBA bytes (as used by
+    gdk-pixbuf)."""
+    if _kernels is not None:
+        return _kernels.unpremultiply_argb(data)
+    if numpy is not None:
+        return _unpremultiply_argb_np(data)
+    return _unpremultiply_argb_py(data)
+
+def _region_data_np(data, rowstride, offset, rowwidth, height):
+    pixels = numpy.frombuffer(data, dtype=numpy.uint8, offset=offset,
+                              count=(height - 1) * rowstride + rowwidth)
+    rows = numpy.lib.stride_tricks.as_strided(pixels, (height, rowwidth),
+                                              (rowstride, 1))
+    return rows.tostring()
+
+def region_data(data, rowstride, offset, rowwidth, height):
+    """Returns the bytes of a region, without the rest of the rows it is
+    part of."""
+    if rowwidth == rowstride or height <= 1:
+        return data[offset:offset + rowwidth * height]
+    if _kernels is not None:
+        return _kernels.region_data(data, rowstride, offset, rowwidth, height)
+    if numpy is not None:
+        return _region_data_np(data, rowstride, offset, rowwidth, height)
+    return "".join([data[start:start + rowwidth]
+                    for start in xrange(offset, offset + height * rowstride,
+                                        rowstride)])
+
+def row_digests(data, rowstride, rowwidth, height):
+    """Returns a list with the digest of each of the first 'rowwidth' bytes
+    of each of 'height' rows."""
+    return [md5(buffer(data, y * rowstride, rowwidth)).digest()
+            for y in xrange(height)]
+
+def solid_pixel(data, rowstride, offset, rowwidth, height, bpp=3):
+    """Returns the pixel (as a string of 'bpp' bytes) that a region is
+    filled with, or None if it has more than one colour."""
+    if _kernels is not None:
+        return _kernels.solid_pixel(data, rowstride, offset, rowwidth, height,
+                                    bpp)
+    pixel = data[offset:offset + bpp]
+    row = pixel * (rowwidth // bpp)
+    # (startswith compares in place, without slicing out a copy)
+    for y in xrange(height):
+        if not data.startswith(row, offset + y * rowstride):
+            return None
+    return pixel
@@ -10,6 +10,7 @@
 import gobject
 gobject.threads_init()
 import os
+import time
 import socket # for socket.error
 import zlib
 
@@ -84,6 +85,10 @@ class Protocol(object):
         self._read_decoder = IncrBDecode()
         self._compressor = None
         self._decompressor = None
+        # How long, in total, the write thread has spent waiting for the
+        # connection to take what we gave it (written by the write thread
+        # only):
+        self.write_wait = 0.0
         self._write_thread = Thread(target=self._write_thread_loop)
         self._write_thread.daemon = True
         self._write_thread.start()
@@ -122,6 +127,7 @@ class Protocol(object):
             # Used to signal that we should exit:
             if buf is None:
                 return
+            start = time.time()
             try:
                 while buf:
                     log("write thread: writing %s", repr_ellipsized(buf))
@@ -133,6 +139,7 @@ class Protocol(object):
             except TypeError:
                 assert self._closed
                 return
+            self.write_wait += time.time() - start
             if self._write_queue.empty():
                 main_thread_call(self._maybe_queue_more_writes)
         return False
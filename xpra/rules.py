@@ -0,0 +1,174 @@
+# This file is part of Parti.
+# Copyright (C) 2010 Nathaniel Smith <njs@pobox.com>
+# Parti is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+# Encoding rules: a file that says how to send windows, picked by what the
+# windows are.  Each line is one rule, made of match terms and settings, all
+# written as key=value:
+#
+#   class=XTerm                  encoding=rgb24
+#   class=Firefox title=*YouTube* encoding=jpeg quality=60 max-fps=25
+#   type=DIALOG                  priority=high
+#   instance=gimp                delay=50
+#
+# The match terms are shell-style patterns (ignoring case) for the window's
+# class, instance, title or type (as in _NET_WM_WINDOW_TYPE, without the
+# prefix), and transient=yes or no; a rule with no match terms matches every
+# window.  The settings are:
+#
+#   encoding   what to send the window's contents as
+#   quality    the quality for lossy encodings
+#   max-fps    the most updates per second to send for the window
+#   delay      how long (in milliseconds) to let damage pile up before
+#              sending any of it, so that it goes out in bigger batches
+#   priority   high, normal or low: how soon the window's damage is sent,
+#              compared to other windows' (see xpra.scheduler)
+#
+# Every window gets the settings of the first rule that matches it and has
+# them, so a general rule can follow the more specific ones.  Anything the
+# client asked for explicitly takes precedence.
+
+import shlex
+from fnmatch import fnmatchcase
+
+from xpra.encodings import ENCODERS, clamp_quality
+from xpra.scheduler import (OVERRIDE_REDIRECT_SLACK, DEFAULT_SLACK,
+                            LOW_SLACK)
+
+MATCH_KEYS = ("class", "instance", "title", "type", "transient")
+
+PRIORITY_SLACKS = {
+    "high": OVERRIDE_REDIRECT_SLACK,
+    "normal": DEFAULT_SLACK,
+    "low": LOW_SLACK,
+    }
+
+class RulesError(Exception):
+    pass
+
+class Profile(object):
+    """What the rules say about a window; None means they don't say."""
+    SETTINGS = ("encoding", "quality", "max_fps", "delay", "priority")
+
+    def __init__(self, **settings):
+        for name in self.SETTINGS:
+            setattr(self, name, settings.get(name))
+
+    def __eq__(self, other):
+        return (isinstance(other, Profile)
+                and all([getattr(self, name) == getattr(other, name)
+                         for name in self.SETTINGS]))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "Profile(%s)" % ", ".join(["%s=%r" % (name, getattr(self, name))
+                                          for name in self.SETTINGS
+                                          if getattr(self, name) is not None])
+
+def window_type_name(atom_name):
+    """Turns "_NET_WM_WINDOW_TYPE_DIALOG" into "DIALOG"."""
+    return atom_name.split("_TYPE_")[-1]
+
+def _parse_setting(key, value):
+    if key == "encoding":
+        if value not in ENCODERS:
+            raise ValueError("unknown encoding %r" % value)
+        return ("encoding", value)
+    if key == "quality":
+        return ("quality", clamp_quality(value))
+    if key == "max-fps":
+        fps = float(value)
+        if fps <= 0:
+            raise ValueError("max-fps must be positive")
+        return ("max_fps", fps)
+    if key == "delay":
+        delay = int(value)
+        if delay < 0:
+            raise ValueError("delay must not be negative")
+        return ("delay", delay / 1000.0)
+    if key == "priority":
+        if value not in PRIORITY_SLACKS:
+            raise ValueError("priority must be one of %s"
+                             % ", ".join(sorted(PRIORITY_SLACKS)))
+        return ("priority", value)
+    raise ValueError("unknown key %r" % key)
+
+def parse_rules(lines):
+    """Parses the lines of a rules file into a list of (matches, settings)
+    pairs, raising RulesError if any of them is no good."""
+    rules = []
+    for (number, line) in enumerate(lines):
+        matches = {}
+        settings = {}
+        try:
+            for term in shlex.split(line, comments=True):
+                if "=" not in term:
+                    raise ValueError("%r is not of the form key=value" % term)
+                (key, value) = term.split("=", 1)
+                if key == "transient":
+                    if value not in ("yes", "no"):
+                        raise ValueError("transient must be yes or no")
+                    matches[key] = (value == "yes")
+                elif key in MATCH_KEYS:
+                    matches[key] = value.lower()
+                else:
+                    (name, value) = _parse_setting(key, value)
+                    settings[name] = value
+        except ValueError, e:
+            raise RulesError("line %s: %s" % (number + 1, e))
+        if not matches and not settings:
+            # Blank, or just a comment:
+            continue
+        if not settings:
+            raise RulesError("line %s: no settings" % (number + 1))
+        rules.append((matches, settings))
+    return rules
+
+def _matches(matches, properties):
+    for (key, pattern) in matches.items():
+        if key == "transient":
+            if bool(properties.get("transient")) != pattern:
+                return False
+        elif key == "type":
+            types = [t.lower() for t in properties.get("type", [])]
+            if not [t for t in types if fnmatchcase(t, pattern)]:
+                return False
+        elif not fnmatchcase((properties.get(key) or u"").lower(), pattern):
+            return False
+    return True
+
+class EncodingRules(object):
+    def __init__(self, filename=None):
+        self.filename = filename
+        self._rules = []
+        if filename is not None:
+            self.load()
+
+    def load(self):
+        """(Re-)reads the rules file.  If it can't be read or is no good,
+        raises RulesError and keeps the rules we already had."""
+        try:
+            f = open(self.filename)
+            try:
+                rules = parse_rules(f.readlines())
+            finally:
+                f.close()
+        except IOError, e:
+            raise RulesError(str(e))
+        except RulesError, e:
+            raise RulesError("%s, %s" % (self.filename, e))
+        self._rules = rules
+
+    def profile_for(self, properties):
+        """Returns the Profile for a window, described by 'properties': a dict
+        with its "class", "instance", "title", "type" (a list of names, as
+        returned by window_type_name) and "transient" (a boolean)."""
+        settings = {}
+        for (matches, rule_settings) in self._rules:
+            if _matches(matches, properties):
+                for (name, value) in rule_settings.items():
+                    settings.setdefault(name, value)
+        return Profile(**settings)
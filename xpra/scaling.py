@@ -0,0 +1,57 @@
+# This file is part of Parti.
+# Copyright (C) 2010 Nathaniel Smith <njs@pobox.com>
+# Parti is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+# A client can ask for windows to be shown smaller than they really are.
+# Scales are given as a percentage (bencode has no floats); window positions
+# are the same on both sides, but sizes, and coordinates within a window, are
+# multiplied by the scale on the way to the client and divided by it on the
+# way back.
+#
+# This module is used for checking command line options, and must not import
+# gtk.
+
+MIN_SCALE = 10
+MAX_SCALE = 100
+
+def clamp_scale(scale):
+    return max(MIN_SCALE, min(MAX_SCALE, int(scale)))
+
+def scale_value(value, scale):
+    """Server to client."""
+    if scale == 100:
+        return value
+    return max(1, (value * scale + 50) // 100)
+
+def unscale_value(value, scale):
+    """Client to server."""
+    if scale == 100:
+        return value
+    return max(1, (value * 100 + scale // 2) // scale)
+
+def scale_rect(x, y, w, h, scale):
+    """Returns the smallest rectangle of the scaled window that covers all of
+    (x, y, w, h) in the unscaled one."""
+    x1 = x * scale // 100
+    y1 = y * scale // 100
+    x2 = -(-(x + w) * scale // 100)
+    y2 = -(-(y + h) * scale // 100)
+    return (x1, y1, x2 - x1, y2 - y1)
+
+def unscale_point(origin, point, scale):
+    """Maps 'point' (in root window coordinates) on a scaled window at
+    'origin' back to where it is on the unscaled one."""
+    if scale == 100:
+        return point
+    (ox, oy) = origin
+    (px, py) = point
+    return (ox + (px - ox) * 100 // scale, oy + (py - oy) * 100 // scale)
+
+def scale_size_constraints(constraints, scale):
+    scaled = {}
+    for (key, value) in constraints.iteritems():
+        if key in ("maximum-size", "minimum-size", "base-size", "increment"):
+            value = [scale_value(v, scale) for v in value]
+        scaled[key] = value
+    return scaled
@@ -0,0 +1,134 @@
+# This file is part of Parti.
+# Copyright (C) 2010 Nathaniel Smith <njs@pobox.com>
+# Parti is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+# Deciding which window to send an update for next.
+#
+# Each window with pending damage gets a deadline: the time its damage
+# arrived, plus a slack that is shorter for the windows the user is most
+# likely looking at (menus and other override-redirect windows, then the
+# focused window).  We always serve the ready window with the earliest
+# deadline.  Once served, a window that still has damage left goes back in
+# with a new deadline, counted from then -- so a busy window takes its turn
+# with everyone else instead of hogging the link, and windows that have been
+# waiting a long time get ahead of newer damage no matter where it comes
+# from.
+#
+# This bounds how long any window waits: once its deadline has passed,
+# anything else that gets damaged ends up behind it, so at worst it waits for
+# its slack plus one turn each for the windows already ahead of it.
+
+from heapq import heappush, heappop
+
+# In seconds:
+DEFAULT_SLACK = 0.1
+FOCUS_SLACK = 0.025
+OVERRIDE_REDIRECT_SLACK = 0.01
+# For windows that the encoding rules say can wait (see xpra.rules):
+LOW_SLACK = 0.5
+
+class LatencyHistogram(object):
+    """Counts how long windows waited for their updates."""
+    # Upper bounds of the buckets, in milliseconds; anything slower goes in
+    # an extra bucket at the end:
+    BUCKETS = (5, 10, 20, 50, 100, 200, 500, 1000)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.max = 0.0
+
+    def __len__(self):
+        return sum(self.counts)
+
+    def record(self, latency):
+        ms = latency * 1000
+        for (i, bound) in enumerate(self.BUCKETS):
+            if ms <= bound:
+                break
+        else:
+            i = len(self.BUCKETS)
+        self.counts[i] += 1
+        self.max = max(self.max, latency)
+
+    def percentile(self, p):
+        """Returns an upper bound (in ms, or None for 'more than the largest
+        bucket') on the latency of the fastest p percent of updates."""
+        needed = len(self) * p / 100.0
+        seen = 0
+        for (i, count) in enumerate(self.counts):
+            seen += count
+            if seen >= needed:
+                if i < len(self.BUCKETS):
+                    return self.BUCKETS[i]
+                return None
+        return None
+
+    def summary(self):
+        def fmt(bound):
+            if bound is None:
+                return ">%sms" % self.BUCKETS[-1]
+            return "<=%sms" % bound
+        return ("%s updates, median %s, 95%% %s, worst %ims"
+                % (len(self), fmt(self.percentile(50)),
+                   fmt(self.percentile(95)), self.max * 1000))
+
+class DamageScheduler(object):
+    def __init__(self):
+        # id -> (deadline, arrival)
+        self._pending = {}
+        # (deadline, arrival, id); may contain stale entries, which are
+        # skipped (and dropped) when they come up:
+        self._heap = []
+        self.latency = LatencyHistogram()
+
+    def __contains__(self, id):
+        return id in self._pending
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, id, now, slack):
+        """Notes that window 'id' has damage as of 'now'.  Does nothing if it
+        was already waiting, so that it keeps its place."""
+        if id in self._pending:
+            return
+        entry = (now + slack, now)
+        self._pending[id] = entry
+        heappush(self._heap, entry + (id,))
+
+    def arrival(self, id):
+        """Returns when window 'id' got the damage it is waiting with, or
+        None if it isn't waiting."""
+        if id not in self._pending:
+            return None
+        return self._pending[id][1]
+
+    def remove(self, id):
+        if id in self._pending:
+            del self._pending[id]
+
+    def served(self, id, now):
+        """Notes that window 'id' has just been sent an update.  If it has
+        damage left over, add() it again."""
+        if id in self._pending:
+            (_, arrival) = self._pending.pop(id)
+            self.latency.record(now - arrival)
+
+    def next(self, is_ready):
+        """Returns the waiting window with the earliest deadline for which
+        is_ready(id) is true, or None."""
+        skipped = []
+        found = None
+        while self._heap:
+            entry = heappop(self._heap)
+            (deadline, arrival, id) = entry
+            if self._pending.get(id) != (deadline, arrival):
+                continue
+            skipped.append(entry)
+            if is_ready(id):
+                found = id
+                break
+        for entry in skipped:
+            heappush(self._heap, entry)
+        return found
@@ -0,0 +1,34 @@
+# This file is part of Parti.
+# Copyright (C) 2010 Nathaniel Smith <njs@pobox.com>
+# Parti is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+# Sizing the server's screen to the client's.  A screen that is bigger than
+# the client's desktop is wasted memory (and windows can end up where the
+# client can't show them); so when a client attaches, we have RandR switch
+# the screen to the smallest size that the client's desktop fits in, and
+# then pull any windows that are now off the edge back into view.
+
+def pick_screen_size(sizes, wanted):
+    """Returns the smallest of 'sizes' that is at least as big as 'wanted' in
+    both directions, or the biggest if none of them are; or None if there
+    are no sizes at all."""
+    if not sizes:
+        return None
+    (wanted_w, wanted_h) = wanted
+    def area(size):
+        return size[0] * size[1]
+    big_enough = [(w, h) for (w, h) in sizes
+                  if w >= wanted_w and h >= wanted_h]
+    if big_enough:
+        return min(big_enough, key=area)
+    return max(sizes, key=area)
+
+def clamp_window_geometry(x, y, w, h, screen_w, screen_h):
+    """Returns (x, y, w, h) moved (and if need be, shrunk) so that the window
+    fits on a screen of size (screen_w, screen_h)."""
+    w = max(1, min(w, screen_w))
+    h = max(1, min(h, screen_h))
+    x = max(0, min(x, screen_w - w))
+    y = max(0, min(y, screen_h - h))
+    return (x, y, w, h)
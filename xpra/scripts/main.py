@@ -19,6 +19,9 @@ from xpra.platform import (XPRA_LOCAL_SERVERS_SUPPORTED,
                            DEFAULT_SSH_CMD,
                            GOT_PASSWORD_PROMPT_SUGGESTION)
 from xpra.protocol import TwoFileConnection, SocketConnection
+from xpra.encodings import ENCODERS
+from xpra.video import DEFAULT_REFRESH_DELAY
+from xpra.scaling import MIN_SCALE, MAX_SCALE
 
 def nox():
     if "DISPLAY" in os.environ:
@@ -38,7 +41,8 @@ def main(script_file, cmdline):
     ## NOTE NOTE NOTE
     #################################################################
     if XPRA_LOCAL_SERVERS_SUPPORTED:
-        start_str = "\t%prog start DISPLAY\n"
+        start_str = ("\t%prog start DISPLAY\n"
+                     "\t%prog shadow DISPLAY\n")
         list_str = "\t%prog list\n"
         upgrade_str = "\t%prog upgrade DISPLAY"
         note_str = ""
@@ -67,17 +71,72 @@ def main(script_file, cmdline):
                           help="Don't daemonize when running as a server")
         parser.add_option("--xvfb", action="store",
                           dest="xvfb", default="Xvfb", metavar="CMD",
-                          help="How to run the headless X server (default: '%default')")
+                          help="How to run the headless X server (default: '%default')."
+                          + " The screen is only fitted to the client's if"
+                          + " this offers several sizes through RandR")
         parser.add_option("--bind-tcp", action="store",
                           dest="bind_tcp", default=None,
                           metavar="[HOST]:PORT",
                           help="Listen for connections over TCP (insecure)")
+        parser.add_option("--refresh-delay", action="store",
+                          dest="refresh_delay", type="float",
+                          default=DEFAULT_REFRESH_DELAY, metavar="SECONDS",
+                          help="How long a window that was sent lossy video"
+                          + " updates must be left alone before it is sent"
+                          + " again losslessly. 0 disables switching to"
+                          + " lossy updates. Default: %default.")
+        parser.add_option("--encoding-threads", action="store",
+                          dest="encoding_threads", type="int", default=2,
+                          metavar="N",
+                          help="How many threads to encode window contents"
+                          + " on. 0 encodes on the main thread."
+                          + " Default: %default.")
+        parser.add_option("--encoding-rules", action="store",
+                          dest="encoding_rules", default=None,
+                          metavar="FILE",
+                          help="Pick how to send each window by its class,"
+                          + " title or type, following the rules in FILE"
+                          + " (re-read on SIGHUP)")
     parser.add_option("-z", "--compress", action="store",
                       dest="compression_level", type="int", default=3,
                       metavar="LEVEL",
                       help="How hard to work on compressing data."
                       + " 0 to disable compression,"
                       + " 9 for maximal (slowest) compression. Default: %default.")
+    parser.add_option("--encoding", action="store",
+                      dest="encoding", default=None, metavar="ENCODING",
+                      help="How to encode window contents: rgb24, png, jpeg,"
+                      + " rgb565 or palette"
+                      + " (default: rgb24, or whatever the server was"
+                      + " started with)")
+    parser.add_option("--quality", action="store",
+                      dest="quality", type="int", default=None,
+                      metavar="QUALITY",
+                      help="Picture quality for lossy encodings, between 1"
+                      + " and 100 (default: 80)")
+    parser.add_option("--tile-cache", action="store",
+                      dest="tile_cache_size", type="int", default=2048,
+                      metavar="TILES",
+                      help="How many window tiles to keep around for reuse"
+                      + " (each takes 12KB). 0 to disable. Default: %default.")
+    parser.add_option("--progressive", action="store_true",
+                      dest="progressive", default=False,
+                      help="On attach, get a quick low-quality preview of"
+                      + " every window before the real thing")
+    parser.add_option("--scale", action="store",
+                      dest="scale", type="int", default=100,
+                      metavar="PERCENT",
+                      help="Show windows at this percentage of their real"
+                      + " size, between %s and %s (default: %%default)"
+                      % (MIN_SCALE, MAX_SCALE))
+    parser.add_option("--read-only", action="store_true",
+                      dest="read_only", default=False,
+                      help="Just watch, alongside whoever else is attached,"
+                      + " without taking over or sending any input")
+    parser.add_option("--auto-depth", action="store_true",
+                      dest="auto_depth", default=False,
+                      help="Accept reduced colour depth while the link to"
+                      + " the server is congested")
     parser.add_option("--ssh", action="store",
                       dest="ssh", default=DEFAULT_SSH_CMD, metavar="CMD",
                       help="How to run ssh (default: '%default')")
@@ -107,8 +166,10 @@ def main(script_file, cmdline):
     logging.root.addHandler(logging.StreamHandler(sys.stderr))
 
     mode = args.pop(0)
+    check_encoding_options(parser, options)
     
-    if mode in ("start", "upgrade") and XPRA_LOCAL_SERVERS_SUPPORTED:
+    if (mode in ("start", "upgrade", "shadow")
+        and XPRA_LOCAL_SERVERS_SUPPORTED):
         nox()
         from xpra.scripts.server import run_server
         run_server(parser, options, mode, script_file, args)
@@ -234,12 +295,26 @@ def got_gibberish_msg(obj, data):
                          "Perhaps try using something like 'ssh:USER@host:display'?\n")
         sys.stdout.flush()
 
+def check_encoding_options(parser, opts):
+    if opts.encoding is not None and opts.encoding not in ENCODERS:
+        parser.error("Unknown encoding '%s' (must be one of: %s)"
+                     % (opts.encoding, ", ".join(sorted(ENCODERS))))
+    if opts.quality is not None and not (1 <= opts.quality <= 100):
+        parser.error("Quality must be between 1 and 100 inclusive.")
+
 def run_client(parser, opts, extra_args):
     from xpra.client import XpraClient
     conn = connect_or_fail(pick_display(parser, opts, extra_args))
     if opts.compression_level < 0 or opts.compression_level > 9:
         parser.error("Compression level must be between 0 and 9 inclusive.")
-    app = XpraClient(conn, opts.compression_level)
+    if opts.tile_cache_size < 0:
+        parser.error("Tile cache size cannot be negative.")
+    if not (MIN_SCALE <= opts.scale <= MAX_SCALE):
+        parser.error("Scale must be between %s and %s inclusive."
+                     % (MIN_SCALE, MAX_SCALE))
+    app = XpraClient(conn, opts.compression_level, opts.tile_cache_size,
+                     opts.encoding, opts.quality, opts.progressive,
+                     opts.scale, opts.read_only, opts.auto_depth)
     app.connect("handshake-complete", handshake_complete_msg)
     app.connect("received-gibberish", got_gibberish_msg)
     app.run()
@@ -18,6 +18,7 @@ import socket
 
 from xpra.wait_for_x_server import wait_for_x_server
 from xpra.dotxpra import DotXpra, ServerSockInUse
+from xpra.rules import EncodingRules, RulesError
 
 _cleanups = []
 def run_cleanups():
@@ -165,6 +166,18 @@ def run_server(parser, opts, mode, xpra_file, extra_args):
     if len(extra_args) != 1:
         parser.error("need exactly 1 extra argument")
     display_name = extra_args.pop(0)
+    if opts.refresh_delay < 0:
+        parser.error("--refresh-delay must not be negative")
+    if opts.encoding_threads < 0:
+        parser.error("--encoding-threads must not be negative")
+    rules = None
+    if opts.encoding_rules:
+        # (an absolute path, so that we can still find it to reload it once
+        # we have daemonized)
+        try:
+            rules = EncodingRules(os.path.abspath(opts.encoding_rules))
+        except RulesError, e:
+            parser.error("bad --encoding-rules: %s" % e)
 
     if opts.exit_with_children and not opts.children:
         print "--exit-with-children specified without any children to spawn; exiting immediately"
@@ -174,8 +187,11 @@ def run_server(parser, opts, mode, xpra_file, extra_args):
     signal.signal(signal.SIGINT, deadly_signal)
     signal.signal(signal.SIGTERM, deadly_signal)
 
-    assert mode in ("start", "upgrade")
+    assert mode in ("start", "upgrade", "shadow")
     upgrading = (mode == "upgrade")
+    # Shadowing a display that is already running, and that will go on
+    # running once we are gone:
+    shadowing = (mode == "shadow")
 
     dotxpra = DotXpra()
 
@@ -240,7 +256,7 @@ def run_server(parser, opts, mode, xpra_file, extra_args):
     # Do this after writing out the shell script:
     os.environ["DISPLAY"] = display_name
 
-    if not upgrading:
+    if not upgrading and not shadowing:
         # We need to set up a new server environment
         xauthority = os.environ.get("XAUTHORITY",
                                     os.path.expanduser("~/.Xauthority"))
@@ -252,8 +268,13 @@ def run_server(parser, opts, mode, xpra_file, extra_args):
                                     + [display_name,
                                        "-auth", xauthority,
                                        "+extension", "Composite",
+                                       # (Xvfb only offers its -screen size
+                                       # through this, so the screen is
+                                       # never fitted to the client's)
+                                       "+extension", "RANDR",
                                        # Biggest easily available monitors are
-                                       # 1920x1200. This is 1920*2 x 1920:
+                                       # 1920x1200. This is 1920*2 x 1920, as
+                                       # big as the screen can get:
                                        "-screen", "0", "3840x1920x24+32",
                                        "-once"],
                                     executable=xvfb_executable)
@@ -280,7 +301,9 @@ def run_server(parser, opts, mode, xpra_file, extra_args):
         default_display.close()
     manager.set_default_display(display)
 
-    if upgrading:
+    if shadowing:
+        xvfb_pid = None
+    elif upgrading:
         xvfb_pid = get_pid()
     else:
         xvfb_pid = xvfb.pid
@@ -291,7 +314,8 @@ def run_server(parser, opts, mode, xpra_file, extra_args):
             display.close()
         if xvfb_pid is not None:
             os.kill(xvfb_pid, signal.SIGTERM)
-    _cleanups.append(kill_xvfb)
+    if not shadowing:
+        _cleanups.append(kill_xvfb)
 
     if xvfb_pid is not None:
         save_pid(xvfb_pid)
@@ -301,9 +325,20 @@ def run_server(parser, opts, mode, xpra_file, extra_args):
     if opts.bind_tcp:
         sockets.append(create_tcp_socket(parser, opts.bind_tcp))
 
-    # This import is delayed because the module depends on gtk:
-    import xpra.server
-    app = xpra.server.XpraServer(upgrading, sockets)
+    # These imports are delayed because the modules depend on gtk:
+    if shadowing:
+        import xpra.shadow_server
+        app = xpra.shadow_server.XpraShadowServer(sockets,
+                                                  opts.encoding, opts.quality,
+                                                  opts.refresh_delay,
+                                                  opts.encoding_threads,
+                                                  rules)
+    else:
+        import xpra.server
+        app = xpra.server.XpraServer(upgrading, sockets,
+                                     opts.encoding, opts.quality,
+                                     opts.refresh_delay, opts.encoding_threads,
+                                     rules)
     def cleanup_socket(self):
         print "removing socket"
         try:
@@ -312,6 +347,11 @@ def run_server(parser, opts, mode, xpra_file, extra_args):
             pass
     _cleanups.append(cleanup_socket)
 
+    def reload_rules(signum, frame):
+        # Not something to do from inside a signal handler:
+        gobject.idle_add(app.reload_rules)
+    signal.signal(signal.SIGHUP, reload_rules)
+
     child_reaper = ChildReaper(app, opts.exit_with_children)
     # Always register the child reaper, because even if exit_with_children is
     # false, we still need to reap them somehow to avoid zombies:
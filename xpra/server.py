@@ -4,8 +4,6 @@
 # later version. See the file COPYING for details.
 
 # Todo:
-#   cursors
-#   xsync resize stuff
 #   shape?
 #   any other interesting metadata? _NET_WM_TYPE, WM_TRANSIENT_FOR, etc.?
 
@@ -13,6 +11,7 @@ import gtk
 import gobject
 import cairo
 import sys
+import time
 import subprocess
 
 from wimpiggy.wm import Wm
@@ -25,7 +24,11 @@ from wimpiggy.lowlevel import (get_rectangle_from_region,
                                xtest_fake_button,
                                is_override_redirect, is_mapped,
                                add_event_receiver,
-                               get_children)
+                               get_children,
+                               xfixes_select_cursor_input,
+                               get_cursor_image,
+                               xrandr_get_screen_sizes,
+                               xrandr_set_screen_size)
 from wimpiggy.prop import prop_set
 from wimpiggy.window import OverrideRedirectWindowModel, Unmanageable
 from wimpiggy.keys import grok_modifier_map
@@ -37,6 +40,27 @@ log = Logger()
 import xpra
 from xpra.protocol import Protocol, SocketConnection
 from xpra.keys import mask_to_names
+from xpra.tiles import (CapturedPixels, TileState, TileCache, TILE_SIZE,
+                        align_to_tiles, iter_tiles, merge_tile_runs,
+                        tile_key, hit_rate)
+from xpra.encodings import (ENCODERS, LOSSLESS, REDUCED_DEPTH,
+                            DEFAULT_QUALITY, clamp_quality)
+from xpra.video import (VideoDetector, VIDEO_QUALITY, VIDEO_FRAME_INTERVAL,
+                        DEFAULT_REFRESH_DELAY)
+from xpra.executor import InlineExecutor, UpdateQueue, make_executor
+from xpra.scheduler import (DamageScheduler, DEFAULT_SLACK, FOCUS_SLACK,
+                            OVERRIDE_REDIRECT_SLACK)
+from xpra.cursors import CURSOR_CACHE_SIZE, cursor_key
+from xpra.icons import ICON_CACHE_SIZE, icon_key, fit_icon_size
+from xpra.scaling import (clamp_scale, scale_value, unscale_value,
+                          scale_rect, unscale_point, scale_size_constraints)
+from xpra.sharing import EncodeCache
+from xpra.screen import pick_screen_size, clamp_window_geometry
+from xpra.classify import (classify_tile, merge_fills,
+                           SOLID, LOW_COLOUR, CONTINUOUS)
+from xpra.depth import LinkMonitor
+from xpra.rules import (EncodingRules, RulesError, PRIORITY_SLACKS,
+                        window_type_name)
 from xpra.xposix.xclipboard import ClipboardProtocolHelper
 from xpra.xposix.xsettings import XSettingsManager
 
@@ -63,6 +87,12 @@ class DesktopManager(gtk.Widget):
     def window_geometry(self, model):
         return self._models[model].geom
 
+    def client_position(self, model):
+        """Where the client shows the window, in its root coordinates.  We
+        put the window in the same place here."""
+        (x, y, _, _) = self._models[model].geom
+        return (x, y)
+
     def show_window(self, model):
         self._models[model].shown = True
         model.ownership_election()
@@ -119,62 +149,880 @@ gobject.type_register(DesktopManager)
 
 class ServerSource(object):
     # Strategy: if we have ordinary packets to send, send those.  When we
-    # don't, then send window updates.
-    def __init__(self, protocol):
+    # don't, then send window updates.  Windows waiting for a preview go
+    # first, then the focused window, then the rest.
+    #
+    # Window contents have to be captured on the main thread (which owns the
+    # X connection), as does everything that touches the tile state and the
+    # mirror of the client's tile cache.  Encoding the captured pixels is
+    # handed to the executor; the resulting packets go out strictly in the
+    # order they were queued, whatever order the encoding finishes in, so
+    # the client never sees a window's updates out of order (and performs
+    # its cache operations in the same order we did).
+    PREVIEW_QUALITY = 20
+
+    def __init__(self, protocol, capabilities,
+                 refresh_delay=DEFAULT_REFRESH_DELAY, executor=None,
+                 encode_cache=None, fetch_damage=None, profiles=None):
         self._ordinary_packets = []
         self._protocol = protocol
+        # id -> (window, region, options); the options (e.g. "encoding")
+        # apply to all of the pending region:
         self._damage = {}
+        # Which of the windows in _damage goes next:
+        self._schedule = DamageScheduler()
+        self._encodings = capabilities.get("encodings", ["rgb24"])
+        # Window id 0 holds the default for windows that have not had an
+        # encoding set specifically:
+        self._window_encodings = {0: (capabilities.get("encoding", "rgb24"),
+                                      capabilities.get("quality",
+                                                       DEFAULT_QUALITY))}
+        # Likewise for the scale (in percent) the client shows windows at:
+        self._window_scales = {0: capabilities.get("scale", 100)}
+        # id -> what the server's encoding rules say about that window (see
+        # xpra.rules), kept up to date by the server:
+        if profiles is None:
+            profiles = {}
+        self._profiles = profiles
+        # Window updates that have been captured but not yet handed to the
+        # protocol layer.  We don't capture any more of a window while it has
+        # updates still being encoded, so a busy window's damage piles up (and
+        # merges) instead of its frames:
+        self._updates = UpdateQueue()
+        if executor is None:
+            executor = InlineExecutor()
+        self._executor = executor
+        # Shared with any other clients, so that we don't all encode the same
+        # pixels (see xpra.sharing):
+        self._encode_cache = encode_cache
+        # Fetching a window's damage takes it off the X server's hands, so
+        # when there are other clients, the fetching is left to something
+        # that hands the damage out to all of them:
+        self._fetch = fetch_damage
+        self._poke_pending = False
+        # Windows the client can't currently show (minimised, say); their
+        # damage just accumulates until they come back:
+        self._paused = set()
+        # On a progressive attach, id -> rank for the windows which still
+        # need a quick preview; they go first, in rank order:
+        self._previews = {}
+        self.focus = 0
+        self._closed = False
+        # Things to do once we have nothing better to send:
+        self._idle_callbacks = []
+        self._tile_states = {}
+        # A mirror of the client's tile cache (keys only):
+        self._client_tiles = TileCache(capabilities.get("tile_cache_size", 0))
+        # Tiles of a single colour can be sent as just that colour:
+        self._send_fills = bool(capabilities.get("fills"))
+        # Likewise for its cursor cache; clients that can't show our cursors
+        # don't get sent any:
+        self._send_cursors = bool(capabilities.get("cursors"))
+        self._client_cursors = TileCache(CURSOR_CACHE_SIZE)
+        # ...and its icon cache:
+        self.icon_size = capabilities.get("icon_size")
+        self._client_icons = TileCache(ICON_CACHE_SIZE)
+        # id -> the metadata the client has for that window (with icons
+        # just as their keys), so that we only send it what changed:
+        self._window_metadata = {}
+        # Windows that look like they are playing video get a lossy encoding
+        # at a reduced frame rate, and a refresh with their usual encoding
+        # once they have been left alone for 'refresh_delay' seconds (0 turns
+        # all of this off):
+        self._refresh_delay = refresh_delay
+        self._video = {}
+        self._last_update = {}
+        self._refresh_timers = {}
+        self._wakeup_timer = None
+        self._wakeup_at = None
+        # Clients that asked for it get reduced colour depth while the link
+        # is congested, and a full depth refresh of whatever was sent that
+        # way once it recovers (id -> window):
+        self._auto_depth = bool(capabilities.get("auto_depth"))
+        self._link = LinkMonitor()
+        self._reduced_depth = {}
+        # While there are any of those, we keep checking on the link even
+        # if nothing is being sent:
+        self._link_timer = None
+        self.stats = {"tiles-unchanged": 0,
+                      "tiles-sent": 0,
+                      "tiles-referenced": 0,
+                      "tiles-filled": 0,
+                      "tiles-solid": 0,
+                      "tiles-low-colour": 0,
+                      "tiles-continuous": 0,
+                      "scrolls": 0,
+                      "rows-scrolled": 0,
+                      "video-on": 0,
+                      "video-off": 0,
+                      "refreshes": 0,
+                      "depth-reduced": 0,
+                      "depth-restored": 0,
+                      "previews": 0,
+                      "popup-updates": 0,
+                      "cursors-sent": 0,
+                      "cursors-referenced": 0}
         protocol.source = self
         if self._have_more():
             protocol.source_has_more()
 
     def _have_more(self):
-        return bool(self._ordinary_packets) or bool(self._damage)
+        return (bool(self._ordinary_packets) or self._update_ready()
+                or self._ready_damage()[0] is not None)
+
+    def _update_ready(self):
+        return self._updates.ready()
+
+    def _pop_update(self):
+        (packet, failed) = self._updates.pop()
+        if failed is not None:
+            self._resend(*failed)
+        return packet
+
+    def _resend(self, id, window, rect, keys):
+        # The client will never see the tiles that were to go with the
+        # update, so it never adds them to its cache:
+        for key in keys:
+            self._client_tiles.discard(key)
+        # (unless the window has gone since)
+        if id in self._last_update:
+            log.info("sending window %s's update again as rgb24", id)
+            (x, y, w, h) = rect
+            self._add_damage(id, window, x, y, w, h,
+                             {"encoding": "rgb24", "refresh": True})
+            # The protocol won't come back for more on its own, as there was
+            # nothing for it to send this time:
+            self.poke_later()
+
+    def _submit_draw(self, id, window, x, y, w, h, pixels, encoding, quality,
+                     extra, keys=()):
+        job = self._executor.submit(self._job_done, self._encode_draw,
+                                    id, x, y, w, h, pixels,
+                                    encoding, quality, extra)
+        self._updates.append_job(id, job, (id, window, (x, y, w, h), keys))
+
+    def _job_done(self, job):
+        # Called from a worker thread:
+        gobject.idle_add(self._wake_up_for_job)
+
+    def _wake_up_for_job(self):
+        if not self._closed and self._update_ready():
+            self._protocol.source_has_more()
+        return False
+
+    def close(self):
+        self._closed = True
+        for timer in self._refresh_timers.values():
+            gobject.source_remove(timer)
+        self._refresh_timers.clear()
+        if self._wakeup_timer is not None:
+            gobject.source_remove(self._wakeup_timer)
+            self._wakeup_timer = None
+            self._wakeup_at = None
+        if self._link_timer is not None:
+            gobject.source_remove(self._link_timer)
+            self._link_timer = None
+        self.log_stats()
+
+    def poke_later(self):
+        """Lets the protocol know we may have more to send, from the main
+        loop; unlike poking it directly, this is safe to do from within any
+        client's next_packet()."""
+        if not self._poke_pending:
+            self._poke_pending = True
+            gobject.idle_add(self._poke)
+
+    def _poke(self):
+        self._poke_pending = False
+        if not self._closed:
+            self._send_or_wait()
+        return False
+
+    def _send_or_wait(self):
+        # Pokes the protocol if there is something to send now, or else makes
+        # sure that we wake up once there is:
+        if self._have_more():
+            self._protocol.source_has_more()
+        else:
+            (_, wait) = self._ready_damage()
+            if wait is not None:
+                self._wake_up_in(wait)
 
     def queue_ordinary_packet(self, packet):
         assert self._protocol
         self._ordinary_packets.append(packet)
         self._protocol.source_has_more()
 
+    def send_cursor(self, cursor):
+        if not self._send_cursors:
+            return
+        (key, xhot, yhot, width, height, pixels) = cursor
+        if key in self._client_cursors:
+            self._client_cursors.touch(key)
+            self.stats["cursors-referenced"] += 1
+            self.queue_ordinary_packet(["cursor-ref", key])
+        else:
+            self._client_cursors.add(key)
+            self.stats["cursors-sent"] += 1
+            self.queue_ordinary_packet(["cursor", key, xhot, yhot,
+                                        width, height, pixels])
+
+    def icon_metadata(self, icon):
+        """Returns what to send as the "icon" metadata for 'icon' (a tuple
+        of (key, width, height, data)): the whole thing the first time, and
+        just the key after that."""
+        (key, width, height, data) = icon
+        if key in self._client_icons:
+            self._client_icons.touch(key)
+            return [key]
+        self._client_icons.add(key)
+        return [key, width, height, "premult_argb32", data]
+
+    def metadata_changes(self, id, metadata):
+        """Returns the part of 'metadata' that the client doesn't already have
+        for window 'id', ready to send, and records it as sent."""
+        sent = self._window_metadata.setdefault(id, {})
+        changes = {}
+        for (key, value) in metadata.iteritems():
+            if key == "icon":
+                if sent.get(key) != value[0]:
+                    sent[key] = value[0]
+                    changes[key] = self.icon_metadata(value)
+            elif sent.get(key) != value:
+                sent[key] = value
+                changes[key] = value
+        return changes
+
+    def forget_window(self, id):
+        self._window_metadata.pop(id, None)
+
     def cancel_damage(self, id):
+        # Note that we do *not* throw away packets that were already encoded
+        # for this window: the client's tile cache has to see every one of
+        # them to stay in sync with ours.  The client ignores updates for
+        # windows it no longer knows about.
         if id in self._damage:
             del self._damage[id]
-        
-    def damage(self, id, window, x, y, w, h):
+        self._schedule.remove(id)
+        self.forget_contents(id)
+        self._cancel_refresh(id)
+        for d in (self._video, self._last_update, self._reduced_depth,
+                  self._previews):
+            if id in d:
+                del d[id]
+
+    def forget_contents(self, id):
+        # Called whenever the client's copy of a window's contents may no
+        # longer match what we sent it (e.g. because it threw away or resized
+        # its backing), so that the next update sends everything:
+        if id in self._tile_states:
+            del self._tile_states[id]
+
+    def damage(self, id, window, x, y, w, h, options=None):
+        self._add_damage(id, window, x, y, w, h, options)
+        self._protocol.source_has_more()
+
+    def _add_damage(self, id, window, x, y, w, h, options=None):
+        # Unlike damage(), this does not poke the protocol, so it is safe to
+        # use from within next_packet():
         log("damage %s (%s, %s, %s, %s)", id, x, y, w, h)
-        window, region = self._damage.setdefault(id,
-                                                 (window, gtk.gdk.Region()))
+        window, region, damage_options = self._damage.setdefault(id,
+            (window, gtk.gdk.Region(), {}))
         region.union_with_rect(gtk.gdk.Rectangle(x, y, w, h))
+        if options:
+            damage_options.update(options)
+        self._schedule_window(id, window)
+
+    def contents_changed(self, id, window):
+        # The X server has collected some damage for this window; we fetch it
+        # once we get around to processing the window, by which time more of
+        # it may have piled up.
+        self._damage.setdefault(id, (window, gtk.gdk.Region(), {}))
+        self._schedule_window(id, window)
         self._protocol.source_has_more()
 
+    def _schedule_window(self, id, window):
+        profile = self._profiles.get(id)
+        if isinstance(window, OverrideRedirectWindowModel):
+            slack = OVERRIDE_REDIRECT_SLACK
+        elif profile is not None and profile.priority is not None:
+            slack = PRIORITY_SLACKS[profile.priority]
+            if id == self.focus:
+                slack = min(slack, FOCUS_SLACK)
+        elif id == self.focus:
+            slack = FOCUS_SLACK
+        else:
+            slack = DEFAULT_SLACK
+        self._schedule.add(id, time.time(), slack)
+
+    def _fetch_damage(self, id):
+        window = self._damage[id][0]
+        if self._fetch is not None:
+            # (which calls our damage_fetched(), among others)
+            self._fetch(self, id, window)
+        else:
+            self.damage_fetched(id, window, window.fetch_damage())
+
+    def damage_fetched(self, id, window, rects):
+        """Adds the damage 'rects' that were just fetched for window 'id', by
+        us or by another client.  Does not poke the protocol."""
+        if not rects:
+            return
+        if id not in self._damage:
+            self._damage[id] = (window, gtk.gdk.Region(), {})
+            self._schedule_window(id, window)
+        region = self._damage[id][1]
+        area = 0
+        for (x, y, w, h) in rects:
+            region.union_with_rect(gtk.gdk.Rectangle(x, y, w, h))
+            area += w * h
+        if area and self._refresh_delay > 0:
+            self._watch_for_video(id, window, area)
+
+    def _watch_for_video(self, id, window, area):
+        (_, _, window_w, window_h) = window.get_property("geometry")
+        detector = self._video.setdefault(id, VideoDetector())
+        if detector.record(time.time(), area, window_w * window_h):
+            if detector.is_video:
+                log.info("window %s looks like video, switching to lossy"
+                         " updates", id)
+                self.stats["video-on"] += 1
+            else:
+                self._video_stopped(id, window)
+                return
+        if detector.is_video:
+            # Each new bit of damage puts the refresh off a little longer:
+            self._cancel_refresh(id)
+            delay = int(self._refresh_delay * 1000)
+            self._refresh_timers[id] = gobject.timeout_add(
+                delay, self._video_idle, id, window)
+
+    def _video_idle(self, id, window):
+        del self._refresh_timers[id]
+        self._video[id].idle()
+        self._video_stopped(id, window)
+        self._protocol.source_has_more()
+        return False
+
+    def _video_stopped(self, id, window):
+        log.info("window %s stopped looking like video, refreshing it", id)
+        self.stats["video-off"] += 1
+        self.stats["refreshes"] += 1
+        self._cancel_refresh(id)
+        # The client has lossy versions of tiles that may not have changed
+        # since, so send the whole window again, whatever we think it has:
+        (_, _, w, h) = window.get_property("geometry")
+        self._add_damage(id, window, 0, 0, w, h, {"refresh": True})
+
+    def _cancel_refresh(self, id):
+        if id in self._refresh_timers:
+            gobject.source_remove(self._refresh_timers.pop(id))
+
+    def set_paused(self, id, paused):
+        if paused:
+            log("pausing updates for window %s", id)
+            self._paused.add(id)
+        elif id in self._paused:
+            log("resuming updates for window %s", id)
+            self._paused.remove(id)
+            if id in self._damage:
+                # Whatever piled up in the meantime goes out as a single
+                # update, rather than replaying every little change:
+                self._fetch_damage(id)
+                (window, region, options) = self._damage[id]
+                self._damage[id] = (window,
+                                    gtk.gdk.region_rectangle(
+                                        region.get_clipbox()),
+                                    options)
+                # Time spent paused doesn't count against it:
+                self._schedule.remove(id)
+                self._schedule_window(id, window)
+                self._protocol.source_has_more()
+
+    def preview_windows(self, ids):
+        """Asks for a low-quality preview of each of the windows 'ids' to be
+        sent before anything else, in the given order.  Each is followed by a
+        proper update once all of the previews are out."""
+        if "jpeg" not in self._encodings:
+            return
+        for (rank, id) in enumerate(ids):
+            self._previews[id] = rank
+
+    def _is_video(self, id):
+        return id in self._video and self._video[id].is_video
+
+    def can_encode(self, encoding):
+        """Whether 'encoding' was agreed on with this client."""
+        return encoding in self._encodings
+
+    def set_encoding(self, id, encoding, quality):
+        assert encoding in self._encodings
+        self._window_encodings[id] = (encoding, clamp_quality(quality))
+
+    def set_scale(self, id, scale):
+        if id == 0:
+            # Resets any per-window scales, like the client does:
+            self._window_scales = {0: scale}
+        else:
+            self._window_scales[id] = scale
+
+    def scale_for(self, id):
+        return self._window_scales.get(id, self._window_scales[0])
+
+    def _encoding_for(self, id, options):
+        (encoding, quality) = self._window_encodings[0]
+        profile = self._profiles.get(id)
+        if id in self._window_encodings:
+            (encoding, quality) = self._window_encodings[id]
+        elif profile is not None:
+            # What the client asked for this window takes precedence over
+            # the encoding rules, which take precedence over what it asked
+            # for in general:
+            if profile.encoding in self._encodings:
+                encoding = profile.encoding
+            if profile.quality is not None:
+                quality = profile.quality
+        # A single update may ask for something different:
+        if options.get("encoding") in self._encodings:
+            encoding = options["encoding"]
+        if "quality" in options:
+            quality = clamp_quality(options["quality"])
+        elif (self._is_video(id) and "encoding" not in options
+              and not options.get("refresh") and "jpeg" in self._encodings):
+            (encoding, quality) = ("jpeg", min(quality, VIDEO_QUALITY))
+        # (png is usually smaller than raw rgb565 already)
+        if (self._link.is_constrained and "encoding" not in options
+            and encoding == "rgb24" and "rgb565" in self._encodings):
+            encoding = "rgb565"
+        return (encoding, quality)
+
+    def _check_link(self):
+        if not self._auto_depth:
+            return
+        if not self._link.record(time.time(), self._protocol.write_wait):
+            return
+        if self._link.is_constrained:
+            log.info("link to client is congested, reducing colour depth")
+            self.stats["depth-reduced"] += 1
+            return
+        log.info("link to client recovered, back to full colour depth")
+        self.stats["depth-restored"] += 1
+        self.stats["refreshes"] += len(self._reduced_depth)
+        for (id, window) in self._reduced_depth.items():
+            (_, _, w, h) = window.get_property("geometry")
+            self._add_damage(id, window, 0, 0, w, h, {"refresh": True})
+        self._reduced_depth = {}
+
+    def _sent_reduced_depth(self, id, window):
+        self._reduced_depth[id] = window
+        if self._link_timer is None:
+            self._link_timer = gobject.timeout_add(
+                int(self._link.period * 1000), self._poll_link)
+
+    def _poll_link(self):
+        # Once the windows stop changing, there is no damage to check the
+        # link for us, but they still need restoring once it recovers:
+        self._check_link()
+        if self._reduced_depth:
+            return True
+        self._link_timer = None
+        if self._damage:
+            self._protocol.source_has_more()
+        return False
+
+    def _encode(self, encoding, quality, width, height, data):
+        encoded = ENCODERS[encoding](width, height, data, quality)
+        if encoding in LOSSLESS and len(encoded) >= len(data):
+            # Compressing made things worse (noise, say), so don't bother:
+            return ("rgb24", data)
+        return (encoding, encoded)
+
+    def _encode_draw(self, id, x, y, w, h, pixels, encoding, quality, extra):
+        # Runs on the executor, so must not touch anything but its arguments:
+        data = pixels.tile_data(x, y, w, h)
+        if self._encode_cache is not None:
+            (coding, data) = self._encode_cache.encode(self._encode, encoding,
+                                                       quality, w, h, data)
+        else:
+            (coding, data) = self._encode(encoding, quality, w, h, data)
+        return ["draw", id, x, y, w, h, coding, data] + extra
+
     def next_packet(self):
         if self._ordinary_packets:
             packet = self._ordinary_packets.pop(0)
-        elif self._damage:
-            id, (window, damage) = self._damage.items()[0]
+        else:
+            # Damage that turns out not to have changed anything produces no
+            # packets, so keep going until we find some that does.  While the
+            # first update is still being encoded, this also gets the other
+            # windows captured and encoding in the meantime:
+            while not self._update_ready():
+                (id, wait) = self._ready_damage()
+                if id is None:
+                    if wait is not None:
+                        self._wake_up_in(wait)
+                    break
+                self._process_damage(id)
+            if self._update_ready():
+                packet = self._pop_update()
+            else:
+                packet = None
+        more = self._have_more()
+        if not more and not self._updates and self._idle_callbacks:
+            gobject.idle_add(self._run_idle_callbacks)
+        return packet, more
+
+    def when_idle(self, callback):
+        """Calls 'callback' once, as soon as all the updates that can be sent
+        have been."""
+        self._idle_callbacks.append(callback)
+        if not self._have_more() and not self._updates:
+            gobject.idle_add(self._run_idle_callbacks)
+
+    def _run_idle_callbacks(self):
+        callbacks = self._idle_callbacks
+        self._idle_callbacks = []
+        if not self._closed:
+            for callback in callbacks:
+                callback()
+        return False
+
+    def _ready_damage(self):
+        # Returns (id, None) for a window whose damage can be sent right now,
+        # or (None, wait) if all the damaged windows are either paused, still
+        # being encoded, or video that was updated too recently (in which
+        # case the first will be ready in 'wait' seconds).
+        now = time.time()
+        waits = []
+        def is_ready(id):
+            if self._updates.in_flight(id) or id in self._paused:
+                return False
+            if id not in self._damage:
+                return False
+            window = self._damage[id][0]
+            if isinstance(window, OverrideRedirectWindowModel):
+                # (popups don't do video, and shouldn't be held back)
+                return True
+            if window.get_property("sync-pending"):
+                # Still repainting after a resize:
+                return False
+            last_update = self._last_update.get(id, 0)
+            delays = []
+            if self._is_video(id):
+                delays.append(last_update + VIDEO_FRAME_INTERVAL - now)
+            profile = self._profiles.get(id)
+            if profile is not None:
+                if profile.max_fps:
+                    delays.append(last_update + 1.0 / profile.max_fps - now)
+                arrival = self._schedule.arrival(id)
+                if profile.delay and arrival is not None:
+                    # Let the damage pile up for a bit:
+                    delays.append(arrival + profile.delay - now)
+            if not delays:
+                return True
+            delay = max(delays)
+            if delay <= 0:
+                return True
+            waits.append(delay)
+            return False
+        # Previews go before anything else, in the order we were given:
+        for id in sorted(self._previews, key=self._previews.get):
+            if id in self._damage and is_ready(id):
+                return (id, None)
+        id = self._schedule.next(is_ready)
+        if id is not None:
+            return (id, None)
+        return (None, waits and min(waits) or None)
+
+    def _wake_up_in(self, wait):
+        # Something that became ready sooner than what the pending timer is
+        # waiting for (e.g. a newly focused window) must not wait for it:
+        at = time.time() + wait
+        if self._wakeup_timer is not None:
+            if self._wakeup_at <= at:
+                return
+            gobject.source_remove(self._wakeup_timer)
+        self._wakeup_timer = gobject.timeout_add(int(wait * 1000) + 1,
+                                                 self._wake_up)
+        self._wakeup_at = at
+
+    def _wake_up(self):
+        self._wakeup_timer = None
+        self._wakeup_at = None
+        self._send_or_wait()
+        return False
+
+    def _process_damage(self, id):
+        self._check_link()
+        # It's important to fetch (and so acknowledge) changes *before* we
+        # extract them, to avoid a race condition.
+        self._fetch_damage(id)
+        (window, damage, options) = self._damage[id]
+        now = time.time()
+        self._schedule.served(id, now)
+        if damage.empty():
+            del self._damage[id]
+            return
+        self._last_update[id] = now
+        if id in self._previews:
+            # The preview covers all of the window's damage in one go, and
+            # the whole window gets sent properly later:
+            del self._previews[id]
+            clip = damage.get_clipbox()
+            (x, y, w, h) = (clip.x, clip.y, clip.width, clip.height)
+            del self._damage[id]
+            options = dict(options)
+            options.update({"encoding": "jpeg",
+                            "quality": self.PREVIEW_QUALITY})
+            self.stats["previews"] += 1
+            (_, _, window_w, window_h) = window.get_property("geometry")
+            self._add_damage(id, window, 0, 0, window_w, window_h,
+                             {"refresh": True})
+        else:
             (x, y, w, h) = get_rectangle_from_region(damage)
             rect = gtk.gdk.Rectangle(x, y, w, h)
             damage.subtract(gtk.gdk.region_rectangle(rect))
             if damage.empty():
                 del self._damage[id]
-            # It's important to acknowledge changes *before* we extract them,
-            # to avoid a race condition.
-            window.acknowledge_changes(x, y, w, h)
-            pixmap = window.get_property("client-contents")
-            if pixmap is None:
-                log.error("wtf, pixmap is None?")
-                packet = None
             else:
-                (x2, y2, w2, h2, data) = self._get_rgb_data(pixmap, x, y, w, h)
-                if not w2 or not h2:
-                    packet = None
-                else:
-                    packet = ["draw", id, x2, y2, w2, h2, "rgb24", data]
+                # The rest waits its turn behind everyone else:
+                self._schedule_window(id, window)
+        pixmap = window.get_property("client-contents")
+        if pixmap is None:
+            log.error("wtf, pixmap is None?")
+            return
+        (pixmap_w, pixmap_h) = pixmap.get_size()
+        scale = self.scale_for(id)
+        if isinstance(window, OverrideRedirectWindowModel):
+            self._process_popup_damage(id, pixmap, x, y, w, h, scale)
+            return
+        if scale != 100:
+            self._process_scaled_damage(id, window, pixmap, x, y, w, h, scale,
+                                        options)
+            return
+        # Capture whole tiles, so that we can tell which of them actually
+        # changed since we last sent them:
+        (x, y, w, h) = align_to_tiles(x, y, w, h, pixmap_w, pixmap_h)
+        pixels = self._get_rgb_data(pixmap, x, y, w, h)
+        if pixels is None:
+            return
+        (w, h) = (pixels.width, pixels.height)
+        tile_state = self._tile_states.setdefault(id, TileState())
+        if options.get("refresh"):
+            tile_state.forget_rect(x, y, w, h)
+        copied_rows = None
+        if x == 0 and w == pixmap_w:
+            # We have whole rows, so we can check whether the window scrolled,
+            # and if so have the client move what it already has:
+            rows = pixels.row_digests()
+            scroll = tile_state.detect_scroll(y, rows, w)
+            if scroll is not None:
+                (dy, y1, y2) = scroll
+                log("damage %s: rows %s-%s scrolled by %s", id, y1, y2, dy,
+                    type="tiles")
+                self._updates.append(["copy-area", id,
+                                             0, y1 - dy, w, y2 - y1, 0, y1])
+                copied_rows = (y1, y2)
+                self.stats["scrolls"] += 1
+                self.stats["rows-scrolled"] += y2 - y1
+            tile_state.set_rows(y, rows, w)
+        else:
+            tile_state.forget_rows(y, h)
+        changed = tile_state.changed_tiles(pixels, x, y, w, h, copied_rows)
+        (encoding, quality) = self._encoding_for(id, options)
+        tile_count = len(list(iter_tiles(x, y, w, h)))
+        log("damage %s: %s of %s tiles changed", id, len(changed), tile_count,
+            type="tiles")
+        self.stats["tiles-unchanged"] += tile_count - len(changed)
+        # Each changed tile goes out according to what is in it: tiles of a
+        # single colour as fills, tiles with few colours losslessly (unless
+        # this update asked for a particular encoding; at reduced depth, a
+        # palette of their own colours is lossless too), and the rest with
+        # the window's encoding.
+        encoding_for_class = {CONTINUOUS: (encoding, quality)}
+        if "encoding" in options or encoding in LOSSLESS:
+            encoding_for_class[LOW_COLOUR] = (encoding, quality)
+        elif encoding in REDUCED_DEPTH and "palette" in self._encodings:
+            encoding_for_class[LOW_COLOUR] = ("palette", quality)
+        elif "png" in self._encodings:
+            encoding_for_class[LOW_COLOUR] = ("png", quality)
         else:
-            packet = None
-        return packet, self._have_more()
+            encoding_for_class[LOW_COLOUR] = ("rgb24", quality)
+        encoding_for_class[SOLID] = encoding_for_class[LOW_COLOUR]
+        if self._link.is_constrained and encoding in REDUCED_DEPTH:
+            self._sent_reduced_depth(id, window)
+        # Tiles the client has cached are sent by reference.  The client
+        # performs its cache operations in packet order, so we must do ours
+        # in the same order: first all the references (which go out first, in
+        # a single packet), then the additions, tile by tile.  Tiles sent
+        # with a lossy encoding are not cached, as the client does not have
+        # the pixels we have for them.  Fills are too cheap to be worth
+        # caching.
+        cache = self._client_tiles
+        fills = []
+        refs = []
+        uncached = {}
+        keys = {}
+        for (tx, ty, tw, th, digest) in changed:
+            (kind, colour) = classify_tile(pixels, tx, ty, tw, th)
+            self.stats["tiles-" + kind] += 1
+            if kind == SOLID and self._send_fills:
+                fills.append([tx, ty, tw, th, colour])
+                continue
+            key = tile_key(tw, th, digest)
+            if key in cache:
+                cache.touch(key)
+                refs.append([tx, ty, tw, th, key])
+            else:
+                uncached.setdefault(encoding_for_class[kind], []).append(
+                    (tx, ty, tw, th))
+                keys[(tx, ty)] = key
+        if refs:
+            self._updates.append(["tile-ref", id, refs])
+        if fills:
+            self._updates.append(["fill", id, merge_fills(fills)])
+        self.stats["tiles-referenced"] += len(refs)
+        self.stats["tiles-filled"] += len(fills)
+        # Tiles that share an encoding are batched together, and if they
+        # make up the whole capture, they go out in one piece:
+        for ((encoding, quality), tiles) in sorted(uncached.items()):
+            self.stats["tiles-sent"] += len(tiles)
+            if len(tiles) == tile_count:
+                rects = [(x, y, w, h)]
+            else:
+                rects = merge_tile_runs(tiles)
+            cache_new_tiles = cache.capacity and encoding in LOSSLESS
+            for (rx, ry, rw, rh) in rects:
+                extra = []
+                rect_keys = []
+                if cache_new_tiles:
+                    rect_keys = [keys[(tx, ty)] for (tx, ty, _, _)
+                                 in iter_tiles(rx, ry, rw, rh)]
+                    for key in rect_keys:
+                        cache.add(key)
+                    extra.append({"tiles": rect_keys})
+                self._submit_draw(id, window, rx, ry, rw, rh, pixels,
+                                  encoding, quality, extra, rect_keys)
+
+    def _process_scaled_damage(self, id, window, pixmap, x, y, w, h, scale,
+                               options):
+        # The client has nothing to compare scaled pixels against, so there
+        # are no tiles, scrolling, or caching here; just the pixels:
+        pixels = self._capture(pixmap, x, y, w, h, scale)
+        if pixels is None:
+            return
+        (encoding, quality) = self._encoding_for(id, options)
+        if self._link.is_constrained and encoding in REDUCED_DEPTH:
+            self._sent_reduced_depth(id, window)
+        self._submit_draw(id, window, pixels.x, pixels.y,
+                          pixels.width, pixels.height, pixels,
+                          encoding, quality, [])
+
+    def _capture(self, pixmap, x, y, w, h, scale):
+        if scale != 100:
+            return self._get_scaled_rgb_data(pixmap, x, y, w, h, scale)
+        return self._get_rgb_data(pixmap, x, y, w, h)
+
+    def _process_popup_damage(self, id, pixmap, x, y, w, h, scale):
+        # Menus, tooltips and the like are small, short-lived and the user is
+        # waiting for them, so they skip the tiles, the cache and the encoder
+        # threads, and go out as plain rgb24 (the protocol's compression
+        # still applies) ahead of whatever else is waiting to be sent.
+        pixels = self._capture(pixmap, x, y, w, h, scale)
+        if pixels is None:
+            return
+        data = pixels.tile_data(pixels.x, pixels.y,
+                                pixels.width, pixels.height)
+        packet = ["draw", id, pixels.x, pixels.y, pixels.width, pixels.height,
+                  "rgb24", data]
+        # Not being cached, these can jump the queue without confusing the
+        # client's tile cache -- but not each other:
+        self._updates.jump_queue(id, packet)
+        self.stats["popup-updates"] += 1
+
+    def capture_popup(self, id, window):
+        """Returns the current contents of the whole of (new, override
+        redirect) window 'id', as [width, height, coding, data] to go on the
+        end of its new-override-redirect packet, or None if it doesn't have
+        any yet.  The caller must have fetched the window's damage first, as
+        in _process_damage, so that anything drawn from then on gets
+        noticed."""
+        pixmap = window.get_property("client-contents")
+        if pixmap is None:
+            return None
+        (w, h) = pixmap.get_size()
+        pixels = self._capture(pixmap, 0, 0, w, h, self.scale_for(id))
+        if pixels is None:
+            return None
+        self.stats["popup-updates"] += 1
+        return [pixels.width, pixels.height, "rgb24",
+                pixels.tile_data(pixels.x, pixels.y,
+                                 pixels.width, pixels.height)]
+
+    def log_stats(self):
+        stats = self.stats
+        changed = stats["tiles-sent"] + stats["tiles-referenced"]
+        log.info("tiles: %s unchanged, %s sent, %s from client cache"
+                 " (hit rate %s)",
+                 stats["tiles-unchanged"], stats["tiles-sent"],
+                 stats["tiles-referenced"],
+                 hit_rate(stats["tiles-referenced"], changed))
+        classified = (stats["tiles-solid"] + stats["tiles-low-colour"]
+                      + stats["tiles-continuous"])
+        log.info("tile contents: %s solid, %s low-colour, %s continuous-tone;"
+                 " %s sent as fills",
+                 hit_rate(stats["tiles-solid"], classified),
+                 hit_rate(stats["tiles-low-colour"], classified),
+                 hit_rate(stats["tiles-continuous"], classified),
+                 stats["tiles-filled"])
+        log.info("scrolling: %s scrolls detected, %s rows copied",
+                 stats["scrolls"], stats["rows-scrolled"])
+        log.info("video: %s windows switched to lossy updates, %s back,"
+                 " %s refreshes",
+                 stats["video-on"], stats["video-off"], stats["refreshes"])
+        if self._auto_depth:
+            log.info("colour depth: reduced %s times for a congested link,"
+                     " restored %s times",
+                     stats["depth-reduced"], stats["depth-restored"])
+        if stats["previews"]:
+            log.info("attach: %s window previews sent", stats["previews"])
+        if stats["popup-updates"]:
+            log.info("popups: %s updates sent the fast way",
+                     stats["popup-updates"])
+        if len(self._schedule.latency):
+            log.info("damage latency: %s", self._schedule.latency.summary())
+        if self._send_cursors:
+            log.info("cursors: %s sent, %s from client cache",
+                     stats["cursors-sent"], stats["cursors-referenced"])
+        if self._encode_cache is not None and self._encode_cache.hits:
+            log.info("sharing: %s updates encoded, %s more reused by other"
+                     " clients",
+                     self._encode_cache.misses, self._encode_cache.hits)
 
     def _get_rgb_data(self, pixmap, x, y, width, height):
+        pixbuf = self._get_pixbuf(pixmap, x, y, width, height)
+        if pixbuf is None:
+            return None
+        # The rows of the pixbuf may be padded; CapturedPixels knows how to
+        # skip over that when it slices out the parts we actually send.
+        return CapturedPixels(x, y, pixbuf.get_width(), pixbuf.get_height(),
+                              pixbuf.get_pixels(), pixbuf.get_rowstride())
+
+    def _get_scaled_rgb_data(self, pixmap, x, y, width, height, scale):
+        pixbuf = self._get_pixbuf(pixmap, x, y, width, height)
+        if pixbuf is None:
+            return None
+        (width, height) = (pixbuf.get_width(), pixbuf.get_height())
+        (sx, sy, sw, sh) = scale_rect(x, y, width, height, scale)
+        scaled = gtk.gdk.Pixbuf(gtk.gdk.COLORSPACE_RGB, False, 8, sw, sh)
+        # Position the capture where it falls in the scaled window, so that
+        # neighbouring updates line up:
+        f = scale / 100.0
+        pixbuf.scale(scaled, 0, 0, sw, sh, x * f - sx, y * f - sy, f, f,
+                     gtk.gdk.INTERP_BILINEAR)
+        return CapturedPixels(sx, sy, sw, sh,
+                              scaled.get_pixels(), scaled.get_rowstride())
+
+    def _get_pixbuf(self, pixmap, x, y, width, height):
         pixmap_w, pixmap_h = pixmap.get_size()
         # Just in case we somehow end up with damage larger than the pixmap,
         # we don't want to start requesting random chunks of memory (this
@@ -187,68 +1035,134 @@ class ServerSource(object):
         if y + height > pixmap_h:
             height = pixmap_h - y
         if width <= 0 or height <= 0:
-            return (0, 0, 0, 0, "")
+            return None
         pixbuf = gtk.gdk.Pixbuf(gtk.gdk.COLORSPACE_RGB, False, 8, width, height)
         pixbuf.get_from_drawable(pixmap, pixmap.get_colormap(),
                                  x, y, 0, 0, width, height)
-        raw_data = pixbuf.get_pixels()
-        rowwidth = width * 3
-        rowstride = pixbuf.get_rowstride()
-        if rowwidth == rowstride:
-            data = raw_data
-        else:
-            rows = []
-            for i in xrange(height):
-                rows.append(raw_data[i*rowstride : i*rowstride+rowwidth])
-            data = "".join(rows)
-        return (x, y, width, height, data)
+        return pixbuf
 
 class XpraServer(gobject.GObject):
     __gsignals__ = {
         "wimpiggy-child-map-event": one_arg_signal,
+        "wimpiggy-cursor-event": one_arg_signal,
         }
 
-    def __init__(self, clobber, sockets):
+    def __init__(self, clobber, sockets, encoding=None, quality=None,
+                 refresh_delay=DEFAULT_REFRESH_DELAY, encoding_threads=0,
+                 rules=None):
         gobject.GObject.__init__(self)
-        
+
+        # Used for clients which don't ask for anything in particular:
+        self._default_encoding = encoding or "rgb24"
+        self._default_quality = quality or DEFAULT_QUALITY
+        self._refresh_delay = refresh_delay
+        # Shared by all clients:
+        self._executor = make_executor(encoding_threads)
+        # How to send which windows, and what that says for each window (by
+        # id):
+        if rules is None:
+            rules = EncodingRules()
+        self._rules = rules
+        self._window_profiles = {}
+
         # Do this before creating the Wm object, to avoid clobbering its
         # selecting SubstructureRedirect.
         root = gtk.gdk.get_default_root_window()
         root.set_events(root.get_events() | gtk.gdk.SUBSTRUCTURE_MASK)
         add_event_receiver(root, self)
 
-        # This must happen early, before loading in windows at least:
+        # This must happen early, before loading in windows (or looking at
+        # the cursor) at least.  The client in control, if any, and any
+        # read-only viewers:
         self._protocol = None
+        self._viewers = []
         self._potential_protocols = []
+        self._encode_cache = EncodeCache()
+
+        # X cursor serial -> (key, xhot, yhot, width, height, pixels), so
+        # that switching back to a cursor we have seen costs no round trip:
+        self._cursors = TileCache(CURSOR_CACHE_SIZE)
+        self._cursor = None
+        self._cursors_supported = False
+        # (raw icon digest, size) -> (key, width, height, data), so that we
+        # don't keep shrinking the same icons:
+        self._icons = TileCache(ICON_CACHE_SIZE)
+        # window -> names of its properties that changed since we last sent
+        # metadata:
+        self._pending_metadata = {}
+        self._metadata_timer = None
+        # window -> the size the client most recently asked for:
+        self._pending_resizes = {}
+        # On attach, the ids of windows the client has yet to map; once it
+        # has mapped (and we have drawn) all of them, it gets the rest of
+        # their metadata:
+        self._awaiting_map = set()
+        self._resize_timer = None
+        try:
+            xfixes_select_cursor_input(root)
+        except ValueError, e:
+            log.warn("Not forwarding cursors: %s", e)
+        else:
+            self._cursors_supported = True
+            self._cursor_changed(None)
+
+        ### Create our window managing data structures:
+        self._window_to_id = {}
+        self._id_to_window = {}
+        # Window id 0 is reserved for "not a window"
+        self._max_window_id = 1
+        self._setup_windows(clobber)
 
+        ### Set up keymap:
+        self._keymap = gtk.gdk.keymap_get_default()
+        self._keymap.connect("keys-changed", self._keys_changed)
+        self._keys_changed()
+        self._setup_modifiers()
+
+        ### Clipboard handling:
+        self._clipboard_helper = ClipboardProtocolHelper(
+            self._send_to_controller)
+
+        ### Misc. state:
+        self._settings = {}
+        self._xsettings_manager = None
+        self._has_focus = 0
+        self._upgrading = False
+
+        ### All right, we're ready to accept customers:
+        for sock in sockets:
+            self.add_listen_socket(sock)
+
+    def _setup_windows(self, clobber):
         ### Create the WM object
         self._wm = Wm("Xpra", clobber)
         self._wm.connect("new-window", self._new_window_signaled)
         self._wm.connect("quit", lambda _: self.quit(True))
 
-        ### Create our window managing data structures:
         self._desktop_manager = DesktopManager()
         self._wm.get_property("toplevel").add(self._desktop_manager)
         self._desktop_manager.show_all()
 
-        self._window_to_id = {}
-        self._id_to_window = {}
-        # Window id 0 is reserved for "not a window"
-        self._max_window_id = 1
-
         ### Load in existing windows:
         for window in self._wm.get_property("windows"):
             self._add_new_window(window)
 
-        for window in get_children(root):
+        for window in get_children(gtk.gdk.get_default_root_window()):
             if (is_override_redirect(window) and is_mapped(window)):
                 self._add_new_or_window(window)
 
-        ### Set up keymap:
-        self._keymap = gtk.gdk.keymap_get_default()
-        self._keymap.connect("keys-changed", self._keys_changed)
-        self._keys_changed()
+    # The keys we press to get each of the modifiers a client asks for:
+    _keyname_for_mod = {
+        "shift": "Shift_L",
+        "control": "Control_L",
+        "meta": "Meta_L",
+        "super": "Super_L",
+        "hyper": "Hyper_L",
+        "alt": "Alt_L",
+        }
 
+    def _setup_modifiers(self):
+        # Make sure the keys in _keyname_for_mod exist, and do what we expect:
         try:
             xmodmap = subprocess.Popen(["xmodmap", "-"], stdin=subprocess.PIPE)
         except OSError, e:
@@ -277,27 +1191,6 @@ class XpraServer(gobject.GObject):
                             # Really stupid hack to force backspace to work.
                             # Remove this once we have real keymap support.
                             + "keycode any = BackSpace")
-        self._keyname_for_mod = {
-            "shift": "Shift_L",
-            "control": "Control_L",
-            "meta": "Meta_L",
-            "super": "Super_L",
-            "hyper": "Hyper_L",
-            "alt": "Alt_L",
-            }
-
-        ### Clipboard handling:
-        self._clipboard_helper = ClipboardProtocolHelper(self._send)
-
-        ### Misc. state:
-        self._settings = {}
-        self._xsettings_manager = None
-        self._has_focus = 0
-        self._upgrading = False
-
-        ### All right, we're ready to accept customers:
-        for sock in sockets:
-            self.add_listen_socket(sock)
 
     def add_listen_socket(self, sock):
         sock.listen(5)
@@ -325,12 +1218,40 @@ class XpraServer(gobject.GObject):
     def _new_window_signaled(self, wm, window):
         self._add_new_window(window)
 
+    def do_wimpiggy_cursor_event(self, event):
+        self._cursor_changed(event.cursor_serial)
+
+    def _cursor_changed(self, serial):
+        if serial is not None and serial in self._cursors:
+            self._cursor = self._cursors.touch(serial)
+        else:
+            image = get_cursor_image(gtk.gdk.get_default_root_window())
+            if image is None:
+                return
+            (serial, xhot, yhot, width, height, pixels) = image
+            key = cursor_key(xhot, yhot, width, height, pixels)
+            self._cursor = (key, xhot, yhot, width, height, pixels)
+            self._cursors.add(serial, self._cursor)
+        for source in self._sources():
+            source.send_cursor(self._cursor)
+
     def do_wimpiggy_child_map_event(self, event):
         raw_window = event.window
         if event.override_redirect:
             self._add_new_or_window(raw_window)
 
-    _window_export_properties = ("title", "size-hints")
+    _window_export_properties = ("title", "size-hints", "icon")
+    # Metadata that is too bulky to hold up a client's attach with; it gets
+    # sent once the windows have been drawn (or when the client asks):
+    _lazy_metadata = ("icon",)
+
+    # Metadata changes are sent at most this often (in milliseconds), so that
+    # applications that animate their titles don't flood the client:
+    METADATA_DELAY = 100
+    # Likewise for resizing windows when the client asks, so that dragging a
+    # window's edge doesn't have the application repaint at every size in
+    # between:
+    RESIZE_DELAY = 50
 
     def _add_new_window_common(self, window):
         id = self._max_window_id
@@ -345,10 +1266,59 @@ class XpraServer(gobject.GObject):
         self._add_new_window_common(window)
         for prop in self._window_export_properties:
             window.connect("notify::%s" % prop, self._update_metadata)
+        for prop in self._profile_properties:
+            window.connect("notify::%s" % prop, self._update_profile)
+        self._update_profile(window)
+        window.connect("notify::sync-pending", self._sync_pending_changed)
         (x, y, w, h, depth) = window.get_property("client-window").get_geometry()
         self._desktop_manager.add_window(window, x, y, w, h)
         self._send_new_window_packet(window)
 
+    # What the encoding rules look at:
+    _profile_properties = ("class-instance", "title", "window-type",
+                           "transient-for")
+
+    def _window_description(self, window):
+        c_i = window.get_property("class-instance") or (None, None)
+        types = [window_type_name(str(atom))
+                 for atom in window.get_property("window-type") or []]
+        return {"class": c_i[0], "instance": c_i[1],
+                "title": window.get_property("title"), "type": types,
+                "transient": bool(window.get_property("transient-for"))}
+
+    def _update_profile(self, window, pspec=None):
+        id = self._window_to_id[window]
+        profile = self._rules.profile_for(self._window_description(window))
+        old_profile = self._window_profiles.get(id)
+        if profile == old_profile:
+            return
+        log("window %s: encoding profile %s", id, profile)
+        self._window_profiles[id] = profile
+        if (old_profile is not None
+            and (profile.encoding, profile.quality)
+                != (old_profile.encoding, old_profile.quality)
+            and self._desktop_manager.visible(window)):
+            # Have the clients' copies of the window redone the new way:
+            (_, _, w, h) = window.get_property("geometry")
+            self._damage(window, 0, 0, w, h, {"refresh": True})
+
+    def reload_rules(self):
+        """Re-reads the encoding rules file (e.g. on SIGHUP), and applies it
+        to every window."""
+        if self._rules.filename is None:
+            log.info("No encoding rules file to reload")
+            return False
+        try:
+            self._rules.load()
+        except RulesError, e:
+            log.warn("Keeping the old encoding rules: %s", e)
+            return False
+        log.info("Reloaded the encoding rules from %s", self._rules.filename)
+        for window in self._window_to_id.keys():
+            if not isinstance(window, OverrideRedirectWindowModel):
+                self._update_profile(window)
+        return False
+
     def _add_new_or_window(self, raw_window):
         log("Discovered new override-redirect window")
         try:
@@ -360,17 +1330,28 @@ class XpraServer(gobject.GObject):
         self._send_new_or_window_packet(window)
 
     def _or_window_geometry_changed(self, window, pspec):
+        for source in self._sources():
+            self._send_or_window_geometry(source, window)
+
+    def _send_or_window_geometry(self, source, window):
         (x, y, w, h) = window.get_property("geometry")
         id = self._window_to_id[window]
-        self._send(["configure-override-redirect", id, x, y, w, h])
+        # The client makes a new backing for the window, so whatever it had
+        # before can't be relied on:
+        source.forget_contents(id)
+        scale = source.scale_for(id)
+        source.queue_ordinary_packet(["configure-override-redirect", id, x, y,
+                                      scale_value(w, scale),
+                                      scale_value(h, scale)])
 
     # These are the names of WindowModel properties that, when they change,
     # trigger updates in the xpra window metadata:
     _all_metadata = ("title", "size-hints", "class-instance", "icon", "client-machine")
 
     # Takes the name of a WindowModel property, and returns a dictionary of
-    # xpra window metadata values that depend on that property:
-    def _make_metadata(self, window, propname):
+    # xpra window metadata values that depend on that property, for the
+    # client whose ServerSource is 'source':
+    def _make_metadata(self, window, propname, source):
         assert propname in self._all_metadata
         if propname == "title":
             if window.get_property("title") is not None:
@@ -400,11 +1381,9 @@ class XpraServer(gobject.GObject):
         elif propname == "icon":
             surf = window.get_property("icon")
             if surf is not None:
-                assert surf.get_format() == cairo.FORMAT_ARGB32
-                assert surf.get_stride() == 4 * surf.get_width()
-                return {"icon": (surf.get_width(), surf.get_height(),
-                                 "premult_argb32", str(surf.get_data()))
-                        }
+                # (ServerSource.metadata_changes turns this into what we
+                # actually send)
+                return {"icon": self._prepare_icon(surf, source.icon_size)}
             else:
                 return {}
         elif propname == "client-machine":
@@ -448,63 +1427,218 @@ class XpraServer(gobject.GObject):
                 window = self._id_to_window[id]
                 window.give_client_focus()
             self._has_focus = id
+            for source in self._sources():
+                source.focus = id
 
     def _move_pointer(self, pos):
         (x, y) = pos
         display = gtk.gdk.display_get_default()
         display.warp_pointer(display.get_default_screen(), x, y)
 
+    def _sources(self):
+        """Returns the ServerSources of all the attached clients, the one in
+        control (if any) first."""
+        protocols = list(self._viewers)
+        if self._protocol is not None:
+            protocols.insert(0, self._protocol)
+        return [proto.source for proto in protocols
+                if proto.source is not None]
+
     def _send(self, packet):
+        log("Queuing packet: %s", packet)
+        for source in self._sources():
+            source.queue_ordinary_packet(packet)
+
+    def _viewer_sources(self):
+        return [proto.source for proto in self._viewers
+                if proto.source is not None]
+
+    def _send_geometry_to_viewers(self, window, resized):
+        # Viewers see the windows where the client in control puts them:
+        id = self._window_to_id[window]
+        (x, y, w, h) = self._desktop_manager.window_geometry(window)
+        for source in self._viewer_sources():
+            if resized:
+                # The viewer makes a new backing for the window, so whatever
+                # it had before can't be relied on:
+                source.forget_contents(id)
+            scale = source.scale_for(id)
+            source.queue_ordinary_packet(["configure-window", id, x, y,
+                                          scale_value(w, scale),
+                                          scale_value(h, scale)])
+
+    def _send_unmap_to_viewers(self, window):
+        id = self._window_to_id[window]
+        for source in self._viewer_sources():
+            source.queue_ordinary_packet(["unmap-window", id])
+
+    def _send_to_controller(self, packet):
         if self._protocol is not None:
             log("Queuing packet: %s", packet)
             self._protocol.source.queue_ordinary_packet(packet)
 
-    def _damage(self, window, x, y, width, height):
-        if self._protocol is not None and self._protocol.source is not None:
-            id = self._window_to_id[window]
-            self._protocol.source.damage(id, window, x, y, width, height)
+    def _damage(self, window, x, y, width, height, options=None):
+        id = self._window_to_id[window]
+        for source in self._sources():
+            source.damage(id, window, x, y, width, height, options)
         
+    def _contents_dirty(self, window):
+        id = self._window_to_id[window]
+        for source in self._sources():
+            source.contents_changed(id, window)
+
     def _cancel_damage(self, window):
-        if self._protocol is not None and self._protocol.source is not None:
-            id = self._window_to_id[window]
-            self._protocol.source.cancel_damage(id)
-            
-    def _send_new_window_packet(self, window):
+        id = self._window_to_id[window]
+        for source in self._sources():
+            source.cancel_damage(id)
+
+    def _fetch_damage(self, fetcher, id, window):
+        # Whichever client gets around to the window first fetches its damage
+        # for everyone, since once fetched, it's gone:
+        rects = window.fetch_damage()
+        for source in self._sources():
+            source.damage_fetched(id, window, rects)
+            if source is not fetcher and rects:
+                source.poke_later()
+
+    def _client_metadata(self, source, id, metadata):
+        scale = source.scale_for(id)
+        if scale != 100 and "size-constraints" in metadata:
+            metadata["size-constraints"] = scale_size_constraints(
+                metadata["size-constraints"], scale)
+        return source.metadata_changes(id, metadata)
+
+    def _send_new_window_packet(self, window, lazy=False, sources=None):
         id = self._window_to_id[window]
         (x, y, w, h) = self._desktop_manager.window_geometry(window)
-        metadata = {}
-        for propname in self._all_metadata:
-            metadata.update(self._make_metadata(window, propname))
-        self._send(["new-window", id, x, y, w, h, metadata])
-
-    def _send_new_or_window_packet(self, window):
+        if sources is None:
+            sources = self._sources()
+        for source in sources:
+            metadata = {}
+            for propname in self._all_metadata:
+                if lazy and propname in self._lazy_metadata:
+                    continue
+                metadata.update(self._make_metadata(window, propname, source))
+            scale = source.scale_for(id)
+            source.queue_ordinary_packet(
+                ["new-window", id, x, y,
+                 scale_value(w, scale), scale_value(h, scale),
+                 self._client_metadata(source, id, metadata)])
+
+    def _send_new_or_window_packet(self, window, sources=None):
         id = self._window_to_id[window]
         (x, y, w, h) = window.get_property("geometry")
-        self._send(["new-override-redirect", id, x, y, w, h, {}])
-        self._damage(window, 0, 0, w, h)
+        if sources is None:
+            sources = self._sources()
+        # Popups are usually drawn by the time we hear about them, so save a
+        # round of damage handling and send their contents straight away.
+        # Fetch first, so that anything drawn from now on gets noticed, and
+        # hand what was fetched to every client, since clients that already
+        # know about this window (when 'sources' is just a new viewer) still
+        # need it:
+        self._fetch_damage(None, id, window)
+        for source in sources:
+            scale = source.scale_for(id)
+            packet = ["new-override-redirect", id, x, y,
+                      scale_value(w, scale), scale_value(h, scale), {}]
+            contents = source.capture_popup(id, window)
+            if contents is not None:
+                source.queue_ordinary_packet(packet + contents)
+            else:
+                source.queue_ordinary_packet(packet)
+                source.damage(id, window, 0, 0, w, h)
 
     def _update_metadata(self, window, pspec):
-        id = self._window_to_id[window]
-        metadata = self._make_metadata(window, pspec.name)
-        self._send(["window-metadata", id, metadata])
+        self._metadata_changed(window, pspec.name)
+
+    def _metadata_changed(self, window, propname):
+        self._pending_metadata.setdefault(window, set()).add(propname)
+        if self._metadata_timer is None:
+            self._metadata_timer = gobject.timeout_add(self.METADATA_DELAY,
+                                                       self._flush_metadata)
+
+    def _flush_metadata(self):
+        self._metadata_timer = None
+        pending = self._pending_metadata
+        self._pending_metadata = {}
+        for (window, propnames) in pending.iteritems():
+            if window not in self._window_to_id:
+                continue
+            id = self._window_to_id[window]
+            for source in self._sources():
+                metadata = {}
+                for propname in propnames:
+                    metadata.update(self._make_metadata(window, propname,
+                                                        source))
+                metadata = self._client_metadata(source, id, metadata)
+                if metadata:
+                    source.queue_ordinary_packet(["window-metadata", id,
+                                                  metadata])
+        return False
+
+    def _sync_pending_changed(self, window, pspec):
+        # The window has finished repainting after being resized, so any
+        # damage we held back can go now:
+        if not window.get_property("sync-pending"):
+            for source in self._sources():
+                source.poke_later()
 
     def _lost_window(self, window, wm_exiting):
         id = self._window_to_id[window]
         self._send(["lost-window", id])
         self._cancel_damage(window)
+        self._pending_metadata.pop(window, None)
+        self._pending_resizes.pop(window, None)
+        self._window_profiles.pop(id, None)
+        self._window_mapped(id)
+        for source in self._sources():
+            source.forget_window(id)
         del self._window_to_id[window]
         del self._id_to_window[id]
 
     def _contents_changed(self, window, event):
         if (isinstance(window, OverrideRedirectWindowModel)
             or self._desktop_manager.visible(window)):
-            self._damage(window, event.x, event.y, event.width, event.height)
+            self._contents_dirty(window)
+
+    # The most tiles we are willing to track for a client's cache:
+    MAX_TILE_CACHE = 16384
 
     def _calculate_capabilities(self, client_capabilities):
         capabilities = {}
         for cap in ("deflate", "__prerelease_version"):
             if cap in client_capabilities:
                 capabilities[cap] = client_capabilities[cap]
+        if client_capabilities.get("tile_cache_size"):
+            capabilities["tile_cache_size"] = min(
+                client_capabilities["tile_cache_size"], self.MAX_TILE_CACHE)
+            capabilities["tile_size"] = TILE_SIZE
+        # rgb24 is always available, so we can always fall back on it:
+        encodings = [e for e in client_capabilities.get("encodings", [])
+                     if e in ENCODERS and e != "rgb24"]
+        capabilities["encodings"] = ["rgb24"] + encodings
+        if (client_capabilities.get("progressive")
+            and "jpeg" in capabilities["encodings"]):
+            capabilities["progressive"] = True
+        if client_capabilities.get("fills"):
+            capabilities["fills"] = True
+        if (client_capabilities.get("auto_depth")
+            and "rgb565" in capabilities["encodings"]):
+            capabilities["auto_depth"] = True
+        if client_capabilities.get("cursors") and self._cursors_supported:
+            capabilities["cursors"] = True
+        if client_capabilities.get("icon_size"):
+            capabilities["icon_size"] = client_capabilities["icon_size"]
+        encoding = client_capabilities.get("encoding", self._default_encoding)
+        if encoding not in capabilities["encodings"]:
+            encoding = "rgb24"
+        capabilities["encoding"] = encoding
+        capabilities["quality"] = clamp_quality(
+            client_capabilities.get("quality", self._default_quality))
+        if "scale" in client_capabilities:
+            capabilities["scale"] = clamp_scale(client_capabilities["scale"])
+        if client_capabilities.get("read_only"):
+            capabilities["read_only"] = True
         if "desktop_size" in client_capabilities:
             client_w, client_h = client_capabilities["desktop_size"]
             (root_w, root_h) = gtk.gdk.get_default_root_window().get_size()
@@ -521,15 +1655,41 @@ class XpraServer(gobject.GObject):
                       + "of exactly the same version (v%s)", xpra.__version__)
             proto.close()
             return
-        # Okay, things are okay, so let's boot out any existing connection and
-        # set this as our new one:
-        if self._protocol is not None:
-            self._protocol.close()
-        self._protocol = proto
-        ServerSource(self._protocol)
-        self._send(["hello", capabilities])
+        read_only = capabilities.get("read_only", False)
+        if read_only:
+            # Viewers can come and go as they please:
+            log.info("Adding a read-only viewer")
+            self._viewers.append(proto)
+        else:
+            # Okay, things are okay, so let's boot out any existing client in
+            # control and set this as our new one (leaving any viewers be):
+            if self._protocol is not None:
+                self._protocol.source.close()
+                self._protocol.close()
+            self._protocol = proto
+            self._awaiting_map = set()
+            if "desktop_size" in client_capabilities:
+                (client_w, client_h) = client_capabilities["desktop_size"]
+                size = self._resize_screen(client_w, client_h)
+                if size is not None:
+                    capabilities["desktop_size"] = [min(client_w, size[0]),
+                                                    min(client_h, size[1])]
+        ServerSource(proto, capabilities, self._refresh_delay,
+                     self._executor, self._encode_cache, self._fetch_damage,
+                     self._window_profiles)
+        source = proto.source
+        self._encode_cache.enabled = len(self._sources()) > 1
+        source.focus = self._has_focus
+        source.queue_ordinary_packet(["hello", capabilities])
         if "deflate" in capabilities:
-            self._protocol.enable_deflate(capabilities["deflate"])
+            proto.enable_deflate(capabilities["deflate"])
+        if capabilities.get("progressive"):
+            # Popups are sent along with their contents anyway, and the
+            # quicker the better:
+            windows = self._id_to_window
+            source.preview_windows(
+                [id for id in self._stacking_order()
+                 if not isinstance(windows[id], OverrideRedirectWindowModel)])
         # We send the new-window packets sorted by id because this sorts them
         # from oldest to newest -- and preserving window creation order means
         # that the earliest override-redirect windows will be on the bottom,
@@ -538,10 +1698,96 @@ class XpraServer(gobject.GObject):
         for id in sorted(self._id_to_window.iterkeys()):
             window = self._id_to_window[id]
             if isinstance(window, OverrideRedirectWindowModel):
-                self._send_new_or_window_packet(window)
+                self._send_new_or_window_packet(window, [source])
+            elif read_only:
+                # Viewers see the windows where the client in control put
+                # them, and don't get to map them themselves:
+                self._send_new_window_packet(window, True, [source])
+                if self._desktop_manager.visible(window):
+                    (_, _, w, h) = self._desktop_manager.window_geometry(
+                        window)
+                    source.damage(id, window, 0, 0, w, h)
+                else:
+                    source.queue_ordinary_packet(["unmap-window", id])
             else:
                 self._desktop_manager.hide_window(window)
-                self._send_new_window_packet(window)
+                self._send_unmap_to_viewers(window)
+                self._send_new_window_packet(window, True, [source])
+                self._awaiting_map.add(id)
+        if read_only or not self._awaiting_map:
+            source.when_idle(self._send_lazy_metadata)
+        if self._cursor is not None:
+            source.send_cursor(self._cursor)
+
+    def _resize_screen(self, client_w, client_h):
+        # Returns the screen's new size, or None if it stayed as it was.
+        root = gtk.gdk.get_default_root_window()
+        try:
+            sizes = xrandr_get_screen_sizes(root)
+        except ValueError, e:
+            log("Not resizing the screen: %s", e)
+            return None
+        if len(sizes) < 2:
+            # (Xvfb, for one, only ever offers the size it started at)
+            log.info("Not resizing the screen: the X server only offers"
+                     " one size")
+            return None
+        size = pick_screen_size(sizes, (client_w, client_h))
+        if size is None or size == root.get_size():
+            return None
+        (screen_w, screen_h) = size
+        log.info("Resizing the screen to %sx%s, to fit the client's %sx%s",
+                 screen_w, screen_h, client_w, client_h)
+        if not xrandr_set_screen_size(root, screen_w, screen_h):
+            log.warn("Failed to resize the screen to %sx%s",
+                     screen_w, screen_h)
+            return None
+        # Bring back any windows that are now off the edge:
+        for window in self._window_to_id.iterkeys():
+            if isinstance(window, OverrideRedirectWindowModel):
+                continue
+            geometry = self._desktop_manager.window_geometry(window)
+            clamped = clamp_window_geometry(*(geometry + size))
+            if clamped != geometry:
+                self._desktop_manager.configure_window(window, *clamped)
+        return size
+
+    def _window_mapped(self, id):
+        if id in self._awaiting_map:
+            self._awaiting_map.remove(id)
+            if not self._awaiting_map and self._protocol is not None:
+                self._protocol.source.when_idle(self._send_lazy_metadata)
+
+    def _send_lazy_metadata(self):
+        for window in self._window_to_id.iterkeys():
+            if not isinstance(window, OverrideRedirectWindowModel):
+                for propname in self._lazy_metadata:
+                    self._metadata_changed(window, propname)
+
+    def _process_request_metadata(self, proto, packet):
+        (_, id) = packet
+        window = self._id_to_window.get(id)
+        if window is None or isinstance(window, OverrideRedirectWindowModel):
+            return
+        metadata = {}
+        for propname in self._lazy_metadata:
+            metadata.update(self._make_metadata(window, propname,
+                                                proto.source))
+        metadata = self._client_metadata(proto.source, id, metadata)
+        if metadata:
+            proto.source.queue_ordinary_packet(["window-metadata", id,
+                                                metadata])
+
+    def _stacking_order(self):
+        # Our best guess at the order the client will stack the windows in,
+        # topmost first: override-redirect windows (menus and the like) are
+        # above everything else, and newer windows above older ones.
+        ids = sorted(self._id_to_window.iterkeys(), reverse=True)
+        def is_or(id):
+            return isinstance(self._id_to_window[id],
+                              OverrideRedirectWindowModel)
+        return ([id for id in ids if is_or(id)]
+                + [id for id in ids if not is_or(id)])
 
     def _process_server_settings(self, proto, packet):
         (_, settings) = packet
@@ -563,19 +1809,51 @@ class XpraServer(gobject.GObject):
                 elif k == "pulse-server":
                     root_set("PULSE_SERVER")
 
+    def _prepare_icon(self, surf, size):
+        assert surf.get_format() == cairo.FORMAT_ARGB32
+        assert surf.get_stride() == 4 * surf.get_width()
+        (width, height) = (surf.get_width(), surf.get_height())
+        data = str(surf.get_data())
+        cache_key = (icon_key(width, height, data), size)
+        if cache_key in self._icons:
+            return self._icons.touch(cache_key)
+        if size:
+            (icon_w, icon_h) = fit_icon_size(width, height, size)
+        else:
+            (icon_w, icon_h) = (width, height)
+        if (icon_w, icon_h) != (width, height):
+            scaled = cairo.ImageSurface(cairo.FORMAT_ARGB32, icon_w, icon_h)
+            cr = cairo.Context(scaled)
+            cr.scale(float(icon_w) / width, float(icon_h) / height)
+            cr.set_source_surface(surf, 0, 0)
+            cr.paint()
+            scaled.flush()
+            assert scaled.get_stride() == 4 * icon_w
+            data = str(scaled.get_data())
+        icon = (icon_key(icon_w, icon_h, data), icon_w, icon_h, data)
+        self._icons.add(cache_key, icon)
+        return icon
+
     def _process_map_window(self, proto, packet):
         (_, id, x, y, width, height) = packet
+        scale = proto.source.scale_for(id)
+        (width, height) = (unscale_value(width, scale),
+                           unscale_value(height, scale))
         window = self._id_to_window[id]
         assert not isinstance(window, OverrideRedirectWindowModel)
+        self._pending_resizes.pop(window, None)
         self._desktop_manager.configure_window(window, x, y, width, height)
         self._desktop_manager.show_window(window)
+        self._send_geometry_to_viewers(window, True)
         self._damage(window, 0, 0, width, height)
+        self._window_mapped(id)
 
     def _process_unmap_window(self, proto, packet):
         (_, id) = packet
         window = self._id_to_window[id]
         assert not isinstance(window, OverrideRedirectWindowModel)
         self._desktop_manager.hide_window(window)
+        self._send_unmap_to_viewers(window)
         self._cancel_damage(window)
 
     def _process_move_window(self, proto, packet):
@@ -584,16 +1862,101 @@ class XpraServer(gobject.GObject):
         assert not isinstance(window, OverrideRedirectWindowModel)
         (_, _, w, h) = self._desktop_manager.window_geometry(window)
         self._desktop_manager.configure_window(window, x, y, w, h)
+        self._send_geometry_to_viewers(window, False)
 
     def _process_resize_window(self, proto, packet):
         (_, id, w, h) = packet
+        scale = proto.source.scale_for(id)
+        (w, h) = (unscale_value(w, scale), unscale_value(h, scale))
         window = self._id_to_window[id]
         assert not isinstance(window, OverrideRedirectWindowModel)
-        self._cancel_damage(window)
-        if self._desktop_manager.visible(window):
-            self._damage(window, 0, 0, w, h)
-        (x, y, _, _) = self._desktop_manager.window_geometry(window)
-        self._desktop_manager.configure_window(window, x, y, w, h)
+        self._pending_resizes[window] = (w, h)
+        if self._resize_timer is None:
+            self._resize_timer = gobject.timeout_add(self.RESIZE_DELAY,
+                                                     self._apply_resizes)
+
+    def _apply_resizes(self):
+        self._resize_timer = None
+        pending = self._pending_resizes
+        self._pending_resizes = {}
+        for (window, (w, h)) in pending.iteritems():
+            if window not in self._window_to_id:
+                continue
+            self._cancel_damage(window)
+            (x, y, _, _) = self._desktop_manager.window_geometry(window)
+            self._desktop_manager.configure_window(window, x, y, w, h)
+            if self._desktop_manager.visible(window):
+                self._send_geometry_to_viewers(window, True)
+                self._damage(window, 0, 0, w, h)
+        return False
+
+    def _process_encoding(self, proto, packet):
+        (_, id, encoding, quality) = packet
+        if id != 0 and id not in self._id_to_window:
+            return
+        if not proto.source.can_encode(encoding):
+            log.warn("client asked for encoding %s, which it did not offer"
+                     " or we cannot provide", encoding)
+            return
+        proto.source.set_encoding(id, encoding, quality)
+        # Repaint with the new encoding straight away:
+        if id == 0:
+            windows = self._id_to_window.values()
+        else:
+            windows = [self._id_to_window[id]]
+        for window in windows:
+            if (isinstance(window, OverrideRedirectWindowModel)
+                or self._desktop_manager.visible(window)):
+                (_, _, w, h) = window.get_property("geometry")
+                proto.source.damage(self._window_to_id[window], window,
+                                    0, 0, w, h)
+
+    def _process_window_state(self, proto, packet):
+        (_, id, state) = packet
+        paused = (state.get("iconified") or state.get("withdrawn")
+                  or state.get("obscured"))
+        proto.source.set_paused(id, bool(paused))
+
+    def _process_scale(self, proto, packet):
+        (_, id, scale) = packet
+        if id != 0 and id not in self._id_to_window:
+            return
+        proto.source.set_scale(id, clamp_scale(scale))
+        # The client resizes its windows itself; all we need to do is send
+        # them again at the new scale:
+        if id == 0:
+            windows = self._id_to_window.values()
+        else:
+            windows = [self._id_to_window[id]]
+        for window in windows:
+            if isinstance(window, OverrideRedirectWindowModel):
+                # The client only resizes its normal windows itself:
+                self._send_or_window_geometry(proto.source, window)
+            else:
+                # Its size constraints need scaling too:
+                self._metadata_changed(window, "size-hints")
+                if not self._desktop_manager.visible(window):
+                    continue
+            id = self._window_to_id[window]
+            proto.source.forget_contents(id)
+            (_, _, w, h) = window.get_property("geometry")
+            proto.source.damage(id, window, 0, 0, w, h)
+
+    def _unscale_pointer(self, proto, id, pointer):
+        # The client gives us the pointer in its root coordinates:
+        if id not in self._id_to_window:
+            return pointer
+        window = self._id_to_window[id]
+        if isinstance(window, OverrideRedirectWindowModel):
+            (x, y, _, _) = window.get_property("geometry")
+            (client_x, client_y) = (x, y)
+        else:
+            (x, y, _, _) = self._desktop_manager.window_geometry(window)
+            (client_x, client_y) = self._desktop_manager.client_position(
+                window)
+        (px, py) = pointer
+        pointer = (px - client_x + x, py - client_y + y)
+        return unscale_point((x, y), pointer, proto.source.scale_for(id))
 
     def _process_focus(self, proto, packet):
         (_, id) = packet
@@ -611,7 +1974,7 @@ class XpraServer(gobject.GObject):
         (_, id, button, depressed, pointer, modifiers) = packet
         self._make_keymask_match(modifiers)
         self._desktop_manager.raise_window(self._id_to_window[id])
-        self._move_pointer(pointer)
+        self._move_pointer(self._unscale_pointer(proto, id, pointer))
         try:
             trap.call_unsynced(xtest_fake_button,
                                gtk.gdk.display_get_default(),
@@ -625,7 +1988,7 @@ class XpraServer(gobject.GObject):
         (_, id, pointer, modifiers) = packet
         self._make_keymask_match(modifiers)
         self._desktop_manager.raise_window(self._id_to_window[id])
-        self._move_pointer(pointer)
+        self._move_pointer(self._unscale_pointer(proto, id, pointer))
 
     def _process_close_window(self, proto, packet):
         (_, id) = packet
@@ -642,7 +2005,12 @@ class XpraServer(gobject.GObject):
         if proto in self._potential_protocols:
             self._potential_protocols.remove(proto)
         if proto is self._protocol:
+            self._protocol.source.close()
             self._protocol = None
+        elif proto in self._viewers:
+            self._viewers.remove(proto)
+            proto.source.close()
+        self._encode_cache.enabled = len(self._sources()) > 1
 
     def _process_gibberish(self, proto, packet):
         (_, data) = packet
@@ -656,6 +2024,10 @@ class XpraServer(gobject.GObject):
         "move-window": _process_move_window,
         "resize-window": _process_resize_window,
         "focus": _process_focus,
+        "encoding": _process_encoding,
+        "window-state": _process_window_state,
+        "scale": _process_scale,
+        "request-metadata": _process_request_metadata,
         "key-action": _process_key_action,
         "button-action": _process_button_action,
         "pointer-position": _process_pointer_position,
@@ -666,8 +2038,18 @@ class XpraServer(gobject.GObject):
         Protocol.GIBBERISH: _process_gibberish,
         }
 
+    # All that read-only viewers get to do; anything that would change the
+    # windows, or pass input on to them, only comes from the client in
+    # control:
+    _viewer_packets = ("hello", "encoding", "window-state", "scale",
+                       "request-metadata",
+                       Protocol.CONNECTION_LOST, Protocol.GIBBERISH)
+
     def process_packet(self, proto, packet):
         packet_type = packet[0]
+        if proto in self._viewers and packet_type not in self._viewer_packets:
+            log("ignoring %s packet from read-only viewer", packet_type)
+            return
         if (isinstance(packet_type, str)
             and packet_type.startswith("clipboard-")):
             self._clipboard_helper.process_clipboard_packet(packet)
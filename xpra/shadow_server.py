@@ -0,0 +1,193 @@
+# This file is part of Parti.
+# Copyright (C) 2010 Nathaniel Smith <njs@pobox.com>
+# Parti is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+# Shadowing: rather than running its own X server and managing the windows on
+# it, the server attaches to a display somebody is already using (a physical
+# one, say) and sends the whole screen to the client as a single window.  The
+# screen goes through the same pipeline as any other window -- damage, tiles,
+# scrolling, the client's tile cache -- so the parts of it that don't change
+# cost next to nothing.
+#
+# We are a guest on this display, so we leave its windows, its window
+# manager, its keyboard mapping and its settings alone.
+
+import gtk
+import gobject
+import socket
+
+from wimpiggy.util import (AutoPropGObjectMixin, AdHocStruct,
+                           one_arg_signal)
+from wimpiggy.lowlevel import (xdamage_start, xdamage_fetch,
+                               add_event_receiver)
+from wimpiggy.error import *
+
+from wimpiggy.log import Logger
+log = Logger()
+
+from xpra.server import XpraServer
+from xpra.video import DEFAULT_REFRESH_DELAY
+
+class RootWindowModel(AutoPropGObjectMixin, gobject.GObject):
+    """Looks enough like a WindowModel for the server to treat the whole
+    screen as a window."""
+    __gsignals__ = {
+        "client-contents-changed": one_arg_signal,
+        "unmanaged": one_arg_signal,
+
+        "wimpiggy-damage-event": one_arg_signal,
+        }
+
+    __gproperties__ = {
+        "client-window": (gobject.TYPE_PYOBJECT,
+                          "", "", gobject.PARAM_READABLE),
+        "client-contents": (gobject.TYPE_PYOBJECT,
+                            "", "", gobject.PARAM_READABLE),
+        "geometry": (gobject.TYPE_PYOBJECT,
+                     "", "", gobject.PARAM_READABLE),
+        "title": (gobject.TYPE_PYOBJECT,
+                  "", "", gobject.PARAM_READABLE),
+        "size-hints": (gobject.TYPE_PYOBJECT,
+                       "", "", gobject.PARAM_READABLE),
+        "class-instance": (gobject.TYPE_PYOBJECT,
+                           "", "", gobject.PARAM_READABLE),
+        "icon": (gobject.TYPE_PYOBJECT,
+                 "", "", gobject.PARAM_READABLE),
+        "client-machine": (gobject.TYPE_PYOBJECT,
+                           "", "", gobject.PARAM_READABLE),
+        "window-type": (gobject.TYPE_PYOBJECT,
+                        "", "", gobject.PARAM_READABLE),
+        "transient-for": (gobject.TYPE_PYOBJECT,
+                          "", "", gobject.PARAM_READABLE),
+        "sync-pending": (gobject.TYPE_BOOLEAN,
+                         "", "", False, gobject.PARAM_READABLE),
+        }
+
+    def __init__(self, root):
+        super(RootWindowModel, self).__init__()
+        self._root = root
+        self._damage_handle = xdamage_start(root)
+        add_event_receiver(root, self)
+
+    def fetch_damage(self):
+        try:
+            return trap.call(xdamage_fetch, self._root, self._damage_handle)
+        except XError:
+            log("failed to fetch the screen's damage")
+            return []
+
+    def do_wimpiggy_damage_event(self, event):
+        self.emit("client-contents-changed", event)
+
+    def do_get_property_client_window(self, name):
+        return self._root
+
+    def do_get_property_client_contents(self, name):
+        # We can capture straight from the screen:
+        return self._root
+
+    def do_get_property_geometry(self, name):
+        (w, h) = self._root.get_size()
+        return (0, 0, w, h)
+
+    def do_get_property_title(self, name):
+        return u"%s on %s" % (gtk.gdk.display_get_default().get_name(),
+                              socket.gethostname())
+
+    def do_get_property_size_hints(self, name):
+        # The client can't resize the screen, so don't let it try:
+        hints = AdHocStruct()
+        for attr in ("base_size", "resize_inc",
+                     "min_aspect_ratio", "max_aspect_ratio"):
+            setattr(hints, attr, None)
+        hints.min_size = hints.max_size = self._root.get_size()
+        return hints
+
+    def do_get_property_client_machine(self, name):
+        return unicode(socket.gethostname())
+
+    def do_get_property_sync_pending(self, name):
+        return False
+
+    def give_client_focus(self):
+        pass
+
+    def request_close(self):
+        pass
+
+gobject.type_register(RootWindowModel)
+
+class ShadowDesktopManager(object):
+    """Stands in for xpra.server.DesktopManager.  The only window is the
+    screen, and that stays put whatever the client does with it; we just
+    remember where the client put it, to make sense of the pointer."""
+    def __init__(self):
+        self._client_positions = {}
+
+    def add_window(self, model, x, y, w, h):
+        self._client_positions[model] = (x, y)
+
+    def window_geometry(self, model):
+        return model.get_property("geometry")
+
+    def client_position(self, model):
+        return self._client_positions.get(model, (0, 0))
+
+    def show_window(self, model):
+        pass
+
+    def configure_window(self, model, x, y, w, h):
+        self._client_positions[model] = (x, y)
+
+    def hide_window(self, model):
+        pass
+
+    def visible(self, model):
+        return True
+
+    def raise_window(self, model):
+        pass
+
+class XpraShadowServer(XpraServer):
+    def __init__(self, sockets, encoding=None, quality=None,
+                 refresh_delay=DEFAULT_REFRESH_DELAY, encoding_threads=0,
+                 rules=None):
+        XpraServer.__init__(self, False, sockets, encoding, quality,
+                            refresh_delay, encoding_threads, rules)
+
+    def _setup_windows(self, clobber):
+        # No window manager: whoever is using the display has their own.
+        self._wm = None
+        self._desktop_manager = ShadowDesktopManager()
+        root = gtk.gdk.get_default_root_window()
+        self._add_new_window(RootWindowModel(root))
+
+    def _setup_modifiers(self):
+        # The display's keyboard is somebody else's, and it already has its
+        # modifiers set up one way or another.
+        pass
+
+    def _resize_screen(self, client_w, client_h):
+        # The screen is the size its owner wants it to be.
+        return None
+
+    def do_wimpiggy_child_map_event(self, event):
+        # Menus and the like are already part of the screen:
+        pass
+
+    def _focus(self, id):
+        # The display's window manager looks after the focus, so all we do is
+        # keep track of which window the client thinks has it:
+        self._has_focus = id
+        for source in self._sources():
+            source.focus = id
+
+    def _process_server_settings(self, proto, packet):
+        # These would clobber the settings of the display's own desktop.
+        pass
+
+    _packet_handlers = dict(XpraServer._packet_handlers)
+    _packet_handlers["server-settings"] = _process_server_settings
+
+gobject.type_register(XpraShadowServer)
@@ -0,0 +1,65 @@
+# This file is part of Parti.
+# Copyright (C) 2010 Nathaniel Smith <njs@pobox.com>
+# Parti is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+# Several clients can be attached to a server at once: one in control, and
+# any number of read-only viewers.  They mostly get sent the same updates --
+# the same damage, captured from the same window contents -- so rather than
+# each of them encoding the same pixels again, the result is kept for a
+# little while, keyed by everything that went into it (the encoding, the
+# quality and the pixels themselves).  That way an update is only encoded
+# once for each encoding and quality the clients are using.
+#
+# Only the encoding work is shared.  What each client has been sent, its tile
+# cache, and how fast it is sent things all stay separate, so a slow viewer
+# just gets fewer, bigger updates and doesn't hold anybody else up.
+
+from threading import Lock
+
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
+
+from xpra.tiles import TileCache
+
+# Only recent updates are worth keeping: the clients are normally at most a
+# few updates apart.
+ENCODE_CACHE_SIZE = 64
+
+class EncodeCache(object):
+    """Remembers the results of recent encodes.  Used from the encoder
+    threads."""
+    def __init__(self, capacity=ENCODE_CACHE_SIZE):
+        self._cache = TileCache(capacity)
+        self._lock = Lock()
+        # With only one client, there is nobody to share with, and the
+        # digests would be wasted:
+        self.enabled = False
+        self.hits = 0
+        self.misses = 0
+
+    def encode(self, fn, encoding, quality, width, height, data):
+        """Returns fn(encoding, quality, width, height, data), or what it
+        returned when last given the same arguments."""
+        if not self.enabled:
+            return fn(encoding, quality, width, height, data)
+        key = (encoding, quality, width, height, md5(data).digest())
+        self._lock.acquire()
+        try:
+            if key in self._cache:
+                self.hits += 1
+                return self._cache.touch(key)
+        finally:
+            self._lock.release()
+        # (Another thread may be encoding the same thing right now; we
+        # don't wait for it, we just do the work twice.)
+        result = fn(encoding, quality, width, height, data)
+        self._lock.acquire()
+        try:
+            self.misses += 1
+            self._cache.add(key, result)
+        finally:
+            self._lock.release()
+        return result
@@ -0,0 +1,65 @@
+# This file is part of Parti.
+# Copyright (C) 2010 Nathaniel Smith <njs@pobox.com>
+# Parti is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import xpra.classify
+from xpra.tiles import CapturedPixels
+from xpra.classify import (classify_tile, count_colours, merge_fills,
+                           SOLID, LOW_COLOUR, CONTINUOUS, LOW_COLOUR_LIMIT,
+                           SAMPLE_ROWS)
+
+def _pixels(values):
+    return "".join([chr(v >> 16) + chr((v >> 8) & 0xff) + chr(v & 0xff)
+                    for v in values])
+
+def _classify(values):
+    pixels = CapturedPixels(0, 0, 64, len(values) // 64, _pixels(values))
+    return classify_tile(pixels, 0, 0, 64, len(values) // 64)
+
+class TestClassify(object):
+    def test_solid(self):
+        assert _classify([0x102030] * 128) == (SOLID, 0x102030)
+
+    def test_low_colour(self):
+        # Black text on white:
+        assert _classify(([0xffffff] * 7 + [0]) * 512) == (LOW_COLOUR, None)
+
+    def test_continuous(self):
+        assert _classify(range(0, 4096 * 3, 3)) == (CONTINUOUS, None)
+
+    def test_only_sampled_rows_count(self):
+        # Colourful rows in between the sampled ones are not looked at:
+        values = []
+        for y in xrange(64):
+            if y % SAMPLE_ROWS == 0:
+                values += [0xffffff] * 64
+            else:
+                values += range(y * 64, y * 64 + 64)
+        assert _classify(values) == (LOW_COLOUR, None)
+
+    def test_count_colours_without_numpy(self):
+        saved = xpra.classify.numpy
+        xpra.classify.numpy = None
+        try:
+            assert count_colours(_pixels([1, 2, 3, 2, 1] * 100)) == 3
+            assert (count_colours(_pixels(range(4096)))
+                    > LOW_COLOUR_LIMIT)
+        finally:
+            xpra.classify.numpy = saved
+
+    def test_count_colours_stops_early(self):
+        saved = xpra.classify.numpy
+        xpra.classify.numpy = None
+        try:
+            count = count_colours(_pixels(range(4096)), 10)
+            assert 10 < count < 4096
+            assert count_colours(_pixels([1, 2] * 2048), 10) == 2
+        finally:
+            xpra.classify.numpy = saved
+
+    def test_merge_fills(self):
+        fills = [[0, 0, 64, 64, 1], [64, 0, 64, 64, 1], [128, 0, 32, 64, 2],
+                 [0, 64, 64, 64, 1]]
+        assert merge_fills(fills) == [[0, 0, 128, 64, 1], [128, 0, 32, 64, 2],
+                                      [0, 64, 64, 64, 1]]
@@ -0,0 +1,15 @@
+# This file is part of Parti.
+# Copyright (C) 2010 Nathaniel Smith <njs@pobox.com>
+# Parti is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+from xpra.cursors import cursor_key
+
+class TestCursors(object):
+    def test_cursor_key(self):
+        pixels = "\0\0\0\xff" * 4
+        key = cursor_key(0, 0, 2, 2, pixels)
+        assert key == cursor_key(0, 0, 2, 2, pixels)
+        # Same pixels, different hotspot or shape:
+        assert key != cursor_key(1, 0, 2, 2, pixels)
+        assert key != cursor_key(0, 0, 4, 1, pixels)
@@ -0,0 +1,83 @@
+# This file is part of Parti.
+# Copyright (C) 2010 Nathaniel Smith <njs@pobox.com>
+# Parti is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import xpra.depth
+import xpra.kernels
+from xpra.depth import (encode_rgb565, decode_rgb565,
+                        encode_palette, decode_palette,
+                        LinkMonitor, RECOVERY_TIME)
+
+def _pixels(values):
+    return "".join([chr(v >> 16) + chr((v >> 8) & 0xff) + chr(v & 0xff)
+                    for v in values])
+
+def _without_numpy(fn):
+    saved = (xpra.depth.numpy, xpra.kernels.numpy, xpra.kernels._kernels)
+    xpra.depth.numpy = xpra.kernels.numpy = xpra.kernels._kernels = None
+    try:
+        return fn()
+    finally:
+        (xpra.depth.numpy, xpra.kernels.numpy, xpra.kernels._kernels) = saved
+
+class TestEncodings(object):
+    def test_rgb565(self):
+        data = _pixels([0x000000, 0xffffff, 0xff0000, 0x00ff00, 0x0000ff,
+                        0x123456])
+        encoded = encode_rgb565(6, 1, data, 80)
+        assert len(encoded) == 12
+        decoded = decode_rgb565(6, 1, encoded)
+        # Black, white and the primaries survive exactly:
+        assert decoded[:15] == data[:15]
+        # Other colours come back close:
+        for (a, b) in zip(decoded[15:], data[15:]):
+            assert abs(ord(a) - ord(b)) < 8
+
+    def test_rgb565_without_numpy(self):
+        data = _pixels(range(0, 0x1000000, 0x10101))
+        assert (_without_numpy(lambda: encode_rgb565(256, 1, data, 80))
+                == encode_rgb565(256, 1, data, 80))
+        encoded = encode_rgb565(256, 1, data, 80)
+        assert (_without_numpy(lambda: decode_rgb565(256, 1, encoded))
+                == decode_rgb565(256, 1, encoded))
+
+    def test_palette_is_exact_for_few_colours(self):
+        data = _pixels([0xffffff, 0, 0x336699, 0] * 16)
+        encoded = encode_palette(64, 1, data, 80)
+        assert len(encoded) == 1 + 3 * 3 + 64
+        assert decode_palette(64, 1, encoded) == data
+        assert _without_numpy(lambda: decode_palette(64, 1, encoded)) == data
+
+    def test_palette_with_many_colours(self):
+        data = _pixels(range(1024))
+        encoded = encode_palette(1024, 1, data, 80)
+        assert len(encoded) == 1 + 256 * 3 + 1024
+        assert (_without_numpy(lambda: encode_palette(1024, 1, data, 80))
+                == encoded)
+        decoded = decode_palette(1024, 1, encoded)
+        assert len(decoded) == len(data)
+        # Red and green keep their top 3 bits:
+        assert ord(decoded[0]) == 0 and ord(decoded[1]) == 0
+
+class TestLinkMonitor(object):
+    def test_congestion_and_recovery(self):
+        monitor = LinkMonitor(period=1.0)
+        assert not monitor.record(0, 0)
+        # Waiting on the link nearly all the time:
+        assert monitor.record(1, 0.9)
+        assert monitor.is_constrained
+        # Then hardly at all, for long enough:
+        switches = []
+        for i in xrange(2, 2 + int(RECOVERY_TIME) + 2):
+            if monitor.record(i, 0.9 + 0.1 * (i - 1)):
+                switches.append(i)
+        assert len(switches) == 1 and not monitor.is_constrained
+
+    def test_busy_link_stays_constrained(self):
+        monitor = LinkMonitor(period=1.0)
+        monitor.record(0, 0)
+        monitor.record(1, 1.0)
+        for i in xrange(2, 30):
+            assert not monitor.record(i, i * 0.5)
+        assert monitor.is_constrained
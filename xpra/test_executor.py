@@ -0,0 +1,65 @@
+# This file is part of Parti.
+# Copyright (C) 2010 Nathaniel Smith <njs@pobox.com>
+# Parti is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+from threading import Event
+
+from xpra.executor import InlineExecutor, ThreadPoolExecutor, UpdateQueue
+
+def fail():
+    raise ValueError("boom")
+
+class TestExecutors(object):
+    def test_inline(self):
+        job = InlineExecutor().submit(None, lambda a, b: a + b, 1, 2)
+        assert job.done
+        assert job.result() == 3
+
+    def test_errors_are_reraised(self):
+        job = InlineExecutor().submit(None, fail)
+        try:
+            job.result()
+        except ValueError:
+            pass
+        else:
+            assert False, "result() should have re-raised"
+
+    def test_thread_pool(self):
+        executor = ThreadPoolExecutor(2)
+        finished = []
+        all_done = Event()
+        def callback(job):
+            finished.append(job)
+            if len(finished) == 10:
+                all_done.set()
+        jobs = [executor.submit(callback, lambda i: i * i, i)
+                for i in xrange(10)]
+        all_done.wait(10)
+        assert len(finished) == 10
+        assert [job.result() for job in jobs] == [i * i for i in xrange(10)]
+
+class TestUpdateQueue(object):
+    def test_order_and_in_flight(self):
+        executor = InlineExecutor()
+        updates = UpdateQueue()
+        updates.append(["tile-ref", 1])
+        updates.append_job(1, executor.submit(None, lambda: ["draw", 1]))
+        updates.jump_queue(2, ["draw", 2])
+        assert updates.in_flight(1) and not updates.in_flight(2)
+        popped = []
+        while updates.ready():
+            popped.append(updates.pop())
+        assert popped == [(["draw", 2], None), (["tile-ref", 1], None),
+                          (["draw", 1], None)]
+        assert not updates.in_flight(1)
+
+    def test_failed_job(self):
+        updates = UpdateQueue()
+        updates.append_job(1, InlineExecutor().submit(None, fail), "info")
+        updates.append(["fill", 1])
+        assert updates.pop() == (None, "info")
+        # The window isn't held up by the failure:
+        assert not updates.in_flight(1)
+        assert updates.pop() == (["fill", 1], None)
+        assert not updates.ready()
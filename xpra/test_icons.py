@@ -0,0 +1,31 @@
+# This file is part of Parti.
+# Copyright (C) 2010 Nathaniel Smith <njs@pobox.com>
+# Parti is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import struct
+
+from xpra.icons import icon_key, fit_icon_size, unpremultiply_argb
+
+def argb(*pixels):
+    return struct.pack("@" + "I" * len(pixels), *pixels)
+
+class TestIcons(object):
+    def test_icon_key(self):
+        data = argb(0xff000000) * 4
+        assert icon_key(2, 2, data) == icon_key(2, 2, data)
+        assert icon_key(2, 2, data) != icon_key(4, 1, data)
+
+    def test_fit_icon_size(self):
+        assert fit_icon_size(256, 256, 64) == (64, 64)
+        assert fit_icon_size(256, 128, 64) == (64, 32)
+        assert fit_icon_size(100, 300, 64) == (21, 64)
+        assert fit_icon_size(16, 16, 64) == (16, 16)
+
+    def test_unpremultiply(self):
+        # (see test_kernels for the rest)
+        data = argb(0xffff8000, 0x00000000, 0x80800000, 0x40102030)
+        assert unpremultiply_argb(data) == ("\xff\x80\x00\xff"
+                                            "\x00\x00\x00\x00"
+                                            "\xff\x00\x00\x80"
+                                            "\x3f\x7f\xbf\x40")
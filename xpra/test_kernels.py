@@ -0,0 +1,71 @@
+# This file is part of Parti.
+# Copyright (C) 2010 Nathaniel Smith <njs@pobox.com>
+# Parti is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import struct
+
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
+
+import xpra.kernels
+from xpra.kernels import (rgb24_to_rgb565, unpremultiply_argb, region_data,
+                          row_digests, solid_pixel)
+
+def each_implementation(fn):
+    """Returns fn()'s results with each of the implementations we have."""
+    saved = (xpra.kernels._kernels, xpra.kernels.numpy)
+    choices = [(None, None)]
+    if saved[0] is not None:
+        choices.append((saved[0], None))
+    if saved[1] is not None:
+        choices.append((None, saved[1]))
+    results = []
+    try:
+        for (xpra.kernels._kernels, xpra.kernels.numpy) in choices:
+            results.append(fn())
+    finally:
+        (xpra.kernels._kernels, xpra.kernels.numpy) = saved
+    return results
+
+RGB24 = "\x01\x02\x03\xff\xff\xff\xff\x00\x00\x00\xff\x00"
+
+class TestKernels(object):
+    def test_rgb565(self):
+        expected = struct.pack("<HHHH", 0x0000, 0xffff, 0xf800, 0x07e0)
+        for result in each_implementation(lambda: rgb24_to_rgb565(RGB24)):
+            assert result == expected
+
+    def test_unpremultiply(self):
+        data = struct.pack("@IIII", 0xffff8000, 0x00000000, 0x80800000,
+                           0x40102030)
+        for result in each_implementation(lambda: unpremultiply_argb(data)):
+            assert result == ("\xff\x80\x00\xff"
+                              "\x00\x00\x00\x00"
+                              "\xff\x00\x00\x80"
+                              "\x3f\x7f\xbf\x40")
+
+    def test_region_data(self):
+        data = "abcdefXXghijklXXmnopqr"
+        for result in each_implementation(lambda: region_data(data, 8, 2,
+                                                              4, 3)):
+            assert result == "cdefijklopqr"
+        for result in each_implementation(lambda: region_data(data, 8, 8,
+                                                              6, 1)):
+            assert result == "ghijkl"
+
+    def test_digests(self):
+        data = "abcdefXXghijklXX"
+        assert row_digests(data, 8, 6, 2) == [md5("abcdef").digest(),
+                                              md5("ghijkl").digest()]
+
+    def test_solid_pixel(self):
+        data = "abcabcXXabcabcXXabcabd"
+        for result in each_implementation(lambda: solid_pixel(data, 8, 0,
+                                                              6, 2)):
+            assert result == "abc"
+        for result in each_implementation(lambda: solid_pixel(data, 8, 0,
+                                                              6, 3)):
+            assert result is None
@@ -0,0 +1,79 @@
+# This file is part of Parti.
+# Copyright (C) 2010 Nathaniel Smith <njs@pobox.com>
+# Parti is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import os
+import tempfile
+
+from xpra.rules import (EncodingRules, RulesError, Profile, parse_rules,
+                        window_type_name)
+
+RULES = """
+# Terminals and editors: lossless
+class=XTerm encoding=rgb24
+class=Emacs encoding=png
+class=Firefox title="*- YouTube*" encoding=jpeg quality=60 max-fps=25
+class=Firefox encoding=jpeg quality=80
+type=DIALOG priority=high
+transient=yes priority=high delay=0
+delay=20
+"""
+
+def _window(cls, title=u"", types=("NORMAL",), transient=False):
+    return {"class": cls, "instance": cls.lower(), "title": title,
+            "type": list(types), "transient": transient}
+
+def _load(text):
+    (fd, filename) = tempfile.mkstemp()
+    os.write(fd, text)
+    os.close(fd)
+    return filename
+
+class TestRules(object):
+    def test_profiles(self):
+        rules = EncodingRules()
+        rules._rules = parse_rules(RULES.splitlines())
+        assert (rules.profile_for(_window(u"XTerm"))
+                == Profile(encoding="rgb24", delay=0.02))
+        assert (rules.profile_for(_window(u"Firefox", u"Cats - YouTube"))
+                == Profile(encoding="jpeg", quality=60, max_fps=25.0,
+                           delay=0.02))
+        assert (rules.profile_for(_window(u"firefox", u"Mail"))
+                == Profile(encoding="jpeg", quality=80, delay=0.02))
+        assert (rules.profile_for(_window(u"Gimp", types=["DIALOG"]))
+                == Profile(priority="high", delay=0.02))
+        assert (rules.profile_for(_window(u"Gimp", transient=True))
+                == Profile(priority="high", delay=0.0))
+
+    def test_window_type_name(self):
+        assert window_type_name("_NET_WM_WINDOW_TYPE_DIALOG") == "DIALOG"
+
+    def test_errors(self):
+        for line in ("class=XTerm", "class=XTerm encoding=gif",
+                     "priority=urgent", "frobnicate", "max-fps=0",
+                     "transient=maybe delay=1"):
+            try:
+                parse_rules([line])
+            except RulesError:
+                pass
+            else:
+                assert False, line
+
+    def test_reload_keeps_old_rules_on_error(self):
+        filename = _load("class=XTerm encoding=png\n")
+        try:
+            rules = EncodingRules(filename)
+            assert rules.profile_for(_window(u"XTerm")).encoding == "png"
+            f = open(filename, "w")
+            f.write("class=XTerm encoding=\n")
+            f.close()
+            try:
+                rules.load()
+            except RulesError:
+                pass
+            else:
+                assert False
+            assert rules.profile_for(_window(u"XTerm")).encoding == "png"
+        finally:
+            os.unlink(filename)
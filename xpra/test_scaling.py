@@ -0,0 +1,35 @@
+# This file is part of Parti.
+# Copyright (C) 2010 Nathaniel Smith <njs@pobox.com>
+# Parti is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+from xpra.scaling import (clamp_scale, scale_value, unscale_value,
+                          scale_rect, unscale_point, scale_size_constraints)
+
+class TestScaling(object):
+    def test_values(self):
+        assert scale_value(640, 50) == 320
+        assert unscale_value(320, 50) == 640
+        assert scale_value(1, 10) == 1
+        assert scale_value(123, 100) == 123
+        for value in (1, 99, 640, 1001):
+            assert abs(unscale_value(scale_value(value, 75), 75) - value) <= 1
+
+    def test_clamp(self):
+        assert clamp_scale(5) == 10
+        assert clamp_scale(250) == 100
+
+    def test_scale_rect(self):
+        assert scale_rect(0, 0, 100, 100, 50) == (0, 0, 50, 50)
+        # Partly covered pixels at either edge are included:
+        assert scale_rect(3, 3, 2, 2, 50) == (1, 1, 2, 2)
+
+    def test_unscale_point(self):
+        assert unscale_point((100, 100), (150, 120), 50) == (200, 140)
+        assert unscale_point((100, 100), (150, 120), 100) == (150, 120)
+
+    def test_size_constraints(self):
+        scaled = scale_size_constraints({"minimum-size": (200, 100),
+                                         "minimum-aspect": (4, 3)}, 50)
+        assert scaled == {"minimum-size": [100, 50],
+                          "minimum-aspect": (4, 3)}
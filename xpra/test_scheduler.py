@@ -0,0 +1,61 @@
+# This file is part of Parti.
+# Copyright (C) 2010 Nathaniel Smith <njs@pobox.com>
+# Parti is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+from xpra.scheduler import DamageScheduler, LatencyHistogram
+
+def always(id):
+    return True
+
+class TestDamageScheduler(object):
+    def test_earliest_deadline_first(self):
+        schedule = DamageScheduler()
+        schedule.add(1, 0.0, 0.1)
+        schedule.add(2, 0.01, 0.01)
+        assert schedule.next(always) == 2
+        # Adding again doesn't lose a window its place:
+        schedule.add(1, 5.0, 0.1)
+        schedule.served(2, 0.02)
+        assert schedule.next(always) == 1
+        assert schedule.arrival(1) == 0.0
+        assert 2 not in schedule
+        assert schedule.arrival(2) is None
+
+    def test_busy_window_takes_turns(self):
+        schedule = DamageScheduler()
+        schedule.add(1, 0.0, 0.025)
+        schedule.add(2, 0.0, 0.1)
+        served = []
+        now = 0.0
+        for i in xrange(10):
+            id = schedule.next(always)
+            served.append(id)
+            now += 0.02
+            schedule.served(id, now)
+            # Both windows keep getting damaged:
+            schedule.add(id, now, {1: 0.025, 2: 0.1}[id])
+        assert 2 in served[:6]
+        assert served.count(1) > served.count(2)
+
+    def test_not_ready(self):
+        schedule = DamageScheduler()
+        schedule.add(1, 0.0, 0.01)
+        schedule.add(2, 0.0, 0.1)
+        assert schedule.next(lambda id: id != 1) == 2
+        assert schedule.next(always) == 1
+        schedule.remove(1)
+        assert schedule.next(always) == 2
+        assert schedule.next(lambda id: False) is None
+
+class TestLatencyHistogram(object):
+    def test_histogram(self):
+        histogram = LatencyHistogram()
+        for latency in (0.001, 0.002, 0.015, 0.030, 2.0):
+            histogram.record(latency)
+        assert len(histogram) == 5
+        assert histogram.percentile(40) == 5
+        assert histogram.percentile(50) == 20
+        assert histogram.percentile(80) == 50
+        assert histogram.percentile(100) is None
+        assert histogram.max == 2.0
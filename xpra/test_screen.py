@@ -0,0 +1,26 @@
+# This file is part of Parti.
+# Copyright (C) 2010 Nathaniel Smith <njs@pobox.com>
+# Parti is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+from xpra.screen import pick_screen_size, clamp_window_geometry
+
+class TestScreen(object):
+    def test_pick_screen_size(self):
+        sizes = [(3840, 1920), (1920, 1200), (1280, 1024), (1024, 768)]
+        assert pick_screen_size(sizes, (1280, 800)) == (1280, 1024)
+        assert pick_screen_size(sizes, (1920, 1080)) == (1920, 1200)
+        assert pick_screen_size(sizes, (1024, 768)) == (1024, 768)
+        # Nothing is big enough:
+        assert pick_screen_size(sizes, (5000, 1000)) == (3840, 1920)
+        assert pick_screen_size([], (1024, 768)) is None
+
+    def test_clamp_window_geometry(self):
+        assert (clamp_window_geometry(10, 10, 100, 100, 1024, 768)
+                == (10, 10, 100, 100))
+        # Off the edge:
+        assert (clamp_window_geometry(1000, 700, 100, 100, 1024, 768)
+                == (924, 668, 100, 100))
+        # Too big:
+        assert (clamp_window_geometry(0, 0, 2000, 100, 1024, 768)
+                == (0, 0, 1024, 100))
@@ -0,0 +1,29 @@
+# This file is part of Parti.
+# Copyright (C) 2010 Nathaniel Smith <njs@pobox.com>
+# Parti is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+from xpra.sharing import EncodeCache
+
+class TestEncodeCache(object):
+    def test_encode_once(self):
+        calls = []
+        def fn(encoding, quality, width, height, data):
+            calls.append((encoding, quality))
+            return (encoding, data.upper())
+        cache = EncodeCache(4)
+        # Nothing is shared until there are several clients:
+        assert cache.encode(fn, "png", 80, 1, 1, "abc") == ("png", "ABC")
+        assert cache.encode(fn, "png", 80, 1, 1, "abc") == ("png", "ABC")
+        assert len(calls) == 2
+        cache.enabled = True
+        calls[:] = []
+        assert cache.encode(fn, "png", 80, 1, 1, "abc") == ("png", "ABC")
+        assert cache.encode(fn, "png", 80, 1, 1, "abc") == ("png", "ABC")
+        assert calls == [("png", 80)]
+        assert (cache.hits, cache.misses) == (1, 1)
+        # Each encoding and quality is encoded separately:
+        cache.encode(fn, "jpeg", 80, 1, 1, "abc")
+        cache.encode(fn, "jpeg", 50, 1, 1, "abc")
+        cache.encode(fn, "png", 80, 1, 1, "abd")
+        assert len(calls) == 4
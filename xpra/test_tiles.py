@@ -0,0 +1,152 @@
+# This file is part of Parti.
+# Copyright (C) 2010 Nathaniel Smith <njs@pobox.com>
+# Parti is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import xpra.kernels
+from xpra.tiles import (CapturedPixels, TileState, TileCache,
+                        align_to_tiles, iter_tiles, merge_tile_runs)
+
+def make_pixels(x, y, w, h, fill="a", rowstride=None):
+    if rowstride is None:
+        rowstride = w * 3
+    rows = []
+    for i in xrange(h):
+        rows.append((fill * (w * 3)) + ("X" * (rowstride - w * 3)))
+    return CapturedPixels(x, y, w, h, "".join(rows), rowstride)
+
+class TestTiles(object):
+    def test_align_to_tiles(self):
+        assert align_to_tiles(10, 10, 5, 5, 1000, 1000, 64) == (0, 0, 64, 64)
+        assert align_to_tiles(70, 10, 60, 5, 1000, 1000, 64) == (64, 0, 128, 64)
+        assert align_to_tiles(10, 10, 5, 5, 30, 20, 64) == (0, 0, 30, 20)
+        assert align_to_tiles(0, 0, 64, 64, 1000, 1000, 64) == (0, 0, 64, 64)
+
+    def test_iter_tiles(self):
+        tiles = list(iter_tiles(0, 64, 100, 64, 64))
+        assert tiles == [(0, 64, 64, 64), (64, 64, 36, 64)]
+
+    def test_tile_data(self):
+        pixels = make_pixels(64, 0, 4, 2, rowstride=16)
+        assert pixels.tile_data(65, 1, 2, 1) == "a" * 6
+
+    def test_tile_data_without_numpy(self):
+        saved = (xpra.kernels._kernels, xpra.kernels.numpy)
+        xpra.kernels._kernels = xpra.kernels.numpy = None
+        try:
+            pixels = make_pixels(0, 0, 4, 2, rowstride=16)
+            assert pixels.tile_data(1, 0, 3, 2) == "a" * 18
+        finally:
+            (xpra.kernels._kernels, xpra.kernels.numpy) = saved
+
+    def test_changed_tiles(self):
+        state = TileState(2)
+        pixels = make_pixels(0, 0, 4, 2)
+        assert len(state.changed_tiles(pixels, 0, 0, 4, 2)) == 2
+        assert state.changed_tiles(pixels, 0, 0, 4, 2) == []
+        data = list(pixels.data)
+        # Change one pixel in the second tile:
+        data[3 * 3] = "b"
+        pixels = CapturedPixels(0, 0, 4, 2, "".join(data))
+        changed = state.changed_tiles(pixels, 0, 0, 4, 2)
+        assert [c[:4] for c in changed] == [(2, 0, 2, 2)]
+        state.forget_rect(0, 0, 1, 1)
+        changed = state.changed_tiles(pixels, 0, 0, 4, 2)
+        assert [c[:4] for c in changed] == [(0, 0, 2, 2)]
+        state.forget()
+        assert len(state.changed_tiles(pixels, 0, 0, 4, 2)) == 2
+
+    def test_merge_tile_runs(self):
+        tiles = [(0, 0, 64, 64), (64, 0, 64, 64), (192, 0, 64, 64),
+                 (0, 64, 64, 10)]
+        assert merge_tile_runs(tiles) == [(0, 0, 128, 64), (192, 0, 64, 64),
+                                          (0, 64, 64, 10)]
+
+class TestTileCache(object):
+    def test_lru_eviction(self):
+        cache = TileCache(2)
+        cache.add("a", 1)
+        cache.add("b", 2)
+        assert cache.touch("a") == 1
+        cache.add("c", 3)
+        assert "a" in cache and "c" in cache
+        assert "b" not in cache
+        assert len(cache) == 2
+        cache.add("a", 4)
+        cache.add("d", 5)
+        assert cache.touch("a") == 4
+        assert "c" not in cache
+
+    def test_mirrors_stay_in_sync(self):
+        client = TileCache(3)
+        server = TileCache(3)
+        ops = [("add", "a"), ("add", "b"), ("touch", "a"), ("add", "c"),
+               ("add", "d"), ("touch", "c"), ("add", "e"), ("add", "b")]
+        for (op, key) in ops:
+            if op == "add":
+                client.add(key, key.upper())
+                server.add(key)
+            else:
+                client.touch(key)
+                server.touch(key)
+            assert sorted(client._entries) == sorted(server._entries)
+
+    def test_discard_keeps_server_within_client(self):
+        client = TileCache(2)
+        server = TileCache(2)
+        for key in ("a", "b"):
+            client.add(key, key.upper())
+            server.add(key)
+        # The server adds "c", but the client never hears about it:
+        server.add("c")
+        server.discard("c")
+        server.discard("c")
+        for key in ("d", "e", "f"):
+            client.add(key, key.upper())
+            server.add(key)
+            for known in server._entries:
+                assert known in client
+        assert len(server) == 2
+
+    def test_disabled(self):
+        cache = TileCache(0)
+        cache.add("a", 1)
+        assert "a" not in cache
+        try:
+            cache.touch("a")
+        except KeyError:
+            pass
+        else:
+            assert False, "touch() of a missing key should fail"
+
+class TestScrollDetection(object):
+    def _rows(self, lines):
+        return [CapturedPixels(0, 0, 1, 1, line * 3).row_digests()[0]
+                for line in lines]
+
+    def test_detect_scroll(self):
+        state = TileState(2)
+        old = self._rows("abcdefgh")
+        state.set_rows(0, old, 10)
+        # Scrolled up by two rows, with two new rows at the bottom:
+        new = self._rows("cdefghij")
+        assert state.detect_scroll(0, new, 10, min_lines=4) == (-2, 0, 6)
+        # Not enough rows to be worth it:
+        assert state.detect_scroll(0, new, 10, min_lines=7) is None
+        # Width changed, so the rows we know about are useless:
+        assert state.detect_scroll(0, new, 12, min_lines=4) is None
+
+    def test_blank_rows_do_not_vote(self):
+        state = TileState(2)
+        state.set_rows(0, self._rows("aaaaaaaa"), 10)
+        assert state.detect_scroll(0, self._rows("aaaaaaab"), 10,
+                                   min_lines=1) is None
+
+    def test_copied_rows_force_partial_tiles(self):
+        state = TileState(2)
+        pixels = make_pixels(0, 0, 2, 6)
+        assert len(state.changed_tiles(pixels, 0, 0, 2, 6)) == 3
+        # Rows 1-4 were copied: the tile at row 2 is wholly inside the copy,
+        # but the ones at rows 0 and 4 are only partly covered.
+        changed = state.changed_tiles(pixels, 0, 0, 2, 6, copied_rows=(1, 5))
+        assert [c[:2] for c in changed] == [(0, 0), (0, 4)]
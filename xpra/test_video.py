@@ -0,0 +1,38 @@
+# This file is part of Parti.
+# Copyright (C) 2010 Nathaniel Smith <njs@pobox.com>
+# Parti is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+from xpra.video import VideoDetector
+
+def feed(detector, start, seconds, fps, area, window_area):
+    switches = []
+    for i in xrange(int(seconds * fps)):
+        now = start + float(i) / fps
+        if detector.record(now, area, window_area):
+            switches.append((now, detector.is_video))
+    return switches
+
+class TestVideoDetector(object):
+    def test_video_switches_on_and_off(self):
+        detector = VideoDetector(period=2.0)
+        # 25 full-window frames a second:
+        switches = feed(detector, 0, 3, 25, 100, 100)
+        assert len(switches) == 1 and switches[0][1]
+        # ...and then only a trickle:
+        switches = feed(detector, 3, 3, 2, 100, 100)
+        assert len(switches) == 1 and not switches[0][1]
+
+    def test_small_updates_are_not_video(self):
+        detector = VideoDetector(period=2.0)
+        # A blinking cursor, say -- frequent, but tiny:
+        assert feed(detector, 0, 5, 25, 1, 100) == []
+        assert not detector.is_video
+
+    def test_idle(self):
+        detector = VideoDetector(period=2.0)
+        feed(detector, 0, 3, 25, 100, 100)
+        assert detector.is_video
+        assert detector.idle()
+        assert not detector.is_video
+        assert not detector.idle()
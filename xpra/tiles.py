@@ -0,0 +1,292 @@
+# This file is part of Parti.
+# Copyright (C) 2010 Nathaniel Smith <njs@pobox.com>
+# Parti is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+# Splitting captured window contents into fixed-size tiles, and keeping track
+# of which tiles the client already has, so that we only send the ones that
+# actually changed.
+
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
+
+from xpra import kernels
+
+# Tiles are aligned to a grid in window coordinates, so that the same tile
+# always covers the same pixels no matter which damage rectangle it was
+# captured as part of:
+TILE_SIZE = 64
+
+def align_to_tiles(x, y, w, h, max_w, max_h, size=TILE_SIZE):
+    """Grow the rectangle (x, y, w, h) outwards to tile boundaries, then clip
+    it to a (max_w, max_h)-sized window."""
+    x2 = min(x + w, max_w)
+    y2 = min(y + h, max_h)
+    x = x - (x % size)
+    y = y - (y % size)
+    x2 = min(x2 + (-x2 % size), max_w)
+    y2 = min(y2 + (-y2 % size), max_h)
+    return (x, y, max(x2 - x, 0), max(y2 - y, 0))
+
+def iter_tiles(x, y, w, h, size=TILE_SIZE):
+    """Yields (tx, ty, tw, th) for every tile that makes up the rectangle (x,
+    y, w, h), which must already be aligned to tile boundaries (except
+    possibly for its right and bottom edges, at the window border)."""
+    assert x % size == 0 and y % size == 0
+    for ty in xrange(y, y + h, size):
+        th = min(size, y + h - ty)
+        for tx in xrange(x, x + w, size):
+            tw = min(size, x + w - tx)
+            yield (tx, ty, tw, th)
+
+class CapturedPixels(object):
+    """A block of captured pixel data, as returned by the pixel capture code:
+    'data' holds 'height' rows of 'rowstride' bytes each, with the top-left
+    pixel at window coordinates (x, y).  Tile positions passed to methods of
+    this class are in window coordinates."""
+    def __init__(self, x, y, width, height, data, rowstride=None, bpp=3):
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+        self.data = data
+        self.bpp = bpp
+        if rowstride is None:
+            rowstride = width * bpp
+        self.rowstride = rowstride
+
+    def tile_data(self, tx, ty, tw, th):
+        return kernels.region_data(self.data, self.rowstride,
+                                   self._offset(tx, ty, tw, th),
+                                   tw * self.bpp, th)
+
+    def _offset(self, tx, ty, tw, th):
+        x = tx - self.x
+        y = ty - self.y
+        assert x >= 0 and y >= 0
+        assert x + tw <= self.width and y + th <= self.height
+        return y * self.rowstride + x * self.bpp
+
+    def tile_digest(self, tx, ty, tw, th):
+        return md5(self.tile_data(tx, ty, tw, th)).digest()
+
+    def solid_pixel(self, tx, ty, tw, th):
+        """Returns the pixel that the tile is filled with, or None if it has
+        more than one colour."""
+        return kernels.solid_pixel(self.data, self.rowstride,
+                                   self._offset(tx, ty, tw, th),
+                                   tw * self.bpp, th, self.bpp)
+
+    def row_digests(self):
+        """Returns a list with one digest for each row of the capture."""
+        return kernels.row_digests(self.data, self.rowstride,
+                                   self.width * self.bpp, self.height)
+
+class TileState(object):
+    """Remembers a digest for every tile of a window that has been sent to the
+    client, so that repaints of identical content can be skipped.
+
+    When the client was sent whole rows of the window, a digest for each of
+    those rows is kept as well, to detect scrolling."""
+    def __init__(self, size=TILE_SIZE):
+        self.size = size
+        self._digests = {}
+        self._rows = {}
+        self._rows_width = None
+
+    def forget(self):
+        self._digests.clear()
+        self._rows.clear()
+
+    def forget_rect(self, x, y, w, h):
+        # Throw away what we know about any tile overlapping this rectangle
+        # (e.g. because the client's copy of it was changed behind our back):
+        for key in self._digests.keys():
+            (tx, ty) = key
+            if (tx < x + w and tx + self.size > x
+                and ty < y + h and ty + self.size > y):
+                del self._digests[key]
+        self.forget_rows(y, h)
+
+    def forget_rows(self, y, h):
+        for row in xrange(y, y + h):
+            if row in self._rows:
+                del self._rows[row]
+
+    def set_rows(self, y, digests, width):
+        """Records the row digests of a full-width capture starting at row
+        'y', once the client has been sent everything in it."""
+        if width != self._rows_width:
+            self._rows.clear()
+            self._rows_width = width
+        for (i, digest) in enumerate(digests):
+            self._rows[y + i] = digest
+
+    def detect_scroll(self, y, digests, width, min_lines=2 * TILE_SIZE):
+        """Looks for a vertical shift between the rows of a new full-width
+        capture starting at row 'y' (given by their 'digests') and the rows
+        last sent to the client.
+
+        Returns None, or (dy, y1, y2), meaning that rows y1 to y2 (exclusive)
+        of the new capture are the same as rows y1 - dy to y2 - dy of what
+        the client already has."""
+        if width != self._rows_width or not self._rows:
+            return None
+        old = self._rows
+        where = {}
+        for (old_y, digest) in old.iteritems():
+            where.setdefault(digest, []).append(old_y)
+        votes = {}
+        for (i, digest) in enumerate(digests):
+            matches = where.get(digest)
+            # Rows that occur more than once (blank lines, mostly) say
+            # nothing about where they came from, so only unique rows vote:
+            if matches is not None and len(matches) == 1:
+                dy = y + i - matches[0]
+                if dy:
+                    votes[dy] = votes.get(dy, 0) + 1
+        if not votes:
+            return None
+        (_, dy) = max([(count, dy) for (dy, count) in votes.iteritems()])
+        # Now find the longest run of rows which really are shifted by dy:
+        (best_start, best_end) = (0, 0)
+        start = None
+        for i in xrange(len(digests) + 1):
+            if i < len(digests) and old.get(y + i - dy) == digests[i]:
+                if start is None:
+                    start = i
+            elif start is not None:
+                if i - start > best_end - best_start:
+                    (best_start, best_end) = (start, i)
+                start = None
+        if best_end - best_start < min_lines:
+            return None
+        return (dy, y + best_start, y + best_end)
+
+    def changed_tiles(self, pixels, x, y, w, h, copied_rows=None):
+        """Compares every tile of the (tile-aligned) rectangle (x, y, w, h)
+        against what was last sent, and returns a list of (tx, ty, tw, th,
+        digest) for those that differ.  The state is updated on the
+        assumption that the caller will go on to send all of them.
+
+        If the client has just had rows copied into place (because of a
+        scroll), 'copied_rows' gives their range (y1, y2): tiles entirely
+        inside it are up to date, and tiles partly inside it must be resent
+        no matter what."""
+        changed = []
+        for (tx, ty, tw, th) in iter_tiles(x, y, w, h, self.size):
+            digest = pixels.tile_digest(tx, ty, tw, th)
+            # Edge tiles can change size when the window does, so the size
+            # is stored (and compared) along with the digest:
+            key = (tx, ty)
+            value = (tw, th, digest)
+            if copied_rows is not None:
+                (y1, y2) = copied_rows
+                if ty >= y1 and ty + th <= y2:
+                    self._digests[key] = value
+                    continue
+                if ty < y2 and ty + th > y1:
+                    self._digests[key] = value
+                    changed.append((tx, ty, tw, th, digest))
+                    continue
+            if self._digests.get(key) != value:
+                self._digests[key] = value
+                changed.append((tx, ty, tw, th, digest))
+        return changed
+
+def merge_tile_runs(tiles):
+    """Merges horizontally adjacent tiles of the same height into strips, to
+    cut down on the number of packets.  Takes and returns a list of (x, y, w,
+    h) tuples; the input must be in the row-major order produced by
+    iter_tiles."""
+    merged = []
+    for (x, y, w, h) in tiles:
+        if merged:
+            (mx, my, mw, mh) = merged[-1]
+            if my == y and mh == h and mx + mw == x:
+                merged[-1] = (mx, my, mw + w, mh)
+                continue
+        merged.append((x, y, w, h))
+    return merged
+
+class TileCache(object):
+    """A bounded, least-recently-used mapping from tile keys to tile data.
+
+    The client keeps one of these holding the pixels of tiles it has been
+    sent; the server keeps one with the same capacity (storing None for every
+    value) to know which tiles the client has.  For the two to stay in sync,
+    both ends must perform exactly the same sequence of add() and touch()
+    calls -- so eviction here must be completely deterministic."""
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._entries = {}
+        # Circular doubly-linked list of [prev, next, key, value] nodes, most
+        # recently used first:
+        self._head = [None, None, None, None]
+        self._head[0] = self._head[1] = self._head
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def _unlink(self, node):
+        node[0][1] = node[1]
+        node[1][0] = node[0]
+
+    def _link_first(self, node):
+        node[0] = self._head
+        node[1] = self._head[1]
+        self._head[1][0] = node
+        self._head[1] = node
+
+    def touch(self, key):
+        """Marks 'key' as just used and returns its value; raises KeyError if
+        it is not in the cache."""
+        node = self._entries[key]
+        self._unlink(node)
+        self._link_first(node)
+        return node[3]
+
+    def add(self, key, value=None):
+        if self.capacity <= 0:
+            return
+        if key in self._entries:
+            node = self._entries[key]
+            node[3] = value
+            self.touch(key)
+            return
+        while len(self._entries) >= self.capacity:
+            oldest = self._head[0]
+            self._unlink(oldest)
+            del self._entries[oldest[2]]
+        node = [None, None, key, value]
+        self._entries[key] = node
+        self._link_first(node)
+
+    def discard(self, key):
+        """Removes 'key', if it is there.  The server uses this for tiles
+        that were added but then never reached the client after all; the
+        client then holds everything the server's cache does, so the two stay
+        in step."""
+        node = self._entries.pop(key, None)
+        if node is not None:
+            self._unlink(node)
+
+    def clear(self):
+        self._entries.clear()
+        self._head[0] = self._head[1] = self._head
+
+def tile_key(w, h, digest):
+    # Tiles at the window edges can be smaller than TILE_SIZE; including the
+    # size keeps a digest from ever matching a tile of different dimensions.
+    return "%sx%s:%s" % (w, h, digest)
+
+def hit_rate(hits, total):
+    """Formats a hit count as a percentage, for the statistics logs."""
+    if not total:
+        return "n/a"
+    return "%.1f%%" % (100.0 * hits / total)
@@ -0,0 +1,71 @@
+# This file is part of Parti.
+# Copyright (C) 2010 Nathaniel Smith <njs@pobox.com>
+# Parti is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+# Spotting windows that are playing video (or some other animation that
+# repaints most of the window many times a second).  For those, sending
+# lossless frames just saturates the link, so the server switches them to a
+# lossy encoding at a lower frame rate -- and once they calm down again, sends
+# one lossless refresh so that they end up pixel-perfect.
+#
+# The caller passes in the current time.
+
+# How far back we look when deciding:
+VIDEO_PERIOD = 2.0
+# A window is treated as video once, over the period above, it gets at least
+# this many damage events per second...
+VIDEO_MIN_RATE = 10
+# ...which together repaint at least this many times the window's area per
+# second:
+VIDEO_MIN_AREA = 1.0
+# It stops being video once it drops below these fractions of the above (the
+# gap stops a window flapping between the two modes):
+VIDEO_HYSTERESIS = 0.5
+
+# What we send video windows:
+VIDEO_QUALITY = 50
+VIDEO_FRAME_INTERVAL = 0.1
+# How long a video window must go without damage before we send it a lossless
+# refresh (the server's --refresh-delay overrides this):
+DEFAULT_REFRESH_DELAY = 1.0
+
+class VideoDetector(object):
+    def __init__(self, period=VIDEO_PERIOD):
+        self.period = period
+        self.is_video = False
+        self._events = []
+
+    def record(self, now, area, window_area):
+        """Records a damage event covering 'area' pixels, in a window of
+        'window_area' pixels.  Returns True if this switched the window into
+        or out of video mode."""
+        self._events.append((now, area))
+        cutoff = now - self.period
+        while self._events and self._events[0][0] < cutoff:
+            del self._events[0]
+        # Don't decide anything until we have seen at least half a period:
+        if not self._events or now - self._events[0][0] < self.period / 2:
+            rate = 0.0
+            coverage = 0.0
+        else:
+            rate = len(self._events) / self.period
+            total = sum([a for (_, a) in self._events])
+            coverage = total / (self.period * max(window_area, 1))
+        if self.is_video:
+            still_video = (rate >= VIDEO_MIN_RATE * VIDEO_HYSTERESIS
+                           and coverage >= VIDEO_MIN_AREA * VIDEO_HYSTERESIS)
+            if not still_video:
+                self.is_video = False
+                return True
+        elif rate >= VIDEO_MIN_RATE and coverage >= VIDEO_MIN_AREA:
+            self.is_video = True
+            return True
+        return False
+
+    def idle(self):
+        """Called when the window has not been damaged for a while."""
+        self._events = []
+        was_video = self.is_video
+        self.is_video = False
+        return was_video